@@ -1,20 +1,389 @@
 from __future__ import annotations
 
 import abc
+import time
 import typing
+import uuid
 
+import aiohttp
 from asgiref.typing import ASGIApplication
+from loguru import logger
 
+from ailingbot.channels.delivery import DeliveryQueue
+from ailingbot.channels.token import AccessTokenManager, TokenStore
+from ailingbot.chat.messages import (
+    FallbackResponseMessage,
+    FileRequestMessage,
+    NoticeResponseMessage,
+    RequestMessage,
+    ResponseMessage,
+    TextResponseMessage,
+)
+from ailingbot.config import settings
 from ailingbot.shared.abc import AbstractAsyncComponent
+from ailingbot.shared.errors import AilingBotError, InvalidAccessTokenError
 from ailingbot.shared.misc import get_class_dynamically
 
+if typing.TYPE_CHECKING:
+    from ailingbot.chat.chatbot import ChatBot
+
+T = typing.TypeVar('T')
+
 
 class ChannelAgent(AbstractAsyncComponent, abc.ABC):
-    """Base class of channel agents."""
+    """Base class of channel agents.
+
+    Each agent owns one pooled HTTP session, created in _initialize and closed in _finalize, so that API calls reuse
+    keep-alive connections and cached DNS lookups instead of paying a handshake each. Agents of APIs that need an
+    access token set tokens to the manager created by _create_token_manager, and make API calls through
+    _with_access_token. Responses are sent through an outbound delivery queue, rate limited to delivery rate calls per
+    second with bursts of delivery burst calls, which agents set to the documented limits of their platform. Agents of
+    platforms that limit calls per chat or per API method key their calls by bucket in _delivery_bucket, and set the
+    limits of buckets that differ from the delivery rate and burst in delivery limits.
+    """
+
+    delivery_rate: float = 20
+    delivery_burst: int = 20
+    # Rate and burst of keyed delivery buckets by bucket name.
+    delivery_limits: dict[str, tuple[float, int]] = {}
+    # Whether the platform deduplicates sent messages, so that sends may be retried when unknown whether they arrived.
+    idempotent_sends: bool = False
+    # Whether the agent implements _start_stream and _update_stream, so that partial responses are shown.
+    supports_streaming: bool = False
 
     def __init__(self):
         super(ChannelAgent, self).__init__()
 
+        # Minimum seconds between two in-place edits of a streaming message.
+        self.stream_interval = settings.get('channel.stream_interval', 1.0)
+        # Maximum number of connections, 0 means unlimited.
+        self.http_limit = settings.get('channel.http.limit', 100)
+        self.http_limit_per_host = settings.get(
+            'channel.http.limit_per_host', 0
+        )
+        # Seconds an idle connection is kept alive.
+        self.http_keepalive_timeout = settings.get(
+            'channel.http.keepalive_timeout', 60
+        )
+        # Seconds a DNS lookup is cached, None means forever.
+        self.http_dns_cache_ttl = settings.get(
+            'channel.http.dns_cache_ttl', 300
+        )
+        # Seconds of a whole request, and of establishing a connection.
+        self.http_timeout = settings.get('channel.http.timeout', 300)
+        self.http_connect_timeout = settings.get(
+            'channel.http.connect_timeout', 10
+        )
+        self.session: typing.Optional[aiohttp.ClientSession] = None
+        # Seconds before expiry at which access token is refreshed in the background.
+        self.token_refresh_margin = settings.get(
+            'channel.token_refresh_margin', 600
+        )
+        self.tokens: typing.Optional[AccessTokenManager] = None
+        self.delivery_config = settings.get('channel.delivery', {})
+        self.delivery: typing.Optional[DeliveryQueue] = None
+
+        self.http_requests = 0
+        self.http_connections_created = 0
+        self.http_connections_reused = 0
+        self.http_dns_cache_hits = 0
+        self.http_dns_cache_misses = 0
+
+    def _create_session(self) -> aiohttp.ClientSession:
+        """Creates pooled HTTP session, with tracing of requests, connections and DNS lookups."""
+
+        def _count(name: str) -> typing.Callable:
+            async def _on_event(*_) -> None:
+                setattr(self, name, getattr(self, name) + 1)
+
+            return _on_event
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(_count('http_requests'))
+        trace_config.on_connection_create_end.append(
+            _count('http_connections_created')
+        )
+        trace_config.on_connection_reuseconn.append(
+            _count('http_connections_reused')
+        )
+        trace_config.on_dns_cache_hit.append(_count('http_dns_cache_hits'))
+        trace_config.on_dns_cache_miss.append(_count('http_dns_cache_misses'))
+
+        return aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=self.http_limit,
+                limit_per_host=self.http_limit_per_host,
+                keepalive_timeout=self.http_keepalive_timeout,
+                ttl_dns_cache=self.http_dns_cache_ttl,
+            ),
+            timeout=aiohttp.ClientTimeout(
+                total=self.http_timeout, connect=self.http_connect_timeout
+            ),
+            trace_configs=[trace_config],
+        )
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Gets pooled HTTP session of agent.
+
+        The session is created in _initialize, agents used without initializing create it on first use.
+
+        :return: HTTP session.
+        :rtype: aiohttp.ClientSession
+        """
+        if self.session is None or self.session.closed:
+            self.session = self._create_session()
+        return self.session
+
+    def _create_token_manager(
+        self,
+        *,
+        key: str,
+        fetch: typing.Callable[[], typing.Awaitable[tuple[str, float]]],
+    ) -> AccessTokenManager:
+        """Creates access token manager, sharing tokens through the configured token store if any.
+
+        :param key: Key identifying the app of the token, shared by processes serving the same app.
+        :type key: str
+        :param fetch: Function that requests a new token, returns the token and its lifetime in seconds.
+        :type fetch: typing.Callable[[], typing.Awaitable[tuple[str, float]]]
+        :return: Token manager.
+        :rtype: AccessTokenManager
+        """
+        store_config = settings.get('channel.token_store', None)
+        store: typing.Optional[TokenStore] = None
+        if store_config:
+            store = TokenStore.get_store(
+                store_config.get('backend', 'sqlite'),
+                **{k: v for k, v in store_config.items() if k != 'backend'},
+            )
+        return AccessTokenManager(
+            fetch=fetch,
+            refresh_margin=self.token_refresh_margin,
+            store=store,
+            key=key,
+        )
+
+    async def _get_access_token(self) -> str:
+        """Gets API access token, cached and refreshed by the token manager.
+
+        :return: Access token.
+        :rtype: str
+        """
+        return await self.tokens.get()
+
+    def _clean_access_token(self, token: typing.Optional[str] = None) -> None:
+        """Cleans up access token to force refreshing token.
+
+        :param token: Token reported as invalid, None to clean up any cached token.
+        :type token: typing.Optional[str]
+        """
+        self.tokens.invalidate(token)
+
+    async def _with_access_token(
+        self, call: typing.Callable[[str], typing.Awaitable[T]]
+    ) -> T:
+        """Calls API with access token, retries once with a new token if API reports the token as invalid.
+
+        :param call: Function that calls API with the given access token.
+        :type call: typing.Callable[[str], typing.Awaitable[T]]
+        :return: Result of call.
+        :rtype: T
+        """
+        access_token = await self._get_access_token()
+        try:
+            return await call(access_token)
+        except InvalidAccessTokenError:
+            self._clean_access_token(access_token)
+            return await call(await self._get_access_token())
+
+    def _get_delivery(self) -> DeliveryQueue:
+        """Gets outbound delivery queue of agent, created on first use.
+
+        :return: Delivery queue.
+        :rtype: DeliveryQueue
+        """
+        if self.delivery is None:
+            config = self.delivery_config
+            self.delivery = DeliveryQueue(
+                rate=config.get('rate', self.delivery_rate),
+                burst=config.get('burst', self.delivery_burst),
+                concurrency=config.get('concurrency', 8),
+                max_queue=config.get('max_queue', 1000),
+                max_retries=config.get('max_retries', 3),
+                backoff_base=config.get('backoff_base', 0.5),
+                backoff_max=config.get('backoff_max', 10),
+                breaker_threshold=config.get('breaker_threshold', 5),
+                breaker_reset_timeout=config.get('breaker_reset_timeout', 30),
+                limits=self.delivery_limits,
+            )
+        return self.delivery
+
+    async def _deliver(
+        self,
+        call: typing.Callable[[], typing.Awaitable[T]],
+        *,
+        idempotent: bool = False,
+        bucket: typing.Optional[tuple[str, typing.Hashable]] = None,
+    ) -> T:
+        """Makes API call through the outbound delivery queue.
+
+        :param call: Function that calls channel API.
+        :type call: typing.Callable[[], typing.Awaitable[T]]
+        :param idempotent: Whether repeating the call has no further effect.
+        :type idempotent: bool
+        :param bucket: Name and key of the rate limit bucket of call, None means the bucket shared by all calls.
+        :type bucket: typing.Optional[tuple[str, typing.Hashable]]
+        :return: Result of call.
+        :rtype: T
+        """
+        return await self._get_delivery().submit(
+            call, idempotent=idempotent, bucket=bucket
+        )
+
+    def _delivery_bucket(
+        self, message: ResponseMessage, *, update: bool = False
+    ) -> typing.Optional[tuple[str, typing.Hashable]]:
+        """Gets rate limit bucket of the call that sends message, or updates it in place.
+
+        :param message: Response message.
+        :type message: ResponseMessage
+        :param update: Whether the call updates a sent message of a streaming response.
+        :type update: bool
+        :return: Name and key of bucket, None means the bucket shared by all calls.
+        :rtype: typing.Optional[tuple[str, typing.Hashable]]
+        """
+        return None
+
+    async def _initialize(self) -> None:
+        self.session = self._create_session()
+
+    async def _finalize(self) -> None:
+        if self.tokens is not None:
+            await self.tokens.close()
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def stats(self) -> dict[str, typing.Any]:
+        """Gets HTTP connection pool, access token and delivery statistics.
+
+        :return: Statistics of requests, created and reused connections, DNS cache, token refreshes, and outbound
+            delivery queue.
+        :rtype: dict
+        """
+        stats = {
+            'http': {
+                'requests': self.http_requests,
+                'connections_created': self.http_connections_created,
+                'connections_reused': self.http_connections_reused,
+                'dns_cache_hits': self.http_dns_cache_hits,
+                'dns_cache_misses': self.http_dns_cache_misses,
+                'limit': self.http_limit,
+                'limit_per_host': self.http_limit_per_host,
+            }
+        }
+        if self.tokens is not None:
+            stats['tokens'] = self.tokens.stats()
+        if self.delivery is not None:
+            stats['delivery'] = self.delivery.stats()
+        return stats
+
+    @abc.abstractmethod
+    async def send_message(self, message: ResponseMessage) -> None:
+        """Sends response message.
+
+        :param message: Response message.
+        :type message: ResponseMessage
+        """
+        raise NotImplementedError
+
+    async def _start_stream(self, message: TextResponseMessage) -> typing.Any:
+        """Sends the first partial response of a streaming response.
+
+        Channels that support editing sent messages should override this method and _update_stream, and set
+        supports_streaming.
+
+        :param message: Partial response message.
+        :type message: TextResponseMessage
+        :return: Handle used to update the sent message.
+        :rtype: typing.Any
+        """
+        raise NotImplementedError
+
+    async def _update_stream(
+        self, handle: typing.Any, message: TextResponseMessage
+    ) -> None:
+        """Updates the sent message of a streaming response in place.
+
+        :param handle: Handle returned by _start_stream.
+        :type handle: typing.Any
+        :param message: Partial or final response message.
+        :type message: TextResponseMessage
+        """
+        raise NotImplementedError
+
+    async def send_stream(
+        self, messages: typing.AsyncIterator[ResponseMessage]
+    ) -> None:
+        """Sends a streaming response.
+
+        Partial responses are shown by editing the sent message in place, at most once per stream interval. If the
+        channel does not support editing messages, only the final response is sent. Notices are sent on their own as
+        soon as they arrive. Each API call goes through the outbound delivery queue, and calls of one stream are made in
+        order.
+
+        :param messages: Async iterator of response messages, the last one is the final response.
+        :type messages: typing.AsyncIterator[ResponseMessage]
+        """
+        handle = None
+        streamable = self.supports_streaming
+        last_update = 0.0
+        previous: typing.Optional[ResponseMessage] = None
+        async for message in messages:
+            if isinstance(message, NoticeResponseMessage):
+                await self._deliver(
+                    lambda: self.send_message(message),
+                    idempotent=self.idempotent_sends,
+                    bucket=self._delivery_bucket(message),
+                )
+                continue
+            # The previous response is known to be partial once a newer one arrives.
+            if streamable and isinstance(previous, TextResponseMessage):
+                now = time.monotonic()
+                if handle is None:
+                    try:
+                        handle = await self._deliver(
+                            lambda: self._start_stream(previous),
+                            idempotent=self.idempotent_sends,
+                            bucket=self._delivery_bucket(previous),
+                        )
+                        last_update = now
+                    except NotImplementedError:
+                        streamable = False
+                elif now - last_update >= self.stream_interval:
+                    await self._deliver(
+                        lambda: self._update_stream(handle, previous),
+                        idempotent=True,
+                        bucket=self._delivery_bucket(previous, update=True),
+                    )
+                    last_update = now
+            previous = message
+
+        if previous is None:
+            return
+        if handle is not None and isinstance(previous, TextResponseMessage):
+            await self._deliver(
+                lambda: self._update_stream(handle, previous),
+                idempotent=True,
+                bucket=self._delivery_bucket(previous, update=True),
+            )
+        else:
+            await self._deliver(
+                lambda: self.send_message(previous),
+                idempotent=self.idempotent_sends,
+                bucket=self._delivery_bucket(previous),
+            )
+
     @staticmethod
     def get_agent(
         name: str, full_class_path: typing.Optional[str] = None
@@ -60,6 +429,68 @@ class ChannelWebhookFactory(abc.ABC):
         """
         raise NotImplementedError
 
+    @staticmethod
+    async def _chat(
+        *,
+        agent: ChannelAgent,
+        bot: ChatBot,
+        conversation_id: str,
+        address: dict[str, typing.Any],
+        create_message: typing.Callable[
+            [], typing.Awaitable[typing.Optional[RequestMessage]]
+        ],
+    ) -> None:
+        """Creates request message, chats with bot, and sends the responses back through agent.
+
+        Runs as a background task of the webhook, so errors meant for users, like a file exceeding the download size
+        limit, are sent back to the sender as a fallback response. The content of a file request, which may be spooled
+        into a temporary file, is closed once the chat is done.
+
+        :param agent: Channel agent.
+        :type agent: ChannelAgent
+        :param bot: Chat bot.
+        :type bot: ChatBot
+        :param conversation_id: Conversation ID.
+        :type conversation_id: str
+        :param address: uuid, sender_id, scope and echo of the request message.
+        :type address: dict[str, typing.Any]
+        :param create_message: Function that creates request message, e.g. downloading its file, None to ignore it.
+        :type create_message: typing.Callable[[], typing.Awaitable[typing.Optional[RequestMessage]]]
+        """
+        message = None
+        try:
+            message = await create_message()
+            if message is None:
+                return
+            for k, v in address.items():
+                setattr(message, k, v)
+            await agent.send_stream(
+                bot.chat_stream(
+                    conversation_id=conversation_id, message=message
+                )
+            )
+        except AilingBotError as e:
+            logger.error(e)
+            try:
+                await agent.send_message(
+                    FallbackResponseMessage(
+                        uuid=str(uuid.uuid4()),
+                        ack_uuid=address.get('uuid', ''),
+                        receiver_id=address.get('sender_id', ''),
+                        scope=address.get('scope', None),
+                        echo=address.get('echo', {}),
+                        reason=e.reason,
+                        suggestion=e.suggestion,
+                    )
+                )
+            except Exception as send_error:
+                logger.error(send_error)
+        finally:
+            if isinstance(message, FileRequestMessage) and hasattr(
+                message.content, 'close'
+            ):
+                message.content.close()
+
     @staticmethod
     async def get_webhook(
         name: str,
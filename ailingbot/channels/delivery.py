@@ -0,0 +1,358 @@
+from __future__ import annotations
+
+import asyncio
+import collections
+import random
+import time
+import typing
+
+import aiohttp
+from cachetools import LRUCache
+from loguru import logger
+
+from ailingbot.shared.errors import (
+    CircuitOpenError,
+    FullQueueError,
+    InvalidAccessTokenError,
+)
+
+T = typing.TypeVar('T')
+
+
+class TokenBucket:
+    """Token bucket rate limiter, allowing rate calls per second on average and bursts of up to burst calls."""
+
+    def __init__(self, *, rate: float, burst: int):
+        """Init.
+
+        :param rate: Tokens added per second.
+        :type rate: float
+        :param burst: Bucket capacity.
+        :type burst: int
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        # Waiters take tokens in arrival order.
+        self.lock = asyncio.Lock()
+
+    async def acquire(self) -> float:
+        """Takes one token, waits until one is available.
+
+        :return: Seconds waited.
+        :rtype: float
+        """
+        waited = 0.0
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst,
+                    self.tokens + (now - self.updated_at) * self.rate,
+                )
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                delay = (1 - self.tokens) / self.rate
+                waited += delay
+                await asyncio.sleep(delay)
+
+
+class CircuitBreaker:
+    """Opens after threshold consecutive failures, and lets one trial call through after reset timeout."""
+
+    def __init__(self, *, threshold: int = 5, reset_timeout: float = 30):
+        """Init.
+
+        :param threshold: Consecutive failures that open the circuit, 0 disables the breaker.
+        :type threshold: int
+        :param reset_timeout: Seconds the circuit stays open before a trial call.
+        :type reset_timeout: float
+        """
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: typing.Optional[float] = None
+        self.trial = False
+        self.opens = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return 'open'
+        return 'half_open'
+
+    def allow(self) -> bool:
+        """Checks whether a call may be made, and marks it as the trial call if circuit is half open."""
+        state = self.state
+        if state == 'closed':
+            return True
+        if state == 'half_open' and not self.trial:
+            self.trial = True
+            return True
+        return False
+
+    def release_trial(self) -> None:
+        """Lets another call be the trial call, after a trial call ended without an outcome, e.g. cancelled."""
+        self.trial = False
+
+    def record_success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        if self.trial or (
+            self.threshold > 0
+            and self.opened_at is None
+            and self.failures >= self.threshold
+        ):
+            self.opened_at = time.monotonic()
+            self.trial = False
+            self.opens += 1
+
+
+class DeliveryQueue:
+    """Outbound queue of channel API calls.
+
+    Calls wait in arrival order for one of concurrency slots, then take a token from the rate limiter, which is shared
+    by all calls, or keyed by bucket for platforms that limit calls per chat or per API method. Calls failing
+    with 429, 5xx or failures to connect are retried with jittered exponential backoff, honoring Retry-After, and
+    idempotent calls also after invalid access tokens, lost connections and timeouts. A circuit breaker fails calls
+    fast while the platform keeps failing. Calls are dropped when the queue is full, the circuit is open, or retries
+    are exhausted.
+    """
+
+    def __init__(
+        self,
+        *,
+        rate: float,
+        burst: int,
+        concurrency: int = 8,
+        max_queue: int = 1000,
+        max_retries: int = 3,
+        backoff_base: float = 0.5,
+        backoff_max: float = 10,
+        breaker_threshold: int = 5,
+        breaker_reset_timeout: float = 30,
+        limits: typing.Optional[dict[str, tuple[float, int]]] = None,
+        max_buckets: int = 10000,
+    ):
+        """Init.
+
+        :param rate: Calls per second.
+        :type rate: float
+        :param burst: Maximum burst of calls.
+        :type burst: int
+        :param concurrency: Number of calls in flight at most.
+        :type concurrency: int
+        :param max_queue: Number of waiting calls at most, further calls are dropped.
+        :type max_queue: int
+        :param max_retries: Retries of a failed call.
+        :type max_retries: int
+        :param backoff_base: Seconds of the first backoff, doubled on each retry.
+        :type backoff_base: float
+        :param backoff_max: Maximum seconds of backoff.
+        :type backoff_max: float
+        :param breaker_threshold: Consecutive failed calls that open the circuit, 0 disables the breaker.
+        :type breaker_threshold: int
+        :param breaker_reset_timeout: Seconds the circuit stays open.
+        :type breaker_reset_timeout: float
+        :param limits: Rate and burst of keyed buckets by bucket name, buckets not listed use rate and burst.
+        :type limits: typing.Optional[dict[str, tuple[float, int]]]
+        :param max_buckets: Number of keyed buckets kept at most, least recently used ones are dropped.
+        :type max_buckets: int
+        """
+        self.rate = rate
+        self.burst = burst
+        self.bucket = TokenBucket(rate=rate, burst=burst)
+        self.limits = limits or {}
+        self.buckets: LRUCache = LRUCache(maxsize=max_buckets)
+        self.breaker = CircuitBreaker(
+            threshold=breaker_threshold, reset_timeout=breaker_reset_timeout
+        )
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_queue = max_queue
+        self.slots = asyncio.Semaphore(concurrency)
+
+        self.waiting = 0
+        self.in_flight = 0
+        self.sent = 0
+        self.retries = 0
+        self.drops = collections.Counter()
+        self.throttled_seconds = 0.0
+        # Seconds from submit to completion of recent successful calls.
+        self.latencies: collections.deque = collections.deque(maxlen=1024)
+
+    async def submit(
+        self,
+        call: typing.Callable[[], typing.Awaitable[T]],
+        *,
+        idempotent: bool = False,
+        bucket: typing.Optional[tuple[str, typing.Hashable]] = None,
+    ) -> T:
+        """Queues call, and waits for its result.
+
+        :param call: Function that calls channel API.
+        :type call: typing.Callable[[], typing.Awaitable[T]]
+        :param idempotent: Whether repeating the call has no further effect, like edits and sends deduplicated by the
+            platform. Only idempotent calls are retried after errors that leave unknown whether the request arrived.
+        :type idempotent: bool
+        :param bucket: Name and key of the rate limit bucket the call takes a token from, None means the shared one.
+        :type bucket: typing.Optional[tuple[str, typing.Hashable]]
+        :return: Result of call.
+        :rtype: T
+        """
+        if self.waiting >= self.max_queue:
+            self.drops['queue_full'] += 1
+            raise FullQueueError('Outbound queue is full.')
+        submitted_at = time.monotonic()
+        self.waiting += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        try:
+            result = await self._call(
+                call, idempotent, self._get_bucket(bucket)
+            )
+        finally:
+            self.in_flight -= 1
+            self.slots.release()
+        self.sent += 1
+        self.latencies.append(time.monotonic() - submitted_at)
+        return result
+
+    def _get_bucket(
+        self, bucket: typing.Optional[tuple[str, typing.Hashable]]
+    ) -> TokenBucket:
+        """Gets rate limiter of bucket, created on first use."""
+        if bucket is None:
+            return self.bucket
+        if bucket not in self.buckets:
+            rate, burst = self.limits.get(bucket[0], (self.rate, self.burst))
+            self.buckets[bucket] = TokenBucket(rate=rate, burst=burst)
+        return self.buckets[bucket]
+
+    async def _call(
+        self,
+        call: typing.Callable[[], typing.Awaitable[T]],
+        idempotent: bool,
+        bucket: TokenBucket,
+    ) -> T:
+        """Makes call with rate limiting, retries and circuit breaker."""
+        attempt = 0
+        while True:
+            trial = self.breaker.state == 'half_open'
+            if not self.breaker.allow():
+                self.drops['circuit_open'] += 1
+                raise CircuitOpenError(
+                    'Outbound calls are suspended after repeated failures.'
+                )
+            recorded = False
+            try:
+                self.throttled_seconds += await bucket.acquire()
+                try:
+                    result = await call()
+                except NotImplementedError:
+                    # Calls the channel does not support, like editing sent messages, are neither failures nor drops.
+                    raise
+                except Exception as e:
+                    delay = self._retry_delay(e, attempt, idempotent)
+                    recorded = True
+                    if delay is None:
+                        # Errors not caused by the platform do not count against it.
+                        self.breaker.record_success()
+                        self.drops['error'] += 1
+                        raise
+                    self.breaker.record_failure()
+                    if attempt >= self.max_retries:
+                        self.drops['retries_exhausted'] += 1
+                        raise
+                    error = e
+                else:
+                    recorded = True
+                    self.breaker.record_success()
+                    return result
+            finally:
+                # A trial call that told nothing about the platform, e.g. cancelled, must not hold the circuit half
+                # open forever.
+                if trial and not recorded:
+                    self.breaker.release_trial()
+            attempt += 1
+            self.retries += 1
+            logger.warning(
+                f'Channel API call failed, retry {attempt} in {delay:.2f}s: {error!r}'
+            )
+            await asyncio.sleep(delay)
+
+    def _retry_delay(
+        self, error: Exception, attempt: int, idempotent: bool
+    ) -> typing.Optional[float]:
+        """Gets seconds to wait before retrying a failed call, None if error is not retryable.
+
+        429, 5xx and failures to connect are retried for all calls. Invalid access tokens, timeouts and connections
+        lost after the request may have been sent are retried only for idempotent calls, since the platform may have
+        acted on the request already.
+        """
+        retry_after = 0.0
+        if isinstance(error, aiohttp.ClientResponseError):
+            if error.status != 429 and error.status < 500:
+                return None
+            try:
+                retry_after = float(
+                    (error.headers or {}).get('Retry-After', 0)
+                )
+            except ValueError:
+                pass
+        elif isinstance(error, aiohttp.ClientConnectorError):
+            pass
+        elif not idempotent or not isinstance(
+            error,
+            (
+                InvalidAccessTokenError,
+                aiohttp.ClientConnectionError,
+                asyncio.TimeoutError,
+            ),
+        ):
+            return None
+        # Full jitter, so that calls failing together do not retry together.
+        backoff = random.uniform(
+            0, min(self.backoff_max, self.backoff_base * 2**attempt)
+        )
+        return max(backoff, retry_after)
+
+    def stats(self) -> dict[str, typing.Any]:
+        """Gets delivery statistics.
+
+        :return: Statistics of queue depth, calls in flight, sent calls, retries, drops by reason, seconds waited for
+            rate limiter, number of keyed buckets, latency percentiles, and circuit breaker state.
+        :rtype: dict
+        """
+        latencies = sorted(self.latencies)
+        return {
+            'queue_depth': self.waiting,
+            'in_flight': self.in_flight,
+            'sent': self.sent,
+            'retries': self.retries,
+            'drops': dict(self.drops),
+            'throttled_seconds': self.throttled_seconds,
+            'buckets': len(self.buckets),
+            'latency_p50': latencies[len(latencies) // 2]
+            if latencies
+            else None,
+            'latency_p95': latencies[int(len(latencies) * 0.95)]
+            if latencies
+            else None,
+            'circuit': self.breaker.state,
+            'circuit_opens': self.breaker.opens,
+        }
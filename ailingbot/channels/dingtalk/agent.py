@@ -4,18 +4,29 @@ import json
 import typing
 
 import aiohttp
-import arrow
 
 from ailingbot.channels.channel import ChannelAgent
 from ailingbot.channels.dingtalk.render import render
-from ailingbot.chat.messages import ResponseMessage, MessageScope
+from ailingbot.chat.messages import (
+    ResponseMessage,
+    MessageScope,
+    SilenceResponseMessage,
+)
 from ailingbot.config import settings
-from ailingbot.shared.errors import ExternalHTTPAPIError
+from ailingbot.shared.download import download
+from ailingbot.shared.errors import (
+    ExternalHTTPAPIError,
+    InvalidAccessTokenError,
+)
 
 
 class DingtalkAgent(ChannelAgent):
     """Dingtalk channel agent class."""
 
+    # Dingtalk allows 20 calls of one API per second per app.
+    delivery_rate = 20
+    delivery_burst = 20
+
     def __init__(self):
         """Initializes class."""
         super(DingtalkAgent, self).__init__()
@@ -23,46 +34,52 @@ class DingtalkAgent(ChannelAgent):
         self.app_key = settings.channel.app_key
         self.app_secret = settings.channel.app_secret
         self.robot_code = settings.channel.robot_code
-        self.access_token: typing.Optional[str] = None
-        self.expire_in: typing.Optional[arrow.Arrow] = None
-
-    async def _get_access_token(self) -> str:
-        """Gets Dingtalk API access token.
+        self.tokens = self._create_token_manager(
+            key=f'dingtalk:{self.app_key}', fetch=self._fetch_access_token
+        )
 
-        Returns cached token if not expired, otherwise, refreshes token.
+    @staticmethod
+    async def _read_body(response: aiohttp.ClientResponse) -> dict:
+        """Reads JSON body of Dingtalk API response.
 
-        :return: Access token.
-        :rtype: str
+        :return: Response body.
+        :rtype: dict
         """
-        # Returns cached token if not expired.
-        if self.expire_in is not None and arrow.now() < self.expire_in:
-            return self.access_token
-
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                'https://oapi.dingtalk.com/gettoken',
-                params={
-                    'appkey': self.app_key,
-                    'appsecret': self.app_secret,
-                },
-            ) as response:
-                if not response.ok:
-                    response.raise_for_status()
-                body = await response.json()
+        try:
+            body = await response.json(content_type=None)
+        except ValueError:
+            body = None
+        if not isinstance(body, dict):
+            body = {}
+        if (
+            response.status == 401
+            or body.get('code', None) == 'InvalidAuthentication'
+        ):
+            raise InvalidAccessTokenError(body.get('message', ''))
+        if not response.ok:
+            response.raise_for_status()
+        return body
+
+    async def _fetch_access_token(self) -> tuple[str, float]:
+        """Requests a new Dingtalk API access token.
+
+        :return: Access token and its lifetime in seconds.
+        :rtype: tuple[str, float]
+        """
+        async with self._get_session().get(
+            'https://oapi.dingtalk.com/gettoken',
+            params={
+                'appkey': self.app_key,
+                'appsecret': self.app_secret,
+            },
+        ) as response:
+            if not response.ok:
+                response.raise_for_status()
+            body = await response.json()
 
         if body.get('errcode', -1) != 0:
             raise ExternalHTTPAPIError(body.get('errmsg', ''))
-        access_token, expires_in = body.get('access_token', ''), body.get(
-            'expires_in', 0
-        )
-        self.access_token = access_token
-        self.expire_in = arrow.now().shift(seconds=(expires_in - 120))
-        return access_token
-
-    def _clean_access_token(self) -> None:
-        """Cleans up access token to force refreshing token."""
-        self.access_token = None
-        self.expire_in = None
+        return body.get('access_token', ''), body.get('expires_in', 0)
 
     async def _send_to_users(
         self, *, user_ids: list[str], body: dict[str, typing.Any]
@@ -72,10 +89,10 @@ class DingtalkAgent(ChannelAgent):
         :param body: Request body parameters.
         :type body: typing.Dict[str, typing.Any]
         """
-        access_token = await self._get_access_token()
-        async with aiohttp.ClientSession() as session:
-            body['userIds'] = user_ids
-            async with session.post(
+        body['userIds'] = user_ids
+
+        async def _call(access_token: str) -> dict:
+            async with self._get_session().post(
                 'https://api.dingtalk.com/v1.0/robot/oToMessages/batchSend',
                 json=body,
                 headers={
@@ -83,11 +100,11 @@ class DingtalkAgent(ChannelAgent):
                     'Content-Type': 'application/json; charset=utf-8',
                 },
             ) as response:
-                if not response.ok:
-                    response.raise_for_status()
-                body = await response.json()
-        if body.get('processQueryKey', None) is None:
-            raise ExternalHTTPAPIError(body.get('message', ''))
+                return await self._read_body(response)
+
+        response_body = await self._with_access_token(_call)
+        if response_body.get('processQueryKey', None) is None:
+            raise ExternalHTTPAPIError(response_body.get('message', ''))
 
     async def _send_to_group(
         self, *, open_conversation_id: str, body: dict[str, typing.Any]
@@ -97,10 +114,10 @@ class DingtalkAgent(ChannelAgent):
         :param body: Request body parameters.
         :type body: typing.Dict[str, typing.Any]
         """
-        access_token = await self._get_access_token()
-        async with aiohttp.ClientSession() as session:
-            body['openConversationId'] = open_conversation_id
-            async with session.post(
+        body['openConversationId'] = open_conversation_id
+
+        async def _call(access_token: str) -> dict:
+            async with self._get_session().post(
                 'https://api.dingtalk.com/v1.0/robot/groupMessages/send',
                 json=body,
                 headers={
@@ -108,14 +125,17 @@ class DingtalkAgent(ChannelAgent):
                     'Content-Type': 'application/json; charset=utf-8',
                 },
             ) as response:
-                if not response.ok:
-                    response.raise_for_status()
-                body = await response.json()
-        if body.get('processQueryKey', None) is None:
-            raise ExternalHTTPAPIError(body.get('message', ''))
+                return await self._read_body(response)
+
+        response_body = await self._with_access_token(_call)
+        if response_body.get('processQueryKey', None) is None:
+            raise ExternalHTTPAPIError(response_body.get('message', ''))
 
     async def send_message(self, message: ResponseMessage) -> None:
         """Using Dingtalk agent to send message."""
+        if isinstance(message, SilenceResponseMessage):
+            return
+
         try:
             content, message_type = await render(message)
         except NotImplementedError:
@@ -137,11 +157,11 @@ class DingtalkAgent(ChannelAgent):
                 body=body,
             )
 
-    async def download_file(self, *, download_code: str) -> bytes:
-        """Download file."""
-        access_token = await self._get_access_token()
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
+    async def download_file(self, *, download_code: str) -> typing.BinaryIO:
+        """Download file, spooled into a size-capped file."""
+
+        async def _call(access_token: str) -> dict:
+            async with self._get_session().post(
                 'https://api.dingtalk.com/v1.0/robot/messageFiles/download',
                 json={
                     'downloadCode': download_code,
@@ -152,16 +172,14 @@ class DingtalkAgent(ChannelAgent):
                     'Content-Type': 'application/json; charset=utf-8',
                 },
             ) as response:
-                if not response.ok:
-                    response.raise_for_status()
-                body = await response.json()
+                return await self._read_body(response)
+
+        body = await self._with_access_token(_call)
         if body.get('downloadUrl', None) is None:
             raise ExternalHTTPAPIError(body.get('message', ''))
-
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                body.get('downloadUrl', ''),
-            ) as response:
-                if not response.ok:
-                    response.raise_for_status()
-                return await response.content.read()
+        async with self._get_session().get(
+            body.get('downloadUrl', ''),
+        ) as response:
+            if not response.ok:
+                response.raise_for_status()
+            return await download(response)
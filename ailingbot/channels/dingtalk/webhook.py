@@ -14,6 +14,7 @@ from ailingbot.chat.messages import (
     TextRequestMessage,
     MessageScope,
     FileRequestMessage,
+    RequestMessage,
 )
 
 
@@ -52,45 +53,53 @@ class DingtalkWebhookFactory(ChannelWebhookFactory):
         ) -> None:
             """Send a request message to the bot, receive a response message, and send it back to the user."""
 
-            if dingtalk_message.msgtype == 'text':
-                req_msg = TextRequestMessage(
-                    text=dingtalk_message.text.get('content', ''),
-                )
-            elif dingtalk_message.msgtype == 'file':
-                dingtalk = DingtalkAgent()
-                file_name = dingtalk_message.content.get('fileName', '')
-                if len(file_name.split('.')) >= 2:
-                    file_type = file_name.split('.')[-1].strip().lower()
-                else:
-                    file_type = ''
-                file_content = await dingtalk.download_file(
-                    download_code=dingtalk_message.content.get(
-                        'downloadCode', ''
+            async def _create_request_message() -> typing.Optional[
+                RequestMessage
+            ]:
+                if dingtalk_message.msgtype == 'text':
+                    return TextRequestMessage(
+                        text=dingtalk_message.text.get('content', ''),
                     )
-                )
-                req_msg = FileRequestMessage(
-                    file_name=file_name,
-                    file_type=file_type,
-                    content=file_content,
-                )
-            else:
-                return
-
-            req_msg.uuid = dingtalk_message.msgId
-            req_msg.sender_id = dingtalk_message.senderId
+                elif dingtalk_message.msgtype == 'file':
+                    file_name = dingtalk_message.content.get('fileName', '')
+                    if len(file_name.split('.')) >= 2:
+                        file_type = file_name.split('.')[-1].strip().lower()
+                    else:
+                        file_type = ''
+                    file_content = await self.agent.download_file(
+                        download_code=dingtalk_message.content.get(
+                            'downloadCode', ''
+                        )
+                    )
+                    return FileRequestMessage(
+                        file_name=file_name,
+                        file_type=file_type,
+                        content=file_content,
+                    )
+                return None
+
+            address = {
+                'uuid': dingtalk_message.msgId,
+                'sender_id': dingtalk_message.senderId,
+            }
             if dingtalk_message.conversationType == '1':
-                req_msg.scope = MessageScope.USER
-                req_msg.echo['staff_ids'] = [dingtalk_message.senderStaffId]
+                address['scope'] = MessageScope.USER
+                address['echo'] = {
+                    'staff_ids': [dingtalk_message.senderStaffId]
+                }
             elif dingtalk_message.conversationType == '2':
-                req_msg.scope = MessageScope.GROUP
-                req_msg.echo[
-                    'conversation_id'
-                ] = dingtalk_message.conversationId
-
-            response = await self.bot.chat(
-                conversation_id=conversation_id, message=req_msg
+                address['scope'] = MessageScope.GROUP
+                address['echo'] = {
+                    'conversation_id': dingtalk_message.conversationId
+                }
+
+            await self._chat(
+                agent=self.agent,
+                bot=self.bot,
+                conversation_id=conversation_id,
+                address=address,
+                create_message=_create_request_message,
             )
-            await self.agent.send_message(response)
 
         @self.app.on_event('startup')
         async def startup() -> None:
@@ -102,6 +111,17 @@ class DingtalkWebhookFactory(ChannelWebhookFactory):
             await self.agent.finalize()
             await self.bot.finalize()
 
+        @self.app.get(
+            '/webhook/dingtalk/stats/', status_code=status.HTTP_200_OK
+        )
+        async def stats() -> dict:
+            """Gets runtime statistics of the agent and the bot.
+
+            :return: Statistics of HTTP connection pool of the agent, and statistics of the bot.
+            :rtype: dict
+            """
+            return {'agent': self.agent.stats(), 'bot': self.bot.stats()}
+
         @self.app.post(
             '/webhook/dingtalk/event/', status_code=status.HTTP_200_OK
         )
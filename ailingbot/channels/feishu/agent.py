@@ -4,76 +4,99 @@ import json
 import typing
 
 import aiohttp
-import arrow
 
 from ailingbot.channels.channel import ChannelAgent
-from ailingbot.channels.feishu.render import render
-from ailingbot.chat.messages import ResponseMessage, MessageScope
+from ailingbot.channels.feishu.render import render, render_stream_card
+from ailingbot.chat.messages import (
+    ResponseMessage,
+    MessageScope,
+    SilenceResponseMessage,
+    TextResponseMessage,
+)
 from ailingbot.config import settings
-from ailingbot.shared.errors import ExternalHTTPAPIError
+from ailingbot.shared.download import download
+from ailingbot.shared.errors import (
+    ExternalHTTPAPIError,
+    InvalidAccessTokenError,
+)
+
+# Error codes of missing, invalid and expired access tokens.
+_INVALID_ACCESS_TOKEN_CODES = {99991661, 99991663, 99991668}
 
 
 class FeishuAgent(ChannelAgent):
     """Feishu channel agent class."""
 
+    # Feishu allows 50 message API calls per second per app.
+    delivery_rate = 50
+    delivery_burst = 50
+    # Feishu deduplicates messages sent with the same uuid.
+    idempotent_sends = True
+    supports_streaming = True
+
     def __init__(self):
         """Initializes class."""
         super(FeishuAgent, self).__init__()
 
         self.app_id = settings.channel.app_id
         self.app_secret = settings.channel.app_secret
-        self.access_token: typing.Optional[str] = None
-        self.expire_in: typing.Optional[arrow.Arrow] = None
+        self.tokens = self._create_token_manager(
+            key=f'feishu:{self.app_id}', fetch=self._fetch_access_token
+        )
 
-    async def _get_access_token(self) -> str:
-        """Gets Feishu API access token.
+    @staticmethod
+    async def _read_body(response: aiohttp.ClientResponse) -> dict:
+        """Reads JSON body of Feishu API response.
 
-        Returns cached token if not expired, otherwise, refreshes token.
+        Feishu reports invalid access tokens with a 4xx status and an error code in body, so body is read before
+        checking status.
 
-        :return: Access token.
-        :rtype: str
+        :return: Response body.
+        :rtype: dict
         """
-        # Returns cached token if not expired.
-        if self.expire_in is not None and arrow.now() < self.expire_in:
-            return self.access_token
-
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                'https://open.feishu.cn/open-apis/auth/v3/tenant_access_token/internal',
-                json={
-                    'app_id': self.app_id,
-                    'app_secret': self.app_secret,
-                },
-            ) as response:
-                if not response.ok:
-                    response.raise_for_status()
-                body = await response.json()
-
+        try:
+            body = await response.json(content_type=None)
+        except ValueError:
+            body = None
+        if not isinstance(body, dict):
+            body = {}
+        if body.get('code', None) in _INVALID_ACCESS_TOKEN_CODES:
+            raise InvalidAccessTokenError(body.get('msg', ''))
+        if not response.ok:
+            response.raise_for_status()
         if body.get('code', -1) != 0:
             raise ExternalHTTPAPIError(body.get('msg', ''))
-        access_token, expires_in = body.get(
-            'tenant_access_token', ''
-        ), body.get('expire', 0)
-        self.access_token = access_token
-        self.expire_in = arrow.now().shift(seconds=(expires_in - 120))
-        return access_token
-
-    def _clean_access_token(self) -> None:
-        """Cleans up access token to force refreshing token."""
-        self.access_token = None
-        self.expire_in = None
+        return body
+
+    async def _fetch_access_token(self) -> tuple[str, float]:
+        """Requests a new Feishu API access token.
+
+        :return: Access token and its lifetime in seconds.
+        :rtype: tuple[str, float]
+        """
+        async with self._get_session().post(
+            'https://open.feishu.cn/open-apis/auth/v3/tenant_access_token/internal',
+            json={
+                'app_id': self.app_id,
+                'app_secret': self.app_secret,
+            },
+        ) as response:
+            body = await self._read_body(response)
+        return body.get('tenant_access_token', ''), body.get('expire', 0)
 
     async def _send(
         self, *, receive_id_type: str, body: dict[str, typing.Any]
-    ) -> None:
+    ) -> str:
         """Sends message using Feishu API.
 
         :param body: Request body parameters.
         :type body: typing.Dict[str, typing.Any]
+        :return: ID of the sent message.
+        :rtype: str
         """
-        access_token = await self._get_access_token()
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
+
+        async def _call(access_token: str) -> dict:
+            async with self._get_session().post(
                 'https://open.feishu.cn/open-apis/im/v1/messages',
                 json=body,
                 headers={
@@ -82,23 +105,24 @@ class FeishuAgent(ChannelAgent):
                 },
                 params={'receive_id_type': receive_id_type},
             ) as response:
-                if not response.ok:
-                    response.raise_for_status()
-                body = await response.json()
-        if body.get('code', -1) != 0:
-            raise ExternalHTTPAPIError(body.get('msg', ''))
+                return await self._read_body(response)
+
+        response_body = await self._with_access_token(_call)
+        return response_body.get('data', {}).get('message_id', '')
 
     async def _reply(
         self, *, ack_uuid: str, body: dict[str, typing.Any]
-    ) -> None:
+    ) -> str:
         """Replies message using Feishu API.
 
         :param body: Request body parameters.
         :type body: typing.Dict[str, typing.Any]
+        :return: ID of the sent message.
+        :rtype: str
         """
-        access_token = await self._get_access_token()
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
+
+        async def _call(access_token: str) -> dict:
+            async with self._get_session().post(
                 f'https://open.feishu.cn/open-apis/im/v1/messages/{ack_uuid}/reply',
                 json=body,
                 headers={
@@ -106,20 +130,46 @@ class FeishuAgent(ChannelAgent):
                     'Content-Type': 'application/json; charset=utf-8',
                 },
             ) as response:
-                if not response.ok:
-                    response.raise_for_status()
-                body = await response.json()
-        if body.get('code', -1) != 0:
-            raise ExternalHTTPAPIError(body.get('msg', ''))
+                return await self._read_body(response)
 
-    async def send_message(self, message: ResponseMessage) -> None:
-        """Using Feishu agent to send message."""
-        try:
-            content, message_type = await render(message)
-        except NotImplementedError:
-            content, message_type = await render(
-                message.downgrade_to_text_message()
-            )
+        response_body = await self._with_access_token(_call)
+        return response_body.get('data', {}).get('message_id', '')
+
+    async def _patch(
+        self, *, message_id: str, body: dict[str, typing.Any]
+    ) -> None:
+        """Updates sent message card using Feishu API.
+
+        :param message_id: ID of the message to update.
+        :type message_id: str
+        :param body: Request body parameters.
+        :type body: typing.Dict[str, typing.Any]
+        """
+
+        async def _call(access_token: str) -> None:
+            async with self._get_session().patch(
+                f'https://open.feishu.cn/open-apis/im/v1/messages/{message_id}',
+                json=body,
+                headers={
+                    'Authorization': f'Bearer {access_token}',
+                    'Content-Type': 'application/json; charset=utf-8',
+                },
+            ) as response:
+                await self._read_body(response)
+
+        await self._with_access_token(_call)
+
+    async def _send_rendered(
+        self,
+        message: ResponseMessage,
+        content: dict[str, typing.Any],
+        message_type: str,
+    ) -> str:
+        """Sends or replies rendered content according to the response message.
+
+        :return: ID of the sent message.
+        :rtype: str
+        """
         body = {
             'msg_type': message_type,
             'content': json.dumps(content),
@@ -133,18 +183,48 @@ class FeishuAgent(ChannelAgent):
             receive_id_type = 'open_id'
 
         if message.ack_uuid:
-            await self._reply(ack_uuid=message.ack_uuid, body=body)
+            return await self._reply(ack_uuid=message.ack_uuid, body=body)
         else:
             body['receive_id'] = message.receiver_id
-            await self._send(receive_id_type=receive_id_type, body=body)
+            return await self._send(receive_id_type=receive_id_type, body=body)
+
+    async def send_message(self, message: ResponseMessage) -> None:
+        """Using Feishu agent to send message."""
+        if isinstance(message, SilenceResponseMessage):
+            return
+
+        try:
+            content, message_type = await render(message)
+        except NotImplementedError:
+            content, message_type = await render(
+                message.downgrade_to_text_message()
+            )
+        await self._send_rendered(message, content, message_type)
+
+    async def _start_stream(self, message: TextResponseMessage) -> str:
+        """Sends partial response as an updatable message card."""
+        # Uses a distinct uuid, so that Feishu does not deduplicate a fallback message sent afterwards.
+        return await self._send_rendered(
+            message.copy(update={'uuid': f'{message.uuid}-stream'}),
+            await render_stream_card(message),
+            'interactive',
+        )
+
+    async def _update_stream(
+        self, handle: str, message: TextResponseMessage
+    ) -> None:
+        await self._patch(
+            message_id=handle,
+            body={'content': json.dumps(await render_stream_card(message))},
+        )
 
     async def get_resource_from_message(
         self, message_id: str, file_key: str, resource_type: str
-    ) -> bytes:
-        """Get file or image resource from message."""
-        access_token = await self._get_access_token()
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
+    ) -> typing.BinaryIO:
+        """Get file or image resource from message, spooled into a size-capped file."""
+
+        async def _call(access_token: str) -> typing.BinaryIO:
+            async with self._get_session().get(
                 f'https://open.feishu.cn/open-apis/im/v1/messages/{message_id}/resources/{file_key}',
                 headers={
                     'Authorization': f'Bearer {access_token}',
@@ -152,5 +232,7 @@ class FeishuAgent(ChannelAgent):
                 params={'type': resource_type},
             ) as response:
                 if not response.ok:
-                    response.raise_for_status()
-                return await response.content.read()
+                    await self._read_body(response)
+                return await download(response)
+
+        return await self._with_access_token(_call)
@@ -50,3 +50,22 @@ async def _render(response: FallbackResponseMessage) -> tuple[dict, str]:
     }
     message_type = 'interactive'
     return content, message_type
+
+
+async def render_stream_card(response: TextResponseMessage) -> dict:
+    """Renders text response message as a message card, which can be updated in place while streaming.
+
+    :param response: Partial or final text response message.
+    :type response: TextResponseMessage
+    :return: Message card content.
+    :rtype: dict
+    """
+    return {
+        'config': {'wide_screen_mode': True, 'update_multi': True},
+        'elements': [
+            {
+                'tag': 'markdown',
+                'content': response.text,
+            }
+        ],
+    }
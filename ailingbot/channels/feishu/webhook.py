@@ -16,6 +16,7 @@ from ailingbot.chat.messages import (
     TextRequestMessage,
     MessageScope,
     FileRequestMessage,
+    RequestMessage,
 )
 from ailingbot.config import settings
 
@@ -88,24 +89,31 @@ class FeishuWebhookFactory(ChannelWebhookFactory):
                 return
             self.event_id_cache[event.header.event_id] = True
 
-            if event.event.message.message_type == 'text':
-                req_msg = _create_text_request_message(event)
-            elif event.event.message.message_type == 'file':
-                req_msg = await _create_file_request_message(event)
-            else:
-                return
-
-            req_msg.uuid = event.event.message.message_id
-            req_msg.sender_id = event.event.sender.sender_id.get('open_id', '')
+            async def _create_request_message() -> typing.Optional[
+                RequestMessage
+            ]:
+                if event.event.message.message_type == 'text':
+                    return _create_text_request_message(event)
+                elif event.event.message.message_type == 'file':
+                    return await _create_file_request_message(event)
+                return None
+
+            address = {
+                'uuid': event.event.message.message_id,
+                'sender_id': event.event.sender.sender_id.get('open_id', ''),
+            }
             if event.event.message.chat_type == 'p2p':
-                req_msg.scope = MessageScope.USER
+                address['scope'] = MessageScope.USER
             elif event.event.message.chat_type == 'group':
-                req_msg.scope = MessageScope.GROUP
-
-            response = await self.bot.chat(
-                conversation_id=conversation_id, message=req_msg
+                address['scope'] = MessageScope.GROUP
+
+            await self._chat(
+                agent=self.agent,
+                bot=self.bot,
+                conversation_id=conversation_id,
+                address=address,
+                create_message=_create_request_message,
             )
-            await self.agent.send_message(response)
 
         @self.app.on_event('startup')
         async def startup() -> None:
@@ -117,6 +125,15 @@ class FeishuWebhookFactory(ChannelWebhookFactory):
             await self.agent.finalize()
             await self.bot.finalize()
 
+        @self.app.get('/webhook/feishu/stats/', status_code=status.HTTP_200_OK)
+        async def stats() -> dict:
+            """Gets runtime statistics of the agent and the bot.
+
+            :return: Statistics of HTTP connection pool of the agent, and statistics of the bot.
+            :rtype: dict
+            """
+            return {'agent': self.agent.stats(), 'bot': self.bot.stats()}
+
         def _create_text_request_message(
             event: FeishuEventBody,
         ) -> TextRequestMessage:
@@ -139,8 +156,7 @@ class FeishuWebhookFactory(ChannelWebhookFactory):
             file_key = content.get('file_key', '')
             file_name = content.get('file_name', '')
 
-            feishu = FeishuAgent()
-            content = await feishu.get_resource_from_message(
+            content = await self.agent.get_resource_from_message(
                 event.event.message.message_id, file_key, 'file'
             )
             if len(file_name.split('.')) >= 2:
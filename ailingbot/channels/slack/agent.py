@@ -1,16 +1,29 @@
 from __future__ import annotations
 
-import aiohttp
+import typing
 
 from ailingbot.channels.channel import ChannelAgent
-from ailingbot.chat.messages import ResponseMessage, MessageScope
+from ailingbot.chat.messages import (
+    ResponseMessage,
+    MessageScope,
+    SilenceResponseMessage,
+    TextResponseMessage,
+)
 from ailingbot.config import settings
+from ailingbot.shared.download import download
 from ailingbot.shared.errors import ExternalHTTPAPIError
 
 
 class SlackAgent(ChannelAgent):
     """Slack channel agent class."""
 
+    # Slack allows about one chat.postMessage per second per channel, with short bursts, so messages are rate limited
+    # per channel. chat.update is a Tier 3 method with its own limit of about 50 calls per minute for the workspace.
+    delivery_rate = 1
+    delivery_burst = 10
+    delivery_limits = {'chat.update': (50 / 60, 10)}
+    supports_streaming = True
+
     def __init__(self):
         """Initializes class."""
         super(SlackAgent, self).__init__()
@@ -23,31 +36,58 @@ class SlackAgent(ChannelAgent):
         channel: str,
         thread_ts: str = '',
         text: str,
-    ) -> None:
-        """Sends message using Slack API."""
-        async with aiohttp.ClientSession() as session:
-            body = {
+    ) -> str:
+        """Sends message using Slack API.
+
+        :return: Timestamp ID of the sent message.
+        :rtype: str
+        """
+        body = {
+            'channel': channel,
+            'text': text,
+        }
+        if thread_ts:
+            body['thread_ts'] = thread_ts
+        async with self._get_session().post(
+            'https://slack.com/api/chat.postMessage',
+            json=body,
+            headers={
+                'Authorization': f'Bearer {self.oauth_token}',
+                'Content-Type': 'application/json; charset=utf-8',
+            },
+        ) as response:
+            if not response.ok:
+                response.raise_for_status()
+            body = await response.json()
+        if not body.get('ok', False):
+            raise ExternalHTTPAPIError(body.get('error', ''))
+        return body.get('ts', '')
+
+    async def _update(self, *, channel: str, ts: str, text: str) -> None:
+        """Updates sent message using Slack API."""
+        async with self._get_session().post(
+            'https://slack.com/api/chat.update',
+            json={
                 'channel': channel,
+                'ts': ts,
                 'text': text,
-            }
-            if thread_ts:
-                body['thread_ts'] = thread_ts
-            async with session.post(
-                'https://slack.com/api/chat.postMessage',
-                json=body,
-                headers={
-                    'Authorization': f'Bearer {self.oauth_token}',
-                    'Content-Type': 'application/json; charset=utf-8',
-                },
-            ) as response:
-                if not response.ok:
-                    response.raise_for_status()
-                body = await response.json()
+            },
+            headers={
+                'Authorization': f'Bearer {self.oauth_token}',
+                'Content-Type': 'application/json; charset=utf-8',
+            },
+        ) as response:
+            if not response.ok:
+                response.raise_for_status()
+            body = await response.json()
         if not body.get('ok', False):
             raise ExternalHTTPAPIError(body.get('error', ''))
 
     async def send_message(self, message: ResponseMessage) -> None:
         """Using Slack agent to send message."""
+        if isinstance(message, SilenceResponseMessage):
+            return
+
         text = message.downgrade_to_text_message().text
         channel = message.echo['channel']
         thread_ts = message.ack_uuid
@@ -57,14 +97,34 @@ class SlackAgent(ChannelAgent):
             # await self._send(channel=channel, text=text, thread_ts=thread_ts)
             await self._send(channel=channel, text=text)
 
-    async def download_file(self, url: str) -> bytes:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                url,
-                headers={
-                    'Authorization': f'Bearer {self.oauth_token}',
-                },
-            ) as response:
-                if not response.ok:
-                    response.raise_for_status()
-                return await response.content.read()
+    def _delivery_bucket(
+        self, message: ResponseMessage, *, update: bool = False
+    ) -> typing.Optional[tuple[str, typing.Hashable]]:
+        if update:
+            return 'chat.update', None
+        return 'chat.postMessage', (message.echo or {}).get('channel', None)
+
+    async def _start_stream(
+        self, message: TextResponseMessage
+    ) -> tuple[str, str]:
+        channel = message.echo['channel']
+        ts = await self._send(channel=channel, text=message.text)
+        return channel, ts
+
+    async def _update_stream(
+        self, handle: tuple[str, str], message: TextResponseMessage
+    ) -> None:
+        channel, ts = handle
+        await self._update(channel=channel, ts=ts, text=message.text)
+
+    async def download_file(self, url: str) -> typing.BinaryIO:
+        """Download file, spooled into a size-capped file."""
+        async with self._get_session().get(
+            url,
+            headers={
+                'Authorization': f'Bearer {self.oauth_token}',
+            },
+        ) as response:
+            if not response.ok:
+                response.raise_for_status()
+            return await download(response)
@@ -14,6 +14,7 @@ from ailingbot.chat.messages import (
     TextRequestMessage,
     MessageScope,
     FileRequestMessage,
+    RequestMessage,
 )
 from ailingbot.config import settings
 
@@ -40,36 +41,40 @@ class SlackWebhookFactory(ChannelWebhookFactory):
             if 'bot_id' in event:
                 return
 
-            if 'files' in event:
-                file_name = event['files'][0]['name']
-                file_type = event['files'][0]['filetype'].lower()
-                url = event['files'][0]['url_private_download']
-                content = await self.agent.download_file(url)
-                req_msg = FileRequestMessage(
-                    file_name=file_name,
-                    file_type=file_type,
-                    content=content,
-                )
-            elif 'text' in event:
-                text = re.sub(r'<@\w+>', '', event['text'])
-                req_msg = TextRequestMessage(
-                    text=text,
-                )
-            else:
-                return
-
-            req_msg.uuid = event['event_ts']
-            req_msg.sender_id = event['user']
-            req_msg.echo['channel'] = event['channel']
-            if event.get('channel_type', '') == 'im':
-                req_msg.scope = MessageScope.USER
-            else:
-                req_msg.scope = MessageScope.GROUP
-
-            response = await self.bot.chat(
-                conversation_id=conversation_id, message=req_msg
+            async def _create_request_message() -> typing.Optional[
+                RequestMessage
+            ]:
+                if 'files' in event:
+                    file_name = event['files'][0]['name']
+                    file_type = event['files'][0]['filetype'].lower()
+                    url = event['files'][0]['url_private_download']
+                    content = await self.agent.download_file(url)
+                    return FileRequestMessage(
+                        file_name=file_name,
+                        file_type=file_type,
+                        content=content,
+                    )
+                elif 'text' in event:
+                    text = re.sub(r'<@\w+>', '', event['text'])
+                    return TextRequestMessage(
+                        text=text,
+                    )
+                return None
+
+            await self._chat(
+                agent=self.agent,
+                bot=self.bot,
+                conversation_id=conversation_id,
+                address={
+                    'uuid': event['event_ts'],
+                    'sender_id': event['user'],
+                    'echo': {'channel': event['channel']},
+                    'scope': MessageScope.USER
+                    if event.get('channel_type', '') == 'im'
+                    else MessageScope.GROUP,
+                },
+                create_message=_create_request_message,
             )
-            await self.agent.send_message(response)
 
         @self.app.on_event('startup')
         async def startup() -> None:
@@ -81,6 +86,15 @@ class SlackWebhookFactory(ChannelWebhookFactory):
             await self.agent.finalize()
             await self.bot.finalize()
 
+        @self.app.get('/webhook/slack/stats/', status_code=status.HTTP_200_OK)
+        async def stats() -> dict:
+            """Gets runtime statistics of the agent and the bot.
+
+            :return: Statistics of HTTP connection pool of the agent, and statistics of the bot.
+            :rtype: dict
+            """
+            return {'agent': self.agent.stats(), 'bot': self.bot.stats()}
+
         @self.app.post('/webhook/slack/event/', status_code=status.HTTP_200_OK)
         async def handle_event(
             request: Request,
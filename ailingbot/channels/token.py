@@ -0,0 +1,419 @@
+from __future__ import annotations
+
+import abc
+import asyncio
+import sqlite3
+import threading
+import time
+import typing
+import uuid
+
+from loguru import logger
+
+from ailingbot.chat.cache import SingleFlight
+from ailingbot.shared.misc import get_class_dynamically
+
+
+class TokenStore(abc.ABC):
+    """Base class of access token stores, which share tokens between processes and across restarts.
+
+    A process that needs a new token first takes the refresh lease of its key, so that only one process requests the
+    token from the platform while the others wait for it to be saved.
+    """
+
+    @abc.abstractmethod
+    async def lease(
+        self,
+        key: str,
+        *,
+        owner: str,
+        min_expires_at: float,
+        reject: typing.Optional[str] = None,
+    ) -> tuple[typing.Optional[tuple[str, float]], bool]:
+        """Gets the stored token, or takes the refresh lease if no stored token is fresh enough.
+
+        :param key: Token key.
+        :type key: str
+        :param owner: Lease owner.
+        :type owner: str
+        :param min_expires_at: Stored tokens expiring before this wall clock time are not returned.
+        :type min_expires_at: float
+        :param reject: Token reported as invalid, dropped from the store.
+        :type reject: typing.Optional[str]
+        :return: Stored token and its expiry time, or None. And whether the lease is taken by owner, if no token is
+            returned and the lease is held by another owner, caller should wait and try again.
+        :rtype: tuple[typing.Optional[tuple[str, float]], bool]
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def save(
+        self, key: str, *, owner: str, token: str, expires_at: float
+    ) -> None:
+        """Saves a new token, and releases the refresh lease.
+
+        :param key: Token key.
+        :type key: str
+        :param owner: Lease owner.
+        :type owner: str
+        :param token: Access token.
+        :type token: str
+        :param expires_at: Wall clock time when the token expires.
+        :type expires_at: float
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def release(self, key: str, *, owner: str) -> None:
+        """Releases the refresh lease after a failed refresh.
+
+        :param key: Token key.
+        :type key: str
+        :param owner: Lease owner.
+        :type owner: str
+        """
+        raise NotImplementedError
+
+    async def close(self) -> None:
+        """Closes the store."""
+        pass
+
+    @staticmethod
+    def get_store(name: str, **kwargs) -> TokenStore:
+        """Gets access token store instance.
+
+        :param name: Built-in store name or full path of store class.
+        :type name: str
+        :return: Store instance.
+        :rtype: TokenStore
+        """
+        if name.lower() == 'sqlite':
+            instance = SQLiteTokenStore(
+                path=kwargs.get('path', 'ailingbot_tokens.sqlite3'),
+                lease_ttl=kwargs.get('lease_ttl', 30),
+            )
+        else:
+            instance = get_class_dynamically(name)(**kwargs)
+
+        return instance
+
+
+class SQLiteTokenStore(TokenStore):
+    """Access token store in a SQLite file, shared by processes on the same host.
+
+    Leases are taken in IMMEDIATE transactions, which hold the database write lock, so that two processes can not
+    both take one. A lease expires after lease ttl seconds, so that a process that died while refreshing does not
+    block the others.
+    """
+
+    def __init__(
+        self, *, path: str = 'ailingbot_tokens.sqlite3', lease_ttl: float = 30
+    ):
+        self.lease_ttl = lease_ttl
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(
+            path, check_same_thread=False, timeout=lease_ttl
+        )
+        # Transactions are managed explicitly.
+        self.connection.isolation_level = None
+        with self.lock:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS access_tokens '
+                '(key TEXT PRIMARY KEY, token TEXT, expires_at REAL, lease_owner TEXT, lease_until REAL)'
+            )
+
+    def _lease_sync(
+        self,
+        key: str,
+        owner: str,
+        min_expires_at: float,
+        reject: typing.Optional[str],
+    ) -> tuple[typing.Optional[tuple[str, float]], bool]:
+        now = time.time()
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.connection.execute(
+                    'SELECT token, expires_at, lease_owner, lease_until FROM access_tokens WHERE key = ?',
+                    (key,),
+                ).fetchone()
+                token, expires_at, lease_owner, lease_until = row or (
+                    None,
+                    0.0,
+                    None,
+                    0.0,
+                )
+                if token is not None and token != reject:
+                    if expires_at >= min_expires_at:
+                        return (token, expires_at), False
+                if lease_owner not in (None, owner) and lease_until > now:
+                    return None, False
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO access_tokens VALUES (?, ?, ?, ?, ?)',
+                    (
+                        key,
+                        None if token == reject else token,
+                        expires_at,
+                        owner,
+                        now + self.lease_ttl,
+                    ),
+                )
+                return None, True
+            finally:
+                self.connection.execute('COMMIT')
+
+    def _save_sync(
+        self, key: str, owner: str, token: str, expires_at: float
+    ) -> None:
+        with self.lock:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO access_tokens VALUES (?, ?, ?, NULL, 0)',
+                (key, token, expires_at),
+            )
+
+    def _release_sync(self, key: str, owner: str) -> None:
+        with self.lock:
+            self.connection.execute(
+                'UPDATE access_tokens SET lease_owner = NULL, lease_until = 0 '
+                'WHERE key = ? AND lease_owner = ?',
+                (key, owner),
+            )
+
+    async def lease(
+        self,
+        key: str,
+        *,
+        owner: str,
+        min_expires_at: float,
+        reject: typing.Optional[str] = None,
+    ) -> tuple[typing.Optional[tuple[str, float]], bool]:
+        return await asyncio.to_thread(
+            self._lease_sync, key, owner, min_expires_at, reject
+        )
+
+    async def save(
+        self, key: str, *, owner: str, token: str, expires_at: float
+    ) -> None:
+        await asyncio.to_thread(self._save_sync, key, owner, token, expires_at)
+
+    async def release(self, key: str, *, owner: str) -> None:
+        await asyncio.to_thread(self._release_sync, key, owner)
+
+    async def close(self) -> None:
+        with self.lock:
+            self.connection.close()
+
+
+class AccessTokenManager:
+    """Caches the access token of a channel API, and refreshes it before it expires.
+
+    Refreshes are single-flight: concurrent callers that find the token missing or expired share one token request.
+    After each refresh, the next one is scheduled in the background refresh margin seconds before expiry, so that
+    requests do not wait for it while traffic keeps flowing. With a token store, refreshes first look for a token
+    saved by another process, and only the process holding the refresh lease requests a new one.
+    """
+
+    def __init__(
+        self,
+        *,
+        fetch: typing.Callable[[], typing.Awaitable[tuple[str, float]]],
+        expiry_margin: float = 120,
+        refresh_margin: float = 600,
+        retry_interval: float = 30,
+        store: typing.Optional[TokenStore] = None,
+        key: str = 'default',
+        lease_poll_interval: float = 0.2,
+    ):
+        """Init.
+
+        :param fetch: Function that requests a new token, returns the token and its lifetime in seconds.
+        :type fetch: typing.Callable[[], typing.Awaitable[tuple[str, float]]]
+        :param expiry_margin: Seconds before expiry after which the token is no longer used.
+        :type expiry_margin: float
+        :param refresh_margin: Seconds before expiry at which the token is refreshed in the background.
+        :type refresh_margin: float
+        :param retry_interval: Seconds to wait before retrying a failed background refresh, and minimum seconds between
+            background refreshes.
+        :type retry_interval: float
+        :param store: Store sharing the token with other processes, None to keep it in this process only.
+        :type store: typing.Optional[TokenStore]
+        :param key: Key of the token in store, which identifies the app.
+        :type key: str
+        :param lease_poll_interval: Seconds between checks of the store while another process refreshes the token.
+        :type lease_poll_interval: float
+        """
+        self.fetch = fetch
+        self.expiry_margin = expiry_margin
+        self.refresh_margin = refresh_margin
+        self.retry_interval = retry_interval
+        self.store = store
+        self.key = key
+        self.lease_poll_interval = lease_poll_interval
+        self.owner = uuid.uuid4().hex
+
+        self.token: typing.Optional[str] = None
+        # Wall clock time when the token expires.
+        self.expires_at = 0.0
+        # Token reported as invalid, dropped from store on next refresh.
+        self.rejected: typing.Optional[str] = None
+        self.flights = SingleFlight()
+        self.refresh_handle: typing.Optional[asyncio.TimerHandle] = None
+        self.refresh_task: typing.Optional[asyncio.Task] = None
+
+        self.refreshes = 0
+        self.background_refreshes = 0
+        self.refresh_failures = 0
+        self.invalidations = 0
+        self.store_hits = 0
+        self.lease_waits = 0
+
+    def _valid(self) -> bool:
+        return (
+            self.token is not None
+            and time.time() < self.expires_at - self.expiry_margin
+        )
+
+    async def _refresh(self) -> str:
+        """Requests a new token, and schedules the next background refresh."""
+        if self.store is None:
+            token, expires_in = await self.fetch()
+            expires_at = time.time() + expires_in
+            self.refreshes += 1
+        else:
+            token, expires_at = await self._refresh_shared()
+        self.token = token
+        self.expires_at = expires_at
+        self.rejected = None
+
+        # Tokens living shorter than the refresh margin are refreshed halfway, and background refreshes are at least
+        # retry interval apart, so that refreshes do not loop. A token that is unusable on arrival, e.g. with a zero
+        # or negative lifetime, is not refreshed in background, requests refresh it when needed.
+        remaining = expires_at - time.time()
+        if remaining <= self.expiry_margin:
+            if self.refresh_handle is not None:
+                self.refresh_handle.cancel()
+                self.refresh_handle = None
+            logger.warning(
+                f'Access token expires in {remaining:.0f} seconds, within expiry margin.'
+            )
+        else:
+            self._schedule(
+                max(
+                    remaining - self.refresh_margin
+                    if remaining > self.refresh_margin
+                    else remaining / 2,
+                    self.retry_interval,
+                )
+            )
+        return token
+
+    async def _refresh_shared(self) -> tuple[str, float]:
+        """Gets a token newer than the current one from store, or requests one while holding the refresh lease."""
+        min_expires_at = max(
+            time.time() + self.expiry_margin,
+            self.expires_at + 1 if self.token is not None else 0.0,
+        )
+        while True:
+            stored, leased = await self.store.lease(
+                self.key,
+                owner=self.owner,
+                min_expires_at=min_expires_at,
+                reject=self.rejected,
+            )
+            if stored is not None:
+                self.store_hits += 1
+                return stored
+            if leased:
+                break
+            self.lease_waits += 1
+            await asyncio.sleep(self.lease_poll_interval)
+
+        try:
+            token, expires_in = await self.fetch()
+        except BaseException:
+            await self.store.release(self.key, owner=self.owner)
+            raise
+        expires_at = time.time() + expires_in
+        self.refreshes += 1
+        await self.store.save(
+            self.key, owner=self.owner, token=token, expires_at=expires_at
+        )
+        return token, expires_at
+
+    def _schedule(self, delay: float) -> None:
+        """Schedules background refresh after delay seconds."""
+        if self.refresh_handle is not None:
+            self.refresh_handle.cancel()
+        self.refresh_handle = asyncio.get_running_loop().call_later(
+            max(delay, 0), self._refresh_in_background
+        )
+
+    def _refresh_in_background(self) -> None:
+        self.refresh_handle = None
+        self.refresh_task = asyncio.create_task(self._background_refresh())
+
+    async def _background_refresh(self) -> None:
+        try:
+            await self.flights.do('token', self._refresh)
+            self.background_refreshes += 1
+        except Exception as e:
+            # The current token may still be valid, a request that finds it expired refreshes it in the foreground.
+            self.refresh_failures += 1
+            logger.warning(f'Failed to refresh access token: {e}')
+            if self._valid():
+                self._schedule(self.retry_interval)
+
+    async def get(self) -> str:
+        """Gets a valid token, requests a new one if missing or expired.
+
+        :return: Access token.
+        :rtype: str
+        """
+        if self._valid():
+            return self.token
+        token, _ = await self.flights.do('token', self._refresh)
+        return token
+
+    def invalidate(self, token: typing.Optional[str] = None) -> None:
+        """Drops the cached token, so that the next call requests a new one.
+
+        :param token: Token reported as invalid, the cached token is kept if it was already replaced by another one.
+        :type token: typing.Optional[str]
+        """
+        if token is not None and token != self.token:
+            return
+        self.rejected = self.token
+        self.token = None
+        self.expires_at = 0.0
+        self.invalidations += 1
+
+    async def close(self) -> None:
+        """Cancels background refresh."""
+        if self.refresh_handle is not None:
+            self.refresh_handle.cancel()
+            self.refresh_handle = None
+        if self.refresh_task is not None and not self.refresh_task.done():
+            self.refresh_task.cancel()
+            await asyncio.gather(self.refresh_task, return_exceptions=True)
+        if self.store is not None:
+            await self.store.close()
+
+    def stats(self) -> dict[str, typing.Any]:
+        """Gets token statistics.
+
+        :return: Statistics of refreshes, failed background refreshes, invalidations, tokens taken from store, waits for
+            other processes, and remaining lifetime.
+        :rtype: dict
+        """
+        return {
+            'refreshes': self.refreshes,
+            'background_refreshes': self.background_refreshes,
+            'refresh_failures': self.refresh_failures,
+            'invalidations': self.invalidations,
+            'shared_requests': self.flights.shared,
+            'store_hits': self.store_hits,
+            'lease_waits': self.lease_waits,
+            'expires_in': max(self.expires_at - time.time(), 0.0)
+            if self.token is not None
+            else None,
+        }
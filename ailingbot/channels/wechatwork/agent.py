@@ -3,18 +3,31 @@ from __future__ import annotations
 import typing
 
 import aiohttp
-import arrow
 
 from ailingbot.channels.channel import ChannelAgent
 from ailingbot.channels.wechatwork.render import render
-from ailingbot.chat.messages import ResponseMessage, MessageScope
+from ailingbot.chat.messages import (
+    ResponseMessage,
+    MessageScope,
+    SilenceResponseMessage,
+)
 from ailingbot.config import settings
-from ailingbot.shared.errors import ExternalHTTPAPIError
+from ailingbot.shared.errors import (
+    ExternalHTTPAPIError,
+    InvalidAccessTokenError,
+)
+
+# Error codes of invalid and expired access tokens.
+_INVALID_ACCESS_TOKEN_CODES = {40001, 40014, 42001}
 
 
 class WechatworkAgent(ChannelAgent):
     """Wechatwork channel agent class."""
 
+    # Wechatwork allows 10000 calls of one API per minute per corp.
+    delivery_rate = 150
+    delivery_burst = 150
+
     def __init__(self):
         """Initializes class."""
         super(WechatworkAgent, self).__init__()
@@ -22,46 +35,42 @@ class WechatworkAgent(ChannelAgent):
         self.corpid = settings.channel.corpid
         self.corpsecret = settings.channel.corpsecret
         self.agentid = settings.channel.agentid
-        self.access_token: typing.Optional[str] = None
-        self.expire_in: typing.Optional[arrow.Arrow] = None
-
-    async def _get_access_token(self) -> str:
-        """Gets Wechatwork API access token.
+        self.tokens = self._create_token_manager(
+            key=f'wechatwork:{self.corpid}:{self.agentid}',
+            fetch=self._fetch_access_token,
+        )
 
-        Returns cached token if not expired, otherwise, refreshes token.
+    @staticmethod
+    async def _read_body(response: aiohttp.ClientResponse) -> dict:
+        """Reads JSON body of Wechatwork API response.
 
-        :return: Access token.
-        :rtype: str
+        :return: Response body.
+        :rtype: dict
         """
-        # Returns cached token if not expired.
-        if self.expire_in is not None and arrow.now() < self.expire_in:
-            return self.access_token
-
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                'https://qyapi.weixin.qq.com/cgi-bin/gettoken',
-                params={
-                    'corpid': self.corpid,
-                    'corpsecret': self.corpsecret,
-                },
-            ) as response:
-                if not response.ok:
-                    response.raise_for_status()
-                body = await response.json()
-
+        if not response.ok:
+            response.raise_for_status()
+        body = await response.json(content_type=None)
+        if body.get('errcode', -1) in _INVALID_ACCESS_TOKEN_CODES:
+            raise InvalidAccessTokenError(body.get('errmsg', ''))
         if body.get('errcode', -1) != 0:
             raise ExternalHTTPAPIError(body.get('errmsg', ''))
-        access_token, expires_in = body.get('access_token', ''), body.get(
-            'expires_in', 0
-        )
-        self.access_token = access_token
-        self.expire_in = arrow.now().shift(seconds=(expires_in - 120))
-        return access_token
+        return body
 
-    def _clean_access_token(self) -> None:
-        """Cleans up access token to force refreshing token."""
-        self.access_token = None
-        self.expire_in = None
+    async def _fetch_access_token(self) -> tuple[str, float]:
+        """Requests a new Wechatwork API access token.
+
+        :return: Access token and its lifetime in seconds.
+        :rtype: tuple[str, float]
+        """
+        async with self._get_session().get(
+            'https://qyapi.weixin.qq.com/cgi-bin/gettoken',
+            params={
+                'corpid': self.corpid,
+                'corpsecret': self.corpsecret,
+            },
+        ) as response:
+            body = await self._read_body(response)
+        return body.get('access_token', ''), body.get('expires_in', 0)
 
     async def _send(self, *, body: dict[str, typing.Any]) -> None:
         """Sends message using Wechatwork API.
@@ -73,21 +82,22 @@ class WechatworkAgent(ChannelAgent):
             'agentid': self.agentid,
             **body,
         }
-        access_token = await self._get_access_token()
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
+
+        async def _call(access_token: str) -> None:
+            async with self._get_session().post(
                 'https://qyapi.weixin.qq.com/cgi-bin/message/send',
                 params={'access_token': access_token},
                 json=req_body,
             ) as response:
-                if not response.ok:
-                    response.raise_for_status()
-                body = await response.json()
-        if body.get('errcode', -1) != 0:
-            raise ExternalHTTPAPIError(body.get('errmsg', ''))
+                await self._read_body(response)
+
+        await self._with_access_token(_call)
 
     async def send_message(self, message: ResponseMessage) -> None:
         """Using Wechatwork agent to send message."""
+        if isinstance(message, SilenceResponseMessage):
+            return
+
         try:
             content, message_type = await render(message)
         except NotImplementedError:
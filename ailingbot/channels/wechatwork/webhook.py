@@ -43,10 +43,19 @@ class WechatworkWebhookFactory(ChannelWebhookFactory):
             conversation_id: str, message: RequestMessage
         ) -> None:
             """Send a request message to the bot, receive a response message, and send it back to the user."""
-            response = await self.bot.chat(
-                conversation_id=conversation_id, message=message
+
+            async def _create_request_message() -> RequestMessage:
+                return message
+
+            await self._chat(
+                agent=self.agent,
+                bot=self.bot,
+                conversation_id=conversation_id,
+                address=message.dict(
+                    include={'uuid', 'sender_id', 'scope', 'echo'}
+                ),
+                create_message=_create_request_message,
             )
-            await self.agent.send_message(response)
 
         @self.app.on_event('startup')
         async def startup() -> None:
@@ -58,6 +67,17 @@ class WechatworkWebhookFactory(ChannelWebhookFactory):
             await self.agent.finalize()
             await self.bot.finalize()
 
+        @self.app.get(
+            '/webhook/wechatwork/stats/', status_code=status.HTTP_200_OK
+        )
+        async def stats() -> dict:
+            """Gets runtime statistics of the agent and the bot.
+
+            :return: Statistics of HTTP connection pool of the agent, and statistics of the bot.
+            :rtype: dict
+            """
+            return {'agent': self.agent.stats(), 'bot': self.bot.stats()}
+
         @self.app.get(
             '/webhook/wechatwork/event/',
             status_code=status.HTTP_200_OK,
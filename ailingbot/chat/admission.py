@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+import asyncio
+import contextlib
+import heapq
+import itertools
+import time
+import typing
+
+from ailingbot.shared.errors import FullQueueError, QueueTimeoutError
+
+
+class AdmissionController:
+    """Limits how many requests are processed at once across conversations.
+
+    Requests over the limit wait in a bounded queue. Each request belongs to a lane, and waiting requests of a lane
+    with smaller priority number are admitted first; requests of the same priority are admitted in arrival order.
+    """
+
+    def __init__(
+        self,
+        *,
+        max_concurrency: int,
+        max_queue_size: int = 100,
+        queue_timeout: typing.Optional[float] = 30,
+        lanes: typing.Optional[dict[str, int]] = None,
+    ):
+        """Init.
+
+        :param max_concurrency: Maximum number of requests processed at once.
+        :type max_concurrency: int
+        :param max_queue_size: Maximum number of waiting requests, further requests are rejected.
+        :type max_queue_size: int
+        :param queue_timeout: Maximum seconds a request may wait in queue, None means waiting forever.
+        :type queue_timeout: typing.Optional[float]
+        :param lanes: Lane names and their priorities, smaller number means higher priority.
+        :type lanes: typing.Optional[dict[str, int]]
+        """
+        self.max_concurrency = max_concurrency
+        self.max_queue_size = max_queue_size
+        self.queue_timeout = queue_timeout
+        self.lanes = dict(lanes or {})
+        # Unknown lanes are served after all configured lanes.
+        self.default_priority = max(self.lanes.values(), default=0) + 1
+
+        self.running = 0
+        self.waiters: list[tuple[int, int, asyncio.Future]] = []
+        self.sequence = itertools.count()
+        self.queue_depth: dict[str, int] = {}
+
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    @contextlib.asynccontextmanager
+    async def admit(self, lane: str) -> typing.AsyncIterator[None]:
+        """Holds a processing slot during the context.
+
+        :param lane: Lane name of the request.
+        :type lane: str
+        :raises FullQueueError: If the wait queue is full.
+        :raises QueueTimeoutError: If the request waits longer than queue timeout.
+        """
+        await self._acquire(lane)
+        try:
+            yield
+        finally:
+            self._release()
+
+    async def _acquire(self, lane: str) -> None:
+        """Waits for a processing slot."""
+        if self.running < self.max_concurrency and not sum(
+            self.queue_depth.values()
+        ):
+            self.running += 1
+            self.admitted += 1
+            return
+
+        if sum(self.queue_depth.values()) >= self.max_queue_size:
+            self.rejected += 1
+            raise FullQueueError('当前请求过多，请求已被拒绝', suggestion='请稍后重试')
+
+        future = asyncio.get_running_loop().create_future()
+        priority = self.lanes.get(lane, self.default_priority)
+        heapq.heappush(self.waiters, (priority, next(self.sequence), future))
+        self.queue_depth[lane] = self.queue_depth.get(lane, 0) + 1
+        start = time.perf_counter()
+        try:
+            # The slot is handed over by _release, so running is not increased here.
+            await asyncio.wait_for(future, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.timed_out += 1
+            raise QueueTimeoutError('当前请求过多，排队等待超时', suggestion='请稍后重试')
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release()
+            raise
+        finally:
+            self.queue_depth[lane] -= 1
+            wait_time = time.perf_counter() - start
+            self.total_wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+
+        self.admitted += 1
+
+    def _release(self) -> None:
+        """Hands the slot over to the first live waiter, or frees it."""
+        while self.waiters:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.running -= 1
+
+    def stats(self) -> dict[str, typing.Any]:
+        """Gets admission statistics.
+
+        :return: Statistics of running requests, queue depth, wait time and rejections.
+        :rtype: dict
+        """
+        return {
+            'running': self.running,
+            'queue_depth': sum(self.queue_depth.values()),
+            'queue_depth_by_lane': {
+                k: v for k, v in self.queue_depth.items() if v
+            },
+            'admitted': self.admitted,
+            'rejected': self.rejected,
+            'timed_out': self.timed_out,
+            'total_wait_time': self.total_wait_time,
+            'max_wait_time': self.max_wait_time,
+        }
@@ -0,0 +1,238 @@
+from __future__ import annotations
+
+import abc
+import asyncio
+import sqlite3
+import threading
+import time
+import typing
+
+from cachetools import TTLCache
+
+from ailingbot.shared.misc import get_class_dynamically
+
+
+class ResponseCache(abc.ABC):
+    """Base class of response caches."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+    @abc.abstractmethod
+    async def _get(self, key: str) -> typing.Optional[str]:
+        """Gets cached value.
+
+        :param key: Cache key.
+        :type key: str
+        :return: Cached value, None if not exists or expired.
+        :rtype: typing.Optional[str]
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def set(self, key: str, value: str) -> None:
+        """Caches value.
+
+        :param key: Cache key.
+        :type key: str
+        :param value: Value to cache.
+        :type value: str
+        """
+        raise NotImplementedError
+
+    async def get(self, key: str) -> typing.Optional[str]:
+        """Gets cached value, and records hit or miss.
+
+        :param key: Cache key.
+        :type key: str
+        :return: Cached value, None if not exists or expired.
+        :rtype: typing.Optional[str]
+        """
+        value = await self._get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def stats(self) -> dict[str, typing.Any]:
+        """Gets cache statistics.
+
+        :return: Statistics of hits and misses.
+        :rtype: dict
+        """
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+        }
+
+    @staticmethod
+    def get_cache(name: str, **kwargs) -> ResponseCache:
+        """Gets response cache instance.
+
+        :param name: Built-in cache backend name or full path of cache class.
+        :type name: str
+        :return: Cache instance.
+        :rtype: ResponseCache
+        """
+        if name.lower() == 'memory':
+            instance = MemoryResponseCache(
+                maxsize=kwargs.get('maxsize', 1024),
+                ttl=kwargs.get('ttl', 3600),
+            )
+        elif name.lower() == 'sqlite':
+            instance = SQLiteResponseCache(
+                path=kwargs.get('path', 'ailingbot_cache.sqlite3'),
+                maxsize=kwargs.get('maxsize', 1024),
+                ttl=kwargs.get('ttl', 3600),
+            )
+        else:
+            instance = get_class_dynamically(name)(**kwargs)
+
+        return instance
+
+
+class MemoryResponseCache(ResponseCache):
+    """In-memory response cache with TTL and LRU eviction."""
+
+    def __init__(self, *, maxsize: int = 1024, ttl: float = 3600):
+        super(MemoryResponseCache, self).__init__()
+
+        self.cache: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def _get(self, key: str) -> typing.Optional[str]:
+        return self.cache.get(key, None)
+
+    async def set(self, key: str, value: str) -> None:
+        self.cache[key] = value
+
+
+class SQLiteResponseCache(ResponseCache):
+    """Response cache stored in a SQLite file, with TTL and LRU eviction.
+
+    The cache survives restarts and can be shared by processes on the same host.
+    """
+
+    def __init__(
+        self,
+        *,
+        path: str = 'ailingbot_cache.sqlite3',
+        maxsize: int = 1024,
+        ttl: float = 3600,
+    ):
+        super(SQLiteResponseCache, self).__init__()
+
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS response_cache '
+                '(key TEXT PRIMARY KEY, value TEXT, created_at REAL, accessed_at REAL)'
+            )
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS response_cache_accessed_at '
+                'ON response_cache (accessed_at)'
+            )
+
+    def _get_sync(self, key: str) -> typing.Optional[str]:
+        now = time.time()
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                'SELECT value FROM response_cache WHERE key = ? AND created_at > ?',
+                (key, now - self.ttl),
+            ).fetchone()
+            if row is None:
+                return None
+            self.connection.execute(
+                'UPDATE response_cache SET accessed_at = ? WHERE key = ?',
+                (now, key),
+            )
+            return row[0]
+
+    def _set_sync(self, key: str, value: str) -> None:
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?)',
+                (key, value, now, now),
+            )
+            self.connection.execute(
+                'DELETE FROM response_cache WHERE created_at <= ?',
+                (now - self.ttl,),
+            )
+            self.connection.execute(
+                'DELETE FROM response_cache WHERE key IN '
+                '(SELECT key FROM response_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+                (self.maxsize,),
+            )
+
+    async def _get(self, key: str) -> typing.Optional[str]:
+        return await asyncio.to_thread(self._get_sync, key)
+
+    async def set(self, key: str, value: str) -> None:
+        await asyncio.to_thread(self._set_sync, key, value)
+
+
+def _cancelling() -> bool:
+    """Checks whether cancellation of the current task was requested."""
+    task = asyncio.current_task()
+    # Task.cancelling is available from Python 3.11.
+    return task is not None and getattr(task, 'cancelling', lambda: 0)() > 0
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time, concurrent callers of the same key share its result."""
+
+    def __init__(self):
+        self.calls: dict[str, asyncio.Future] = {}
+        self.shared = 0
+
+    async def do(
+        self, key: str, fn: typing.Callable[[], typing.Awaitable[typing.Any]]
+    ) -> tuple[typing.Any, bool]:
+        """Calls fn, or waits for the in-flight call of the same key.
+
+        If the caller running the in-flight call is cancelled, waiting callers do not fail, one of them calls its own
+        fn instead.
+
+        :param key: Call key.
+        :type key: str
+        :param fn: Function that returns an awaitable.
+        :type fn: typing.Callable[[], typing.Awaitable[typing.Any]]
+        :return: Result and whether the result is shared from another caller.
+        :rtype: tuple[typing.Any, bool]
+        """
+        while key in self.calls:
+            future = self.calls[key]
+            try:
+                result = await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # Only the in-flight call was cancelled, not this caller.
+                if future.cancelled() and not _cancelling():
+                    continue
+                raise
+            self.shared += 1
+            return result, True
+
+        future = asyncio.get_running_loop().create_future()
+        self.calls[key] = future
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Retrieves the exception, so that it is not reported when no other caller waits for it.
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            del self.calls[key]
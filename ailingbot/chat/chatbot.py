@@ -1,19 +1,26 @@
 from __future__ import annotations
 
 import asyncio
+import contextlib
 import typing
 import uuid
 
 from loguru import logger
 
+from ailingbot.chat.admission import AdmissionController
+from ailingbot.chat.lock import ConversationLockManager
 from ailingbot.chat.messages import (
     RequestMessage,
     FallbackResponseMessage,
+    NoticeResponseMessage,
     ResponseMessage,
+    SilenceResponseMessage,
+    TextRequestMessage,
 )
 from ailingbot.chat.policy import ChatPolicy
 from ailingbot.config import settings
 from ailingbot.shared.abc import AbstractAsyncComponent
+from ailingbot.shared.errors import AilingBotError
 
 
 class ChatBot(AbstractAsyncComponent):
@@ -28,11 +35,39 @@ class ChatBot(AbstractAsyncComponent):
 
         self.debug = debug
 
-        self.locks: dict[str, asyncio.Lock] = {}
+        self.locks = ConversationLockManager.get_lock_manager(
+            settings.get('chatbot.lock_manager', 'refcount'),
+            stripes=settings.get('chatbot.lock_stripes', 1024),
+        )
+        # Coalescing window in milliseconds, None disables coalescing.
+        self.coalesce_window: typing.Optional[int] = settings.get(
+            'chatbot.coalesce_window', None
+        )
+        self.batches: dict[
+            str, list[tuple[TextRequestMessage, asyncio.Future]]
+        ] = {}
+        self.coalesced_messages = 0
+        max_concurrency = settings.get('chatbot.max_concurrency', None)
+        self.admission: typing.Optional[AdmissionController] = (
+            AdmissionController(
+                max_concurrency=max_concurrency,
+                max_queue_size=settings.get('chatbot.max_queue_size', 100),
+                queue_timeout=settings.get('chatbot.queue_timeout', 30),
+                lanes=settings.get(
+                    'chatbot.lanes', {'user': 0, 'api': 1, 'group': 2}
+                ),
+            )
+            if max_concurrency
+            else None
+        )
         self.policy: typing.Optional[ChatPolicy] = None
 
     async def chat(
-        self, *, conversation_id: str, message: RequestMessage
+        self,
+        *,
+        conversation_id: str,
+        message: RequestMessage,
+        lane: typing.Optional[str] = None,
     ) -> ResponseMessage:
         """Run chat pipeline, and replies messages to sender.
 
@@ -40,28 +75,216 @@ class ChatBot(AbstractAsyncComponent):
         :type conversation_id: str
         :param message: Reqeust message.
         :type message: RequestMessage
+        :param lane: Admission lane, defaults to the message scope.
+        :type lane: typing.Optional[str]
+        """
+        if lane is None:
+            lane = message.scope.value if message.scope else 'default'
+
+        if self.coalesce_window is None or not isinstance(
+            message, TextRequestMessage
+        ):
+            async with self.locks.hold(conversation_id):
+                return await self._respond(
+                    conversation_id=conversation_id, message=message, lane=lane
+                )
+
+        future = asyncio.get_running_loop().create_future()
+        if conversation_id in self.batches:
+            # Another request of this conversation is waiting to be answered, joins its batch.
+            self.batches[conversation_id].append((message, future))
+            return await future
+
+        batch = [(message, future)]
+        self.batches[conversation_id] = batch
+        try:
+            async with self.locks.hold(conversation_id):
+                if self.coalesce_window > 0:
+                    await asyncio.sleep(self.coalesce_window / 1000)
+                del self.batches[conversation_id]
+                await self._respond_batch(
+                    conversation_id=conversation_id, batch=batch, lane=lane
+                )
+        except asyncio.CancelledError:
+            # Messages joined to the batch are not answered, waiters whose response is already set keep it.
+            self.batches.pop(conversation_id, None)
+            for _, f in batch:
+                f.cancel()
+            raise
+        except Exception as e:
+            self.batches.pop(conversation_id, None)
+            for _, f in batch:
+                if f is not future and not f.done():
+                    f.set_exception(e)
+            raise
+
+        return future.result()
+
+    async def chat_stream(
+        self,
+        *,
+        conversation_id: str,
+        message: RequestMessage,
+        lane: typing.Optional[str] = None,
+    ) -> typing.AsyncIterator[ResponseMessage]:
+        """Run chat pipeline, and yields partial responses as they are generated.
+
+        All yielded responses except notices share the same uuid, the last one is the final response. Coalesced messages are not
+        streamed, their response is yielded once.
+
+        :param conversation_id: Conversation id.
+        :type conversation_id: str
+        :param message: Reqeust message.
+        :type message: RequestMessage
+        :param lane: Admission lane, defaults to the message scope.
+        :type lane: typing.Optional[str]
+        :return: Async iterator of response messages.
+        :rtype: typing.AsyncIterator[ResponseMessage]
         """
-        if conversation_id not in self.locks:
-            self.locks[conversation_id] = asyncio.Lock()
-        lock = self.locks[conversation_id]
+        if self.coalesce_window is not None and isinstance(
+            message, TextRequestMessage
+        ):
+            yield await self.chat(
+                conversation_id=conversation_id, message=message, lane=lane
+            )
+            return
+
+        if lane is None:
+            lane = message.scope.value if message.scope else 'default'
 
-        async with lock:
+        response_uuid = str(uuid.uuid4())
+        async with self.locks.hold(conversation_id):
             try:
-                r = await self.policy.respond(
-                    conversation_id=conversation_id, message=message
+                async with self._admit(lane):
+                    async for r in self.policy.respond_stream(
+                        conversation_id=conversation_id, message=message
+                    ):
+                        r = self._fill_response(r, message)
+                        # Notices are separate messages, so they keep their own uuid.
+                        if not isinstance(r, NoticeResponseMessage):
+                            r.uuid = response_uuid
+                        yield r
+            except AilingBotError as e:
+                logger.error(e)
+                r = self._fill_response(
+                    FallbackResponseMessage(
+                        reason=e.reason, suggestion=e.suggestion
+                    ),
+                    message,
                 )
+                r.uuid = response_uuid
+                yield r
             except Exception as e:
                 logger.error(e)
-                r = FallbackResponseMessage(
-                    reason=str(e),
+                r = self._fill_response(
+                    FallbackResponseMessage(reason=str(e)), message
                 )
-            r.uuid = str(uuid.uuid4())
-            r.ack_uuid = message.uuid
-            r.receiver_id = message.sender_id
-            r.scope = message.scope
-            r.echo = message.echo
+                r.uuid = response_uuid
+                yield r
 
-            return r
+    async def _respond_batch(
+        self,
+        *,
+        conversation_id: str,
+        batch: list[tuple[TextRequestMessage, asyncio.Future]],
+        lane: str,
+    ) -> None:
+        """Merges a batch of text messages into one request, and resolves the future of each message.
+
+        The last message receives the response, the others receive silence response.
+
+        :param conversation_id: Conversation id.
+        :type conversation_id: str
+        :param batch: Messages and their futures, in arrival order.
+        :type batch: list[tuple[TextRequestMessage, asyncio.Future]]
+        :param lane: Admission lane.
+        :type lane: str
+        """
+        last = batch[-1][0]
+        if len(batch) == 1:
+            merged = last
+        else:
+            merged = last.copy(
+                update={'text': '\n'.join([m.text for m, _ in batch])}
+            )
+            self.coalesced_messages += len(batch) - 1
+        r = await self._respond(
+            conversation_id=conversation_id, message=merged, lane=lane
+        )
+
+        # Waiters cancelled meanwhile are skipped, the others still get their response.
+        for m, f in batch[:-1]:
+            if not f.done():
+                f.set_result(self._fill_response(SilenceResponseMessage(), m))
+        if not batch[-1][1].done():
+            batch[-1][1].set_result(r)
+
+    async def _respond(
+        self, *, conversation_id: str, message: RequestMessage, lane: str
+    ) -> ResponseMessage:
+        """Calls chat policy to respond a message.
+
+        :param conversation_id: Conversation id.
+        :type conversation_id: str
+        :param message: Reqeust message.
+        :type message: RequestMessage
+        :param lane: Admission lane.
+        :type lane: str
+        """
+        try:
+            async with self._admit(lane):
+                r = await self.policy.respond(
+                    conversation_id=conversation_id, message=message
+                )
+        except AilingBotError as e:
+            logger.error(e)
+            r = FallbackResponseMessage(
+                reason=e.reason,
+                suggestion=e.suggestion,
+            )
+        except Exception as e:
+            logger.error(e)
+            r = FallbackResponseMessage(
+                reason=str(e),
+            )
+        return self._fill_response(r, message)
+
+    @contextlib.asynccontextmanager
+    async def _admit(self, lane: str) -> typing.AsyncIterator[None]:
+        """Holds an admission slot if admission control is enabled."""
+        if self.admission is None:
+            yield
+        else:
+            async with self.admission.admit(lane):
+                yield
+
+    @staticmethod
+    def _fill_response(
+        response: ResponseMessage, message: RequestMessage
+    ) -> ResponseMessage:
+        """Fills response message fields from the request message."""
+        response.uuid = str(uuid.uuid4())
+        response.ack_uuid = message.uuid
+        response.receiver_id = message.sender_id
+        response.scope = message.scope
+        response.echo = message.echo
+        return response
+
+    def stats(self) -> dict[str, typing.Any]:
+        """Gets runtime statistics of the bot.
+
+        :return: Statistics grouped by component.
+        :rtype: dict
+        """
+        return {
+            'locks': self.locks.stats(),
+            'coalescing': {
+                'pending_batches': len(self.batches),
+                'coalesced_messages': self.coalesced_messages,
+            },
+            'admission': self.admission.stats() if self.admission else None,
+            'policy': self.policy.stats() if self.policy else None,
+        }
 
     async def _initialize(self) -> None:
         self.policy = ChatPolicy.get_policy(
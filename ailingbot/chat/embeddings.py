@@ -0,0 +1,337 @@
+from __future__ import annotations
+
+import array
+import asyncio
+import hashlib
+import itertools
+import random
+import sqlite3
+import threading
+import typing
+
+import openai.error
+from langchain.embeddings.base import Embeddings
+
+
+class SQLiteEmbeddingCache:
+    """Embedding cache stored in a SQLite file.
+
+    Vectors are keyed by embedding model and SHA-256 of the text, and stored as float32 blobs.
+    """
+
+    def __init__(self, *, path: str = 'ailingbot_embeddings.sqlite3'):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS embedding_cache '
+                '(model TEXT, text_hash BLOB, vector BLOB, PRIMARY KEY (model, text_hash))'
+            )
+
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    @staticmethod
+    def _hash(text: str) -> bytes:
+        return hashlib.sha256(text.encode('utf-8')).digest()
+
+    def _get_many_sync(
+        self, model: str, texts: list[str]
+    ) -> list[typing.Optional[list[float]]]:
+        hashes = [self._hash(t) for t in texts]
+        vectors: dict[bytes, list[float]] = {}
+        with self.lock:
+            # Stays well below the SQLite limit of host parameters.
+            for i in range(0, len(hashes), 500):
+                batch = hashes[i : i + 500]
+                rows = self.connection.execute(
+                    'SELECT text_hash, vector FROM embedding_cache WHERE model = ? AND text_hash IN '
+                    f'({",".join("?" * len(batch))})',
+                    (model, *batch),
+                ).fetchall()
+                for text_hash, blob in rows:
+                    vectors[text_hash] = array.array('f', blob).tolist()
+        return [vectors.get(h, None) for h in hashes]
+
+    def _set_many_sync(
+        self, model: str, texts: list[str], vectors: list[list[float]]
+    ) -> None:
+        with self.lock, self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO embedding_cache VALUES (?, ?, ?)',
+                [
+                    (model, self._hash(t), array.array('f', v).tobytes())
+                    for t, v in zip(texts, vectors)
+                ],
+            )
+
+    async def get_many(
+        self, model: str, texts: list[str]
+    ) -> list[typing.Optional[list[float]]]:
+        """Gets cached vectors of texts, and records hits and misses.
+
+        :param model: Embedding model name.
+        :type model: str
+        :param texts: Texts.
+        :type texts: list[str]
+        :return: Vector of each text, None if not cached.
+        :rtype: list[typing.Optional[list[float]]]
+        """
+        vectors = await asyncio.to_thread(self._get_many_sync, model, texts)
+        for t, v in zip(texts, vectors):
+            if v is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.bytes_saved += len(t.encode('utf-8'))
+        return vectors
+
+    async def set_many(
+        self, model: str, texts: list[str], vectors: list[list[float]]
+    ) -> None:
+        """Caches vectors of texts.
+
+        :param model: Embedding model name.
+        :type model: str
+        :param texts: Texts.
+        :type texts: list[str]
+        :param vectors: Vector of each text.
+        :type vectors: list[list[float]]
+        """
+        await asyncio.to_thread(self._set_many_sync, model, texts, vectors)
+
+    def stats(self) -> dict[str, typing.Any]:
+        """Gets cache statistics.
+
+        :return: Statistics of hits, misses, and bytes of text not sent to the embedding API.
+        :rtype: dict
+        """
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'bytes_saved': self.bytes_saved,
+        }
+
+    def close(self) -> None:
+        """Closes the database."""
+        with self.lock:
+            self.connection.close()
+
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings that consults an embedding cache before calling the underlying embeddings.
+
+    Only documents are cached, queries are always delegated.
+    """
+
+    def __init__(
+        self,
+        *,
+        embeddings: Embeddings,
+        cache: SQLiteEmbeddingCache,
+        model: str,
+    ):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model = model
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        vectors = self.cache._get_many_sync(self.model, texts)
+        missing = [t for t, v in zip(texts, vectors) if v is None]
+        if missing:
+            computed = self.embeddings.embed_documents(missing)
+            self.cache._set_many_sync(self.model, missing, computed)
+            vectors = self._merge(vectors, computed)
+        return vectors
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embeddings.embed_query(text)
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        vectors = await self.cache.get_many(self.model, texts)
+        missing = [t for t, v in zip(texts, vectors) if v is None]
+        if missing:
+            computed = await self.embeddings.aembed_documents(missing)
+            await self.cache.set_many(self.model, missing, computed)
+            vectors = self._merge(vectors, computed)
+        return vectors
+
+    async def aembed_query(self, text: str) -> list[float]:
+        return await self.embeddings.aembed_query(text)
+
+    @staticmethod
+    def _merge(
+        vectors: list[typing.Optional[list[float]]],
+        computed: list[list[float]],
+    ) -> list[list[float]]:
+        """Fills missing vectors with computed ones, in order."""
+        it = iter(computed)
+        return [v if v is not None else next(it) for v in vectors]
+
+
+class BatchingEmbeddings(Embeddings):
+    """Embeddings that merges concurrent document embedding calls into batched requests.
+
+    Texts of all callers are queued and sent in batches of up to batch size, at most max concurrency requests at a
+    time. A batch is sent once full, or batch delay seconds after its first text was queued, so chunks of concurrent
+    uploads share requests. Requests that are rate limited, time out, fail to connect, or fail with 5xx are retried with
+    jittered exponential backoff.
+    """
+
+    def __init__(
+        self,
+        *,
+        embeddings: Embeddings,
+        batch_size: int = 100,
+        max_concurrency: int = 4,
+        batch_delay: float = 0.05,
+        max_retries: int = 6,
+        backoff_base: float = 1.0,
+        backoff_max: float = 60.0,
+    ):
+        """Init.
+
+        :param embeddings: Underlying embeddings, each call of which is one request.
+        :type embeddings: Embeddings
+        :param batch_size: Maximum number of texts in a request.
+        :type batch_size: int
+        :param max_concurrency: Maximum number of requests in flight.
+        :type max_concurrency: int
+        :param batch_delay: Seconds to wait for more texts before sending a batch that is not full.
+        :type batch_delay: float
+        :param max_retries: Maximum number of retries of a rate limited or transiently failed request.
+        :type max_retries: int
+        :param backoff_base: Backoff seconds of the first retry, doubled on each retry.
+        :type backoff_base: float
+        :param backoff_max: Maximum backoff seconds.
+        :type backoff_max: float
+        """
+        self.embeddings = embeddings
+        self.batch_size = batch_size
+        self.max_concurrency = max_concurrency
+        self.batch_delay = batch_delay
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.pending: list[tuple[str, asyncio.Future]] = []
+        self.flush_handle: typing.Optional[asyncio.TimerHandle] = None
+        self.semaphore: typing.Optional[asyncio.Semaphore] = None
+        self.tasks: set[asyncio.Task] = set()
+
+        self.requests = 0
+        self.texts = 0
+        self.rate_limited = 0
+        self.transient_errors = 0
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embeddings.embed_query(text)
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        loop = asyncio.get_running_loop()
+        futures = []
+        for t in texts:
+            future = loop.create_future()
+            self.pending.append((t, future))
+            futures.append(future)
+            if len(self.pending) >= self.batch_size:
+                self._flush()
+        if self.pending and self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.batch_delay, self._flush)
+        return list(await asyncio.gather(*futures))
+
+    async def aembed_query(self, text: str) -> list[float]:
+        return await self.embeddings.aembed_query(text)
+
+    def _flush(self) -> None:
+        """Sends all queued texts in batches."""
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        # Creates semaphore lazily, so that it is bound to the running event loop.
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        while self.pending:
+            batch = self.pending[: self.batch_size]
+            del self.pending[: self.batch_size]
+            task = asyncio.create_task(self._embed_batch(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def _embed_batch(
+        self, batch: list[tuple[str, asyncio.Future]]
+    ) -> None:
+        """Embeds a batch, and resolves the future of each text."""
+        try:
+            async with self.semaphore:
+                vectors = await self._embed_with_backoff([t for t, _ in batch])
+        except Exception as e:
+            for _, f in batch:
+                if not f.done():
+                    f.set_exception(e)
+            return
+        for (_, f), v in zip(batch, vectors):
+            if not f.done():
+                f.set_result(v)
+
+    @staticmethod
+    def _is_transient(error: openai.error.OpenAIError) -> bool:
+        """Checks if a failed request is worth retrying other than being rate limited."""
+        return isinstance(
+            error,
+            (
+                openai.error.Timeout,
+                openai.error.APIConnectionError,
+                openai.error.ServiceUnavailableError,
+                openai.error.TryAgain,
+            ),
+        ) or (error.http_status is not None and error.http_status >= 500)
+
+    async def _embed_with_backoff(self, texts: list[str]) -> list[list[float]]:
+        """Sends one request, retries it while rate limited or failing transiently."""
+        for attempt in itertools.count():
+            try:
+                self.requests += 1
+                vectors = await self.embeddings.aembed_documents(texts)
+            except openai.error.OpenAIError as e:
+                if attempt >= self.max_retries:
+                    raise
+                retry_after = None
+                if e.http_status == 429:
+                    self.rate_limited += 1
+                    retry_after = (e.headers or {}).get('retry-after', None)
+                elif self._is_transient(e):
+                    self.transient_errors += 1
+                else:
+                    raise
+                if retry_after is not None:
+                    delay = float(retry_after)
+                else:
+                    delay = min(
+                        self.backoff_base * 2**attempt, self.backoff_max
+                    ) * random.uniform(0.5, 1.0)
+                await asyncio.sleep(delay)
+            else:
+                self.texts += len(texts)
+                return vectors
+
+    def stats(self) -> dict[str, typing.Any]:
+        """Gets batching statistics.
+
+        :return: Statistics of requests, embedded texts, rate limited and transiently failed requests.
+        :rtype: dict
+        """
+        return {
+            'requests': self.requests,
+            'texts': self.texts,
+            'rate_limited': self.rate_limited,
+            'transient_errors': self.transient_errors,
+            'in_flight': len(self.tasks),
+            'queued': len(self.pending),
+        }
@@ -0,0 +1,1293 @@
+from __future__ import annotations
+
+import abc
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import io
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import typing
+
+from cachetools import TTLCache
+from langchain.docstore.document import Document
+from langchain.embeddings.base import Embeddings
+from langchain.vectorstores import Chroma
+from langchain.schema import BaseRetriever
+from langchain.vectorstores.base import VectorStore
+
+from ailingbot.chat.cache import SingleFlight
+from ailingbot.chat.lexical import BM25Index
+from ailingbot.chat.splitter import get_text_splitter
+from ailingbot.chat.vectorstore import NumpyVectorStore
+from ailingbot.shared.errors import ConfigValidationError
+from ailingbot.shared.misc import get_class_dynamically
+
+
+def file_source(
+    content: typing.Union[bytes, typing.BinaryIO]
+) -> typing.Union[bytes, str]:
+    """Gets what indexing workers read an uploaded file from.
+
+    Files spooled to disk are read by workers from their path, so that the content is neither copied into memory nor
+    sent to worker processes. In-memory files and bytes are passed as content.
+
+    :param content: File content, or binary file.
+    :type content: typing.Union[bytes, typing.BinaryIO]
+    :return: File content, or path of the file.
+    :rtype: typing.Union[bytes, str]
+    """
+    if isinstance(content, bytes):
+        return content
+    name = getattr(content, 'name', None)
+    if isinstance(name, str) and os.path.isfile(name):
+        content.flush()
+        return name
+    if isinstance(content, io.BytesIO):
+        return content.getvalue()
+    content.seek(0)
+    return content.read()
+
+
+@contextlib.contextmanager
+def _open_file(
+    source: typing.Union[bytes, str]
+) -> typing.Iterator[typing.BinaryIO]:
+    """Opens file content or file path as a binary file."""
+    if isinstance(source, bytes):
+        yield io.BytesIO(source)
+    else:
+        with open(source, 'rb') as f:
+            yield f
+
+
+def count_pdf_pages(content: typing.Union[bytes, str]) -> int:
+    """Gets number of pages of PDF document.
+
+    :param content: PDF file content, or path of the file.
+    :type content: typing.Union[bytes, str]
+    :return: Number of pages.
+    :rtype: int
+    """
+    from pypdf import PdfReader
+
+    with _open_file(content) as f:
+        return len(PdfReader(f).pages)
+
+
+def load_and_split(
+    content: typing.Union[bytes, str],
+    *,
+    chunk_size: int,
+    chunk_overlap: int,
+    start: int = 0,
+    stop: typing.Optional[int] = None,
+    splitter: str = 'character',
+) -> list[Document]:
+    """Extracts a page range of PDF document, and splits the pages into chunks.
+
+    CPU bound, runs in a worker of the indexing executor, so it must stay a module level function to be picklable.
+
+    :param content: PDF file content, or path of the file, which is read without loading it whole into memory.
+    :type content: typing.Union[bytes, str]
+    :param chunk_size: Chunk size of splitter.
+    :type chunk_size: int
+    :param chunk_overlap: Chunk overlap of splitter.
+    :type chunk_overlap: int
+    :param start: First page, counted from 0.
+    :type start: int
+    :param stop: Page after the last page, None means the end of document.
+    :type stop: typing.Optional[int]
+    :param splitter: Text splitter name.
+    :type splitter: str
+    :return: Chunks, with page number in metadata.
+    :rtype: list[Document]
+    """
+    from pypdf import PdfReader
+
+    with _open_file(content) as f:
+        reader = PdfReader(f)
+        documents = [
+            Document(
+                page_content=reader.pages[i].extract_text(),
+                metadata={'page': i},
+            )
+            for i in range(start, len(reader.pages) if stop is None else stop)
+        ]
+
+    text_splitter = get_text_splitter(
+        splitter, chunk_size=chunk_size, chunk_overlap=chunk_overlap
+    )
+    return text_splitter.split_documents(documents)
+
+
+def index_key(
+    content: typing.Union[bytes, str],
+    *,
+    file_type: str,
+    chunk_size: int,
+    chunk_overlap: int,
+    splitter: str = 'character',
+) -> str:
+    """Gets content address of the index of a document.
+
+    Identical documents split with identical settings have identical indexes, whoever uploads them.
+
+    :param content: File content, or path of the file.
+    :type content: typing.Union[bytes, str]
+    :param file_type: File type.
+    :type file_type: str
+    :param chunk_size: Chunk size of splitter.
+    :type chunk_size: int
+    :param chunk_overlap: Chunk overlap of splitter.
+    :type chunk_overlap: int
+    :param splitter: Text splitter name.
+    :type splitter: str
+    :return: Index key.
+    :rtype: str
+    """
+    if isinstance(content, bytes):
+        h = hashlib.sha256(content)
+    else:
+        h = hashlib.sha256()
+        with open(content, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+    h.update(f'\0{file_type.lower()}\0{chunk_size}\0{chunk_overlap}'.encode())
+    # Keeps keys of indexes split by the default splitter unchanged.
+    if splitter != 'character':
+        h.update(f'\0{splitter}'.encode())
+    return h.hexdigest()
+
+
+def get_executor(
+    name: str, *, max_workers: typing.Optional[int] = None
+) -> concurrent.futures.Executor:
+    """Gets executor that runs CPU bound indexing works.
+
+    :param name: `process` or `thread`.
+    :type name: str
+    :param max_workers: Maximum number of workers, defaults to the executor's own default.
+    :type max_workers: typing.Optional[int]
+    :return: Executor.
+    :rtype: concurrent.futures.Executor
+    """
+    if name.lower() == 'process':
+        return concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+    elif name.lower() == 'thread':
+        return concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    else:
+        raise ConfigValidationError(
+            f'Unknown indexing executor: {name}', critical=True
+        )
+
+
+class PrecomputedEmbeddings(Embeddings):
+    """Embeddings that answers documents from vectors computed beforehand.
+
+    Lets vector stores with synchronous builders be built off the event loop, after the embedding requests were
+    made asynchronously. Queries are delegated to the underlying embeddings.
+    """
+
+    def __init__(
+        self,
+        *,
+        embeddings: Embeddings,
+        texts: list[str],
+        vectors: list[list[float]],
+    ):
+        self.embeddings = embeddings
+        self.vectors = dict(zip(texts, vectors))
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        missing = [t for t in texts if t not in self.vectors]
+        if missing:
+            self.vectors.update(
+                zip(missing, self.embeddings.embed_documents(missing))
+            )
+        return [self.vectors[t] for t in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embeddings.embed_query(text)
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        missing = [t for t in texts if t not in self.vectors]
+        if missing:
+            self.vectors.update(
+                zip(missing, await self.embeddings.aembed_documents(missing))
+            )
+        return [self.vectors[t] for t in texts]
+
+    async def aembed_query(self, text: str) -> list[float]:
+        return await self.embeddings.aembed_query(text)
+
+
+# Vector and BM25 results of one index, chunks and scores.
+SearchResults = tuple[
+    list[tuple[Document, float]], list[tuple[Document, float]]
+]
+
+
+class DocumentIndex(typing.NamedTuple):
+    """Indexes of one document, either may be None depending on retrieval mode."""
+
+    key: str
+    vector: typing.Optional[VectorStore]
+    lexical: typing.Optional[BM25Index]
+
+
+class RetrievalCache:
+    """Caches query embeddings and retrieval results of document QA, with TTL and LRU eviction.
+
+    Questions are normalized by collapsing whitespace and case folding. Query vectors are keyed by question, and
+    are shared by all indexes. Retrieval results are keyed by index key, question and k, and are invalidated when
+    the index is rebuilt or dropped.
+    """
+
+    def __init__(self, *, maxsize: int = 1024, ttl: float = 3600):
+        """Init.
+
+        :param maxsize: Maximum number of entries of each cache.
+        :type maxsize: int
+        :param ttl: Seconds an entry stays valid.
+        :type ttl: float
+        """
+        self.vectors: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.results: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+        self.vector_hits = 0
+        self.vector_misses = 0
+        self.result_hits = 0
+        self.result_misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def normalize(question: str) -> str:
+        """Normalizes question, so that near-identical questions share entries."""
+        return ' '.join(question.split()).casefold()
+
+    def get_vector(self, question: str) -> typing.Optional[list[float]]:
+        """Gets cached query vector of question.
+
+        :param question: Question.
+        :type question: str
+        :return: Query vector, None if not cached.
+        :rtype: typing.Optional[list[float]]
+        """
+        vector = self.vectors.get(self.normalize(question), None)
+        if vector is None:
+            self.vector_misses += 1
+        else:
+            self.vector_hits += 1
+        return vector
+
+    def set_vector(self, question: str, vector: list[float]) -> None:
+        """Caches query vector of question.
+
+        :param question: Question.
+        :type question: str
+        :param vector: Query vector.
+        :type vector: list[float]
+        """
+        self.vectors[self.normalize(question)] = vector
+
+    def get_results(
+        self, key: str, question: str, k: int
+    ) -> typing.Optional[typing.Any]:
+        """Gets cached retrieval results of question on an index.
+
+        :param key: Index key.
+        :type key: str
+        :param question: Question.
+        :type question: str
+        :param k: Number of chunks retrieved.
+        :type k: int
+        :return: Retrieval results, None if not cached.
+        :rtype: typing.Optional[typing.Any]
+        """
+        results = self.results.get((key, self.normalize(question), k), None)
+        if results is None:
+            self.result_misses += 1
+        else:
+            self.result_hits += 1
+        return results
+
+    def set_results(
+        self, key: str, question: str, k: int, results: typing.Any
+    ) -> None:
+        """Caches retrieval results of question on an index.
+
+        :param key: Index key.
+        :type key: str
+        :param question: Question.
+        :type question: str
+        :param k: Number of chunks retrieved.
+        :type k: int
+        :param results: Retrieval results.
+        :type results: typing.Any
+        """
+        self.results[(key, self.normalize(question), k)] = results
+
+    def invalidate(self, key: str) -> None:
+        """Removes cached retrieval results of an index.
+
+        :param key: Index key.
+        :type key: str
+        """
+        for cache_key in [x for x in list(self.results.keys()) if x[0] == key]:
+            self.results.pop(cache_key, None)
+            self.invalidations += 1
+
+    def stats(self) -> dict[str, typing.Any]:
+        """Gets cache statistics.
+
+        :return: Statistics of hits and misses of query vectors and retrieval results.
+        :rtype: dict
+        """
+        vectors = self.vector_hits + self.vector_misses
+        results = self.result_hits + self.result_misses
+        return {
+            'vector_hits': self.vector_hits,
+            'vector_misses': self.vector_misses,
+            'vector_hit_rate': self.vector_hits / vectors if vectors else 0.0,
+            'result_hits': self.result_hits,
+            'result_misses': self.result_misses,
+            'result_hit_rate': self.result_hits / results if results else 0.0,
+            'invalidations': self.invalidations,
+        }
+
+
+class SharedIndexRegistry:
+    """Shares document indexes across conversations by content address, and keeps a bounded number of them loaded.
+
+    Each document has its own index, and a conversation uses the indexes of all documents uploaded to it. Indexes
+    are reference counted by the conversations using them, and dropped once no conversation uses them. Concurrent
+    builds of the same index are merged into one.
+
+    At most max indexes, and indexes of at most max bytes in total, are kept loaded, least recently used or idle ones
+    are unloaded. Unloaded indexes are dropped together with their references from conversations, and the names of
+    dropped documents are kept until the conversation is told. Subclasses can persist indexes and reload them on the
+    next question by overriding _unload and _reload, and estimate index sizes by overriding _size.
+    """
+
+    def __init__(
+        self,
+        *,
+        max_indexes: int = 100,
+        max_bytes: typing.Optional[int] = None,
+        idle_ttl: typing.Optional[float] = None,
+    ):
+        """Init.
+
+        :param max_indexes: Maximum number of indexes kept loaded.
+        :type max_indexes: int
+        :param max_bytes: Maximum estimated memory size of loaded indexes in bytes, None means no limit.
+        :type max_bytes: typing.Optional[int]
+        :param idle_ttl: Seconds after which an idle index is unloaded, None means never.
+        :type idle_ttl: typing.Optional[float]
+        """
+        self.max_indexes = max_indexes
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        # Index key -> (index, last access time), in order of access.
+        self.indexes: collections.OrderedDict[
+            str, tuple[DocumentIndex, float]
+        ] = collections.OrderedDict()
+        # Index key -> estimated memory size of loaded index.
+        self.sizes: dict[str, int] = {}
+        self.loaded_bytes = 0
+        self.refcounts: dict[str, int] = {}
+        # Conversation ID -> index key -> document name, in order of upload.
+        self.owners: dict[str, dict[str, str]] = {}
+        # Conversation ID -> names of documents dropped since the conversation was last told.
+        self.dropped: dict[str, list[str]] = {}
+        self.flights = SingleFlight()
+
+        self.builds = 0
+        self.reuses = 0
+        self.evictions = 0
+        self.reloads = 0
+
+    async def _reload(self, key: str) -> typing.Optional[DocumentIndex]:
+        """Reloads an unloaded index.
+
+        :param key: Index key.
+        :type key: str
+        :return: Index, None if it can not be reloaded.
+        :rtype: typing.Optional[DocumentIndex]
+        """
+        return None
+
+    async def _unload(self, key: str, index: DocumentIndex) -> None:
+        """Unloads an evicted index, drops it together with its references since it can not be reloaded.
+
+        :param key: Index key.
+        :type key: str
+        :param index: Index.
+        :type index: DocumentIndex
+        """
+        for conversation_id, documents in list(self.owners.items()):
+            name = documents.pop(key, None)
+            if name is not None:
+                self.dropped.setdefault(conversation_id, []).append(name)
+                await self._save_owner(conversation_id, key, None)
+                if not documents:
+                    del self.owners[conversation_id]
+        del self.refcounts[key]
+        await self._drop(key, index)
+
+    async def _size(self, index: DocumentIndex) -> int:
+        """Estimates memory size of a loaded index.
+
+        :param index: Index.
+        :type index: DocumentIndex
+        :return: Size in bytes.
+        :rtype: int
+        """
+        return 0
+
+    def _put(self, key: str, index: DocumentIndex, size: int) -> None:
+        """Adds a loaded index, or marks it as recently used."""
+        self._pop(key)
+        self.indexes[key] = (index, time.monotonic())
+        self.sizes[key] = size
+        self.loaded_bytes += size
+
+    def _pop(self, key: str) -> typing.Optional[DocumentIndex]:
+        """Removes a loaded index, returns None if not loaded."""
+        index, _ = self.indexes.pop(key, (None, 0.0))
+        self.loaded_bytes -= self.sizes.pop(key, 0)
+        return index
+
+    async def _drop(
+        self, key: str, index: typing.Optional[DocumentIndex]
+    ) -> None:
+        """Deletes an index no conversation uses.
+
+        :param key: Index key.
+        :type key: str
+        :param index: Index, None if not loaded.
+        :type index: typing.Optional[DocumentIndex]
+        """
+        pass
+
+    async def _save_owner(
+        self, conversation_id: str, key: str, name: typing.Optional[str]
+    ) -> None:
+        """Records that conversation uses an index, or no longer uses it.
+
+        :param conversation_id: Conversation ID.
+        :type conversation_id: str
+        :param key: Index key.
+        :type key: str
+        :param name: Document name, None if the conversation no longer uses the index.
+        :type name: typing.Optional[str]
+        """
+        pass
+
+    async def _load(self, key: str) -> typing.Optional[DocumentIndex]:
+        """Gets a loaded index, or reloads it, and marks it as recently used."""
+        if key in self.indexes:
+            index, _ = self.indexes[key]
+            self.indexes[key] = (index, time.monotonic())
+            self.indexes.move_to_end(key)
+        else:
+            index = await self._reload(key)
+            if index is None:
+                return None
+            self.reloads += 1
+            self._put(key, index, await self._size(index))
+        return index
+
+    async def _evict(self, keep: typing.Collection[str] = ()) -> None:
+        """Unloads least recently used indexes over the limits, and idle indexes.
+
+        :param keep: Keys of indexes that must stay loaded.
+        :type keep: typing.Collection[str]
+        """
+        now = time.monotonic()
+        for key, (index, last_access) in list(self.indexes.items()):
+            if (
+                len(self.indexes) <= self.max_indexes
+                and (
+                    self.max_bytes is None
+                    or self.loaded_bytes <= self.max_bytes
+                )
+                and (
+                    self.idle_ttl is None or now - last_access < self.idle_ttl
+                )
+            ):
+                break
+            if key in keep:
+                continue
+            self._pop(key)
+            self.evictions += 1
+            await self._unload(key, index)
+
+    async def acquire(
+        self,
+        conversation_id: str,
+        key: str,
+        build: typing.Callable[[], typing.Awaitable[DocumentIndex]],
+        name: str = '',
+    ) -> DocumentIndex:
+        """Adds document to conversation, builds its index if no conversation uses it yet.
+
+        A document of the conversation with the same name but another content is replaced.
+
+        :param conversation_id: Conversation ID.
+        :type conversation_id: str
+        :param key: Index key.
+        :type key: str
+        :param build: Function that builds the index.
+        :type build: typing.Callable[[], typing.Awaitable[DocumentIndex]]
+        :param name: Document name.
+        :type name: str
+        :return: Index.
+        :rtype: DocumentIndex
+        """
+        index = await self._load(key)
+        if index is not None:
+            self.reuses += 1
+        else:
+            index, shared = await self.flights.do(key, build)
+            if shared:
+                self.reuses += 1
+            else:
+                self.builds += 1
+            size = await self._size(index)
+            # Releasing in the meantime may have dropped the index built by another caller.
+            if key not in self.indexes:
+                self._put(key, index, size)
+            index, _ = self.indexes[key]
+
+        documents = self.owners.setdefault(conversation_id, {})
+        # An uploaded document is no longer missing from the conversation.
+        if name in self.dropped.get(conversation_id, []):
+            self.dropped[conversation_id].remove(name)
+        if key not in documents:
+            self.refcounts[key] = self.refcounts.get(key, 0) + 1
+        replaced = [k for k, n in documents.items() if n == name and k != key]
+        documents[key] = name
+        await self._save_owner(conversation_id, key, name)
+        for k in replaced:
+            await self.release(conversation_id, k)
+        await self._evict(keep=[key])
+        return index
+
+    async def get(
+        self, conversation_id: str
+    ) -> list[tuple[str, DocumentIndex]]:
+        """Gets indexes of all documents of conversation, reloads them if unloaded.
+
+        :param conversation_id: Conversation ID.
+        :type conversation_id: str
+        :return: Document names and indexes, empty if no document was uploaded.
+        :rtype: list[tuple[str, DocumentIndex]]
+        """
+        documents = self.owners.get(conversation_id, {})
+        indexes = []
+        for key, name in list(documents.items()):
+            index = await self._load(key)
+            if index is not None:
+                indexes.append((name, index))
+        await self._evict(keep=list(documents))
+        return indexes
+
+    def pop_dropped(self, conversation_id: str) -> list[str]:
+        """Gets names of documents dropped from conversation since the last call, which can not be answered from.
+
+        :param conversation_id: Conversation ID.
+        :type conversation_id: str
+        :return: Document names, in order of dropping.
+        :rtype: list[str]
+        """
+        return self.dropped.pop(conversation_id, [])
+
+    def documents(self, conversation_id: str) -> list[str]:
+        """Gets names of documents of conversation.
+
+        :param conversation_id: Conversation ID.
+        :type conversation_id: str
+        :return: Document names, in order of upload.
+        :rtype: list[str]
+        """
+        return list(self.owners.get(conversation_id, {}).values())
+
+    async def release(
+        self, conversation_id: str, key: typing.Optional[str] = None
+    ) -> None:
+        """Removes a document from conversation, or all documents if key is None.
+
+        :param conversation_id: Conversation ID.
+        :type conversation_id: str
+        :param key: Index key of the document.
+        :type key: typing.Optional[str]
+        """
+        documents = self.owners.get(conversation_id, {})
+        if key is None:
+            self.dropped.pop(conversation_id, None)
+        for k in list(documents) if key is None else [key]:
+            if documents.pop(k, None) is None:
+                continue
+            await self._save_owner(conversation_id, k, None)
+            self.refcounts[k] -= 1
+            if self.refcounts[k] == 0:
+                del self.refcounts[k]
+                await self._drop(k, self._pop(k))
+        if not documents:
+            self.owners.pop(conversation_id, None)
+
+    async def remove(self, conversation_id: str, name: str) -> bool:
+        """Removes a document from conversation by name.
+
+        :param conversation_id: Conversation ID.
+        :type conversation_id: str
+        :param name: Document name.
+        :type name: str
+        :return: Whether the document existed.
+        :rtype: bool
+        """
+        documents = self.owners.get(conversation_id, {})
+        keys = [k for k, n in documents.items() if n == name]
+        for k in keys:
+            await self.release(conversation_id, k)
+        return bool(keys)
+
+    async def close(self) -> None:
+        """Releases resources of the registry."""
+        pass
+
+    def stats(self) -> dict[str, typing.Any]:
+        """Gets registry statistics.
+
+        :return: Statistics of loaded indexes, builds, reuses, evictions and reloads.
+        :rtype: dict
+        """
+        return {
+            'live_indexes': len(self.indexes),
+            'live_bytes': self.loaded_bytes,
+            'indexes': len(self.refcounts),
+            'conversations': len(self.owners),
+            'builds': self.builds,
+            'reuses': self.reuses,
+            'evictions': self.evictions,
+            'reloads': self.reloads,
+        }
+
+    @staticmethod
+    def get_registry(name: str, **kwargs) -> PersistentIndexRegistry:
+        """Gets index registry instance.
+
+        :param name: Built-in vector store name or full path of registry class.
+        :type name: str
+        :return: Registry instance.
+        :rtype: PersistentIndexRegistry
+        """
+        if name.lower() == 'chroma':
+            instance = ChromaIndexRegistry(
+                embeddings=kwargs['embeddings'],
+                path=kwargs.get('path', None),
+                max_indexes=kwargs.get('max_indexes', 100),
+                max_bytes=kwargs.get('max_bytes', None),
+                idle_ttl=kwargs.get('idle_ttl', None),
+                retrieval=kwargs.get('retrieval', 'vector'),
+                cache=kwargs.get('cache', None),
+            )
+        elif name.lower() == 'numpy':
+            instance = NumpyIndexRegistry(
+                embeddings=kwargs['embeddings'],
+                path=kwargs.get('path', None),
+                max_indexes=kwargs.get('max_indexes', 100),
+                max_bytes=kwargs.get('max_bytes', None),
+                idle_ttl=kwargs.get('idle_ttl', None),
+                retrieval=kwargs.get('retrieval', 'vector'),
+                cache=kwargs.get('cache', None),
+                dtype=kwargs.get('dtype', 'float32'),
+            )
+        else:
+            instance = get_class_dynamically(name)(**kwargs)
+
+        return instance
+
+
+class PersistentIndexRegistry(SharedIndexRegistry, abc.ABC):
+    """Base class of registries that build indexes in a vector store.
+
+    Depending on retrieval mode, a document has a vector index, a BM25 index built from the same chunks, or both.
+    Indexes of the registry are DocumentIndex tuples.
+
+    If path is set, indexes and the documents of each conversation are persisted in the directory, unloaded
+    indexes are reopened on the next question, and survive restarts.
+    """
+
+    def __init__(
+        self,
+        *,
+        embeddings: typing.Optional[Embeddings],
+        path: typing.Optional[str] = None,
+        max_indexes: int = 100,
+        max_bytes: typing.Optional[int] = None,
+        idle_ttl: typing.Optional[float] = None,
+        retrieval: str = 'vector',
+        cache: typing.Optional[RetrievalCache] = None,
+    ):
+        """Init.
+
+        :param embeddings: Embeddings used to embed questions, may be None in `bm25` mode.
+        :type embeddings: typing.Optional[Embeddings]
+        :param path: Directory where indexes are persisted, None means keeping them in memory only.
+        :type path: typing.Optional[str]
+        :param max_indexes: Maximum number of indexes kept loaded.
+        :type max_indexes: int
+        :param max_bytes: Maximum estimated memory size of loaded indexes in bytes, None means no limit.
+        :type max_bytes: typing.Optional[int]
+        :param idle_ttl: Seconds after which an idle index is unloaded, None means never.
+        :type idle_ttl: typing.Optional[float]
+        :param retrieval: Retrieval mode, `vector`, `bm25` which needs no embeddings, or `hybrid`.
+        :type retrieval: str
+        :param cache: Cache of query embeddings and retrieval results, None disables caching.
+        :type cache: typing.Optional[RetrievalCache]
+        """
+        super(PersistentIndexRegistry, self).__init__(
+            max_indexes=max_indexes, max_bytes=max_bytes, idle_ttl=idle_ttl
+        )
+
+        if retrieval not in ('vector', 'bm25', 'hybrid'):
+            raise ConfigValidationError(
+                f'Unknown retrieval mode: {retrieval}', critical=True
+            )
+        self.embeddings = embeddings
+        self.path = path
+        self.retrieval = retrieval
+        self.cache = cache
+        self.connection: typing.Optional[sqlite3.Connection] = None
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+            self.lock = threading.Lock()
+            self.connection = sqlite3.connect(
+                os.path.join(path, 'conversations.sqlite3'),
+                check_same_thread=False,
+            )
+            with self.lock, self.connection:
+                self.connection.execute(
+                    'CREATE TABLE IF NOT EXISTS conversation_documents '
+                    '(conversation_id TEXT, key TEXT, name TEXT, uploaded_at REAL, '
+                    'PRIMARY KEY (conversation_id, key))'
+                )
+                rows = self.connection.execute(
+                    'SELECT conversation_id, key, name FROM conversation_documents '
+                    'ORDER BY uploaded_at'
+                ).fetchall()
+            for conversation_id, key, name in rows:
+                self.owners.setdefault(conversation_id, {})[key] = name
+                self.refcounts[key] = self.refcounts.get(key, 0) + 1
+
+    @abc.abstractmethod
+    def _build_sync(
+        self, key: str, documents: list[Document], vectors: list[list[float]]
+    ) -> VectorStore:
+        """Builds index from embedded chunks, and persists it if path is set."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def _open_sync(self, key: str) -> typing.Optional[VectorStore]:
+        """Opens a persisted index, None if not exists."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def _delete_sync(self, key: str) -> None:
+        """Deletes an index."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def search_sync(
+        self, index: VectorStore, vector: list[float], k: int
+    ) -> list[tuple[Document, float]]:
+        """Searches the chunks of index most similar to vector.
+
+        :param index: Index.
+        :type index: VectorStore
+        :param vector: Query vector.
+        :type vector: list[float]
+        :param k: Number of chunks.
+        :type k: int
+        :return: Chunks and scores, higher score means more similar.
+        :rtype: list[tuple[Document, float]]
+        """
+        raise NotImplementedError
+
+    def _vector_size_sync(self, index: VectorStore) -> int:
+        """Estimates memory size of a vector index in bytes."""
+        return 0
+
+    def _close_sync(self) -> None:
+        """Releases resources of the vector store."""
+        pass
+
+    def _lexical_path(self, key: str) -> str:
+        return os.path.join(self.path, 'bm25', key)
+
+    def _build_index_sync(
+        self,
+        key: str,
+        documents: list[Document],
+        vectors: typing.Optional[list[list[float]]],
+    ) -> DocumentIndex:
+        vector = lexical = None
+        if self.retrieval != 'bm25':
+            vector = self._build_sync(key, documents, vectors)
+        if self.retrieval != 'vector':
+            lexical = BM25Index.from_documents(documents)
+            if self.path is not None:
+                lexical.save(self._lexical_path(key))
+        return DocumentIndex(key, vector, lexical)
+
+    def _open_index_sync(self, key: str) -> typing.Optional[DocumentIndex]:
+        vector = lexical = None
+        if self.retrieval != 'bm25':
+            vector = self._open_sync(key)
+        # Indexes persisted before switching to another mode may lack the BM25 index.
+        if self.retrieval != 'vector' and os.path.isdir(
+            self._lexical_path(key)
+        ):
+            lexical = BM25Index.load(self._lexical_path(key))
+        if vector is None and lexical is None:
+            return None
+        return DocumentIndex(key, vector, lexical)
+
+    def _delete_index_sync(self, key: str) -> None:
+        self._delete_sync(key)
+        if self.path is not None:
+            shutil.rmtree(self._lexical_path(key), ignore_errors=True)
+
+    async def build(
+        self,
+        key: str,
+        documents: list[Document],
+        vectors: typing.Optional[list[list[float]]],
+    ) -> DocumentIndex:
+        """Builds index of key from embedded chunks.
+
+        :param key: Index key.
+        :type key: str
+        :param documents: Chunks.
+        :type documents: list[Document]
+        :param vectors: Vector of each chunk, None in `bm25` mode.
+        :type vectors: typing.Optional[list[list[float]]]
+        :return: Index.
+        :rtype: DocumentIndex
+        """
+        index = await asyncio.to_thread(
+            self._build_index_sync, key, documents, vectors
+        )
+        if self.cache is not None:
+            self.cache.invalidate(key)
+        return index
+
+    async def _reload(self, key: str) -> typing.Optional[DocumentIndex]:
+        if self.path is None:
+            return None
+        return await asyncio.to_thread(self._open_index_sync, key)
+
+    def _size_sync(self, index: DocumentIndex) -> int:
+        size = 0
+        if index.vector is not None:
+            size += self._vector_size_sync(index.vector)
+        if index.lexical is not None:
+            size += index.lexical.nbytes
+        return size
+
+    async def _size(self, index: DocumentIndex) -> int:
+        return await asyncio.to_thread(self._size_sync, index)
+
+    async def _unload(self, key: str, index: DocumentIndex) -> None:
+        # Persisted indexes stay on disk, and are reopened on the next question.
+        if self.path is None:
+            await super(PersistentIndexRegistry, self)._unload(key, index)
+
+    async def _drop(
+        self, key: str, index: typing.Optional[DocumentIndex]
+    ) -> None:
+        if self.cache is not None:
+            self.cache.invalidate(key)
+        await asyncio.to_thread(self._delete_index_sync, key)
+
+    def _save_owner_sync(
+        self, conversation_id: str, key: str, name: typing.Optional[str]
+    ) -> None:
+        with self.lock, self.connection:
+            if name is None:
+                self.connection.execute(
+                    'DELETE FROM conversation_documents WHERE conversation_id = ? AND key = ?',
+                    (conversation_id, key),
+                )
+            else:
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO conversation_documents VALUES (?, ?, ?, ?)',
+                    (conversation_id, key, name, time.time()),
+                )
+
+    async def _save_owner(
+        self, conversation_id: str, key: str, name: typing.Optional[str]
+    ) -> None:
+        if self.connection is not None:
+            await asyncio.to_thread(
+                self._save_owner_sync, conversation_id, key, name
+            )
+
+    async def close(self) -> None:
+        await asyncio.to_thread(self._close_sync)
+        if self.connection is not None:
+            with self.lock:
+                self.connection.close()
+
+
+class ChromaIndexRegistry(PersistentIndexRegistry):
+    """Keeps indexes as collections of one shared Chroma client."""
+
+    def __init__(
+        self,
+        *,
+        embeddings: typing.Optional[Embeddings],
+        path: typing.Optional[str] = None,
+        max_indexes: int = 100,
+        max_bytes: typing.Optional[int] = None,
+        idle_ttl: typing.Optional[float] = None,
+        retrieval: str = 'vector',
+        cache: typing.Optional[RetrievalCache] = None,
+    ):
+        super(ChromaIndexRegistry, self).__init__(
+            embeddings=embeddings,
+            path=path,
+            max_indexes=max_indexes,
+            max_bytes=max_bytes,
+            idle_ttl=idle_ttl,
+            retrieval=retrieval,
+            cache=cache,
+        )
+
+        import chromadb
+        import chromadb.config
+
+        if path is None:
+            self.client = chromadb.Client(chromadb.config.Settings())
+        else:
+            self.client = chromadb.Client(
+                chromadb.config.Settings(
+                    chroma_db_impl='duckdb+parquet', persist_directory=path
+                )
+            )
+
+    @staticmethod
+    def collection_name(key: str) -> str:
+        """Gets Chroma collection name of index key."""
+        # Chroma limits collection names to 63 characters.
+        return f'ailingbot-{key[:48]}'
+
+    def _open(self, key: str) -> Chroma:
+        return Chroma(
+            collection_name=self.collection_name(key),
+            embedding_function=self.embeddings,
+            client=self.client,
+        )
+
+    def _exists(self, key: str) -> bool:
+        name = self.collection_name(key)
+        return any(c.name == name for c in self.client.list_collections())
+
+    def _build_sync(
+        self, key: str, documents: list[Document], vectors: list[list[float]]
+    ) -> VectorStore:
+        texts = [d.page_content for d in documents]
+        Chroma(
+            collection_name=self.collection_name(key),
+            embedding_function=PrecomputedEmbeddings(
+                embeddings=self.embeddings, texts=texts, vectors=vectors
+            ),
+            client=self.client,
+        ).add_texts(texts, metadatas=[d.metadata for d in documents])
+        if self.path is not None:
+            self.client.persist()
+        # Reopens the collection, so that precomputed vectors are not kept in memory.
+        return self._open(key)
+
+    def _open_sync(self, key: str) -> typing.Optional[VectorStore]:
+        return self._open(key) if self._exists(key) else None
+
+    def _delete_sync(self, key: str) -> None:
+        if self._exists(key):
+            self.client.delete_collection(self.collection_name(key))
+
+    def _vector_size_sync(self, index: Chroma) -> int:
+        # Vectors dominate, estimated as float32 rows of the dimension of the first one.
+        count = index._collection.count()
+        if count == 0:
+            return 0
+        embeddings = index._collection.get(limit=1, include=['embeddings'])[
+            'embeddings'
+        ]
+        return count * len(embeddings[0]) * 4 if embeddings else 0
+
+    def search_sync(
+        self, index: Chroma, vector: list[float], k: int
+    ) -> list[tuple[Document, float]]:
+        k = min(k, index._collection.count())
+        if k <= 0:
+            return []
+        results = index._collection.query(
+            query_embeddings=[vector], n_results=k
+        )
+        return [
+            (Document(page_content=text, metadata=metadata or {}), -distance)
+            for text, metadata, distance in zip(
+                results['documents'][0],
+                results['metadatas'][0],
+                results['distances'][0],
+            )
+        ]
+
+    def _close_sync(self) -> None:
+        if self.path is not None:
+            self.client.persist()
+
+
+class NumpyIndexRegistry(PersistentIndexRegistry):
+    """Keeps indexes as NumPy vector stores, persisted as memory-mapped .npy files."""
+
+    def __init__(
+        self,
+        *,
+        embeddings: typing.Optional[Embeddings],
+        path: typing.Optional[str] = None,
+        max_indexes: int = 100,
+        max_bytes: typing.Optional[int] = None,
+        idle_ttl: typing.Optional[float] = None,
+        retrieval: str = 'vector',
+        cache: typing.Optional[RetrievalCache] = None,
+        dtype: str = 'float32',
+    ):
+        """Init.
+
+        :param dtype: Storage type of vectors, `float32`, `float16` or `int8`.
+        :type dtype: str
+        """
+        super(NumpyIndexRegistry, self).__init__(
+            embeddings=embeddings,
+            path=path,
+            max_indexes=max_indexes,
+            max_bytes=max_bytes,
+            idle_ttl=idle_ttl,
+            retrieval=retrieval,
+            cache=cache,
+        )
+
+        self.dtype = dtype
+
+    def _index_path(self, key: str) -> str:
+        return os.path.join(self.path, 'numpy', key)
+
+    def _build_sync(
+        self, key: str, documents: list[Document], vectors: list[list[float]]
+    ) -> VectorStore:
+        store = NumpyVectorStore(embedding=self.embeddings, dtype=self.dtype)
+        store.add_vectors(
+            vectors,
+            [d.page_content for d in documents],
+            [d.metadata for d in documents],
+        )
+        if self.path is not None:
+            store.save(self._index_path(key))
+        return store
+
+    def _open_sync(self, key: str) -> typing.Optional[VectorStore]:
+        if not os.path.isdir(self._index_path(key)):
+            return None
+        return NumpyVectorStore.load(
+            self._index_path(key), embedding=self.embeddings
+        )
+
+    def _delete_sync(self, key: str) -> None:
+        if self.path is not None:
+            shutil.rmtree(self._index_path(key), ignore_errors=True)
+
+    def _vector_size_sync(self, index: NumpyVectorStore) -> int:
+        return index.nbytes
+
+    def search_sync(
+        self, index: NumpyVectorStore, vector: list[float], k: int
+    ) -> list[tuple[Document, float]]:
+        return index.similarity_search_with_score_by_vector(vector, k)
+
+
+class MultiDocumentRetriever(BaseRetriever):
+    """Retrieves the most relevant chunks across the indexes of several documents.
+
+    Each index is searched for the top k chunks, and the overall top k are returned, with the document name in
+    metadata. In `vector` mode the question is embedded once, in `bm25` mode nothing is embedded and chunks are
+    ranked by BM25. In `hybrid` mode both are searched, scores of each are min-max normalized over all candidates,
+    and chunks are ranked by the weighted sum of normalized scores.
+
+    If the registry has a retrieval cache, results of each index and query vectors are looked up in it first.
+    """
+
+    def __init__(
+        self,
+        *,
+        registry: PersistentIndexRegistry,
+        indexes: list[tuple[str, DocumentIndex]],
+        k: int = 4,
+        hybrid_weight: float = 0.5,
+    ):
+        """Init.
+
+        :param registry: Registry that owns the indexes.
+        :type registry: PersistentIndexRegistry
+        :param indexes: Document names and indexes.
+        :type indexes: list[tuple[str, DocumentIndex]]
+        :param k: Number of chunks to retrieve.
+        :type k: int
+        :param hybrid_weight: Weight of vector scores in `hybrid` mode, BM25 scores weigh the rest.
+        :type hybrid_weight: float
+        """
+        self.registry = registry
+        self.indexes = indexes
+        self.k = k
+        self.hybrid_weight = hybrid_weight
+
+    @staticmethod
+    def _normalize(
+        results: list[tuple[str, Document, float]]
+    ) -> dict[tuple[str, str], tuple[Document, float]]:
+        """Min-max normalizes scores, keyed by document name and chunk text."""
+        if not results:
+            return {}
+        low = min(s for _, _, s in results)
+        high = max(s for _, _, s in results)
+        return {
+            (name, d.page_content): (
+                d,
+                (s - low) / (high - low) if high > low else 1.0,
+            )
+            for name, d, s in results
+        }
+
+    def _search_index(
+        self,
+        index: DocumentIndex,
+        query: str,
+        vector: typing.Optional[list[float]],
+    ) -> SearchResults:
+        """Searches one index, gets its vector and BM25 results."""
+        vector_results = []
+        lexical_results = []
+        if vector is not None and index.vector is not None:
+            vector_results = self.registry.search_sync(
+                index.vector, vector, self.k
+            )
+        if self.registry.retrieval != 'vector' and index.lexical:
+            lexical_results = index.lexical.search(query, self.k)
+        return vector_results, lexical_results
+
+    def _rank(self, results: dict[str, SearchResults]) -> list[Document]:
+        """Ranks results of all indexes, gets the overall top k chunks."""
+        vector_results = []
+        lexical_results = []
+        for name, index in self.indexes:
+            index_vector_results, index_lexical_results = results[index.key]
+            vector_results.extend(
+                (name, d, s) for d, s in index_vector_results
+            )
+            lexical_results.extend(
+                (name, d, s) for d, s in index_lexical_results
+            )
+
+        if self.registry.retrieval == 'hybrid':
+            scores: dict[tuple[str, str], list] = {}
+            for weight, weighted_results in (
+                (self.hybrid_weight, vector_results),
+                (1 - self.hybrid_weight, lexical_results),
+            ):
+                for key, (d, s) in self._normalize(weighted_results).items():
+                    scores.setdefault(key, [key[0], d, 0.0])[2] += weight * s
+            ranked = [tuple(x) for x in scores.values()]
+        else:
+            ranked = vector_results + lexical_results
+        ranked.sort(key=lambda x: x[2], reverse=True)
+        # Copies metadata, since indexes are shared by conversations naming the document differently.
+        return [
+            Document(
+                page_content=d.page_content,
+                metadata={**d.metadata, 'document': name},
+            )
+            for name, d, _ in ranked[: self.k]
+        ]
+
+    def _cached(
+        self, query: str
+    ) -> tuple[dict[str, SearchResults], list[DocumentIndex]]:
+        """Gets cached results of indexes, and indexes that must be searched."""
+        results = {}
+        if self.registry.cache is not None:
+            for _, index in self.indexes:
+                cached = self.registry.cache.get_results(
+                    index.key, query, self.k
+                )
+                if cached is not None:
+                    results[index.key] = cached
+        return results, [i for _, i in self.indexes if i.key not in results]
+
+    def _search(
+        self,
+        query: str,
+        vector: typing.Optional[list[float]],
+        indexes: list[DocumentIndex],
+    ) -> dict[str, SearchResults]:
+        return {i.key: self._search_index(i, query, vector) for i in indexes}
+
+    def _store(self, query: str, results: dict[str, SearchResults]) -> None:
+        if self.registry.cache is not None:
+            for key, index_results in results.items():
+                self.registry.cache.set_results(
+                    key, query, self.k, index_results
+                )
+
+    def get_relevant_documents(self, query: str) -> list[Document]:
+        results, missing = self._cached(query)
+        if missing:
+            vector = None
+            if self.registry.retrieval != 'bm25':
+                cache = self.registry.cache
+                vector = cache.get_vector(query) if cache else None
+                if vector is None:
+                    vector = self.registry.embeddings.embed_query(query)
+                    if cache is not None:
+                        cache.set_vector(query, vector)
+            searched = self._search(query, vector, missing)
+            self._store(query, searched)
+            results.update(searched)
+        return self._rank(results)
+
+    async def aget_relevant_documents(self, query: str) -> list[Document]:
+        # Questions whose results are all cached skip both embedding and search.
+        results, missing = self._cached(query)
+        if missing:
+            vector = None
+            if self.registry.retrieval != 'bm25':
+                cache = self.registry.cache
+                vector = cache.get_vector(query) if cache else None
+                if vector is None:
+                    vector = await self.registry.embeddings.aembed_query(query)
+                    if cache is not None:
+                        cache.set_vector(query, vector)
+            searched = await asyncio.to_thread(
+                self._search, query, vector, missing
+            )
+            self._store(query, searched)
+            results.update(searched)
+        return self._rank(results)
@@ -0,0 +1,246 @@
+from __future__ import annotations
+
+import collections
+import json
+import math
+import os
+import re
+import typing
+
+import numpy as np
+from langchain.docstore.document import Document
+
+_CJK = (
+    '぀-ヿ'  # Hiragana and Katakana.
+    '㐀-䶿'  # CJK Unified Ideographs Extension A.
+    '一-鿿'  # CJK Unified Ideographs.
+    '가-힯'  # Hangul Syllables.
+    '豈-﫿'  # CJK Compatibility Ideographs.
+)
+_TOKEN_PATTERN = re.compile(f'([{_CJK}]+)|[^\\W_{_CJK}]+')
+
+
+def tokenize(text: str) -> list[str]:
+    """Splits text into terms.
+
+    Words of alphabetic scripts are lowercased terms. CJK text has no word boundaries, so each run of CJK characters
+    is split into single characters and overlapping character bigrams.
+
+    :param text: Text.
+    :type text: str
+    :return: Terms.
+    :rtype: list[str]
+    """
+    terms = []
+    for match in _TOKEN_PATTERN.finditer(text.lower()):
+        token = match.group()
+        if match.group(1):
+            terms.extend(token)
+            terms.extend(token[i : i + 2] for i in range(len(token) - 1))
+        else:
+            terms.append(token)
+    return terms
+
+
+class BM25Index:
+    """Inverted index that ranks chunks by Okapi BM25.
+
+    Postings are stored compactly in CSR layout: the postings of term t are doc_ids[offsets[t]:offsets[t + 1]] with
+    frequencies in tfs at the same positions. Saved indexes are loaded through memory-mapped .npy files.
+    """
+
+    def __init__(
+        self,
+        *,
+        vocabulary: dict[str, int],
+        offsets: np.ndarray,
+        doc_ids: np.ndarray,
+        tfs: np.ndarray,
+        lengths: np.ndarray,
+        texts: list[str],
+        metadatas: list[dict],
+        k1: float = 1.5,
+        b: float = 0.75,
+    ):
+        """Init.
+
+        :param vocabulary: Term -> term ID.
+        :type vocabulary: dict[str, int]
+        :param offsets: Start of the postings of each term, with the end of the last one appended.
+        :type offsets: np.ndarray
+        :param doc_ids: Chunk IDs of all postings.
+        :type doc_ids: np.ndarray
+        :param tfs: Term frequencies of all postings.
+        :type tfs: np.ndarray
+        :param lengths: Number of terms of each chunk.
+        :type lengths: np.ndarray
+        :param texts: Text of each chunk.
+        :type texts: list[str]
+        :param metadatas: Metadata of each chunk.
+        :type metadatas: list[dict]
+        :param k1: BM25 term frequency saturation.
+        :type k1: float
+        :param b: BM25 length normalization.
+        :type b: float
+        """
+        self.vocabulary = vocabulary
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.lengths = lengths
+        self.texts = texts
+        self.metadatas = metadatas
+        self.k1 = k1
+        self.b = b
+        self.average_length = float(lengths.mean()) if len(lengths) else 0.0
+
+    @property
+    def nbytes(self) -> int:
+        """Estimated memory size of postings and texts in bytes."""
+        return sum(
+            a.nbytes
+            for a in (self.offsets, self.doc_ids, self.tfs, self.lengths)
+        ) + sum(len(t) for t in self.texts)
+
+    @classmethod
+    def from_documents(
+        cls, documents: list[Document], *, k1: float = 1.5, b: float = 0.75
+    ) -> BM25Index:
+        """Builds index of chunks.
+
+        :param documents: Chunks.
+        :type documents: list[Document]
+        :param k1: BM25 term frequency saturation.
+        :type k1: float
+        :param b: BM25 length normalization.
+        :type b: float
+        :return: Index.
+        :rtype: BM25Index
+        """
+        vocabulary: dict[str, int] = {}
+        postings: list[list[tuple[int, int]]] = []
+        lengths = []
+        for doc_id, document in enumerate(documents):
+            terms = tokenize(document.page_content)
+            lengths.append(len(terms))
+            for term, tf in collections.Counter(terms).items():
+                if term not in vocabulary:
+                    vocabulary[term] = len(postings)
+                    postings.append([])
+                postings[vocabulary[term]].append((doc_id, tf))
+
+        offsets = np.zeros(len(postings) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(p) for p in postings])
+        flat = [x for p in postings for x in p]
+        return cls(
+            vocabulary=vocabulary,
+            offsets=offsets,
+            doc_ids=np.array([d for d, _ in flat], dtype=np.int32),
+            tfs=np.array([min(tf, 65535) for _, tf in flat], dtype=np.uint16),
+            lengths=np.array(lengths, dtype=np.int32),
+            texts=[d.page_content for d in documents],
+            metadatas=[d.metadata for d in documents],
+            k1=k1,
+            b=b,
+        )
+
+    def search(self, query: str, k: int = 4) -> list[tuple[Document, float]]:
+        """Gets the k chunks with highest BM25 score for query.
+
+        :param query: Query text.
+        :type query: str
+        :param k: Number of chunks.
+        :type k: int
+        :return: Chunks and scores, highest first. Chunks sharing no term with query are not returned.
+        :rtype: list[tuple[Document, float]]
+        """
+        n = len(self.lengths)
+        if n == 0:
+            return []
+        scores = np.zeros(n, dtype=np.float32)
+        for term in set(tokenize(query)):
+            term_id = self.vocabulary.get(term, None)
+            if term_id is None:
+                continue
+            start, stop = self.offsets[term_id], self.offsets[term_id + 1]
+            ids = self.doc_ids[start:stop]
+            tf = self.tfs[start:stop].astype(np.float32)
+            df = stop - start
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            norm = self.k1 * (
+                1 - self.b + self.b * self.lengths[ids] / self.average_length
+            )
+            scores[ids] += idf * tf * (self.k1 + 1) / (tf + norm)
+
+        k = min(k, int(np.count_nonzero(scores)))
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [
+            (
+                Document(
+                    page_content=self.texts[i],
+                    metadata=dict(self.metadatas[i]),
+                ),
+                float(scores[i]),
+            )
+            for i in top
+        ]
+
+    def save(self, path: str) -> None:
+        """Saves the index in a directory.
+
+        :param path: Directory path.
+        :type path: str
+        """
+        os.makedirs(path, exist_ok=True)
+        for name in ('offsets', 'doc_ids', 'tfs', 'lengths'):
+            np.save(os.path.join(path, f'{name}.npy'), getattr(self, name))
+        with open(
+            os.path.join(path, 'documents.json'), 'w', encoding='utf-8'
+        ) as f:
+            json.dump(
+                {
+                    'terms': sorted(
+                        self.vocabulary, key=self.vocabulary.__getitem__
+                    ),
+                    'texts': self.texts,
+                    'metadatas': self.metadatas,
+                    'k1': self.k1,
+                    'b': self.b,
+                },
+                f,
+                ensure_ascii=False,
+            )
+
+    @classmethod
+    def load(cls, path: str, *, mmap: bool = True) -> BM25Index:
+        """Loads an index saved in a directory.
+
+        :param path: Directory path.
+        :type path: str
+        :param mmap: Whether to memory-map postings instead of reading them into memory.
+        :type mmap: bool
+        :return: Index.
+        :rtype: BM25Index
+        """
+        with open(
+            os.path.join(path, 'documents.json'), 'r', encoding='utf-8'
+        ) as f:
+            documents = json.load(f)
+        arrays: dict[str, typing.Any] = {
+            name: np.load(
+                os.path.join(path, f'{name}.npy'),
+                mmap_mode='r' if mmap else None,
+            )
+            for name in ('offsets', 'doc_ids', 'tfs', 'lengths')
+        }
+        return cls(
+            vocabulary={t: i for i, t in enumerate(documents['terms'])},
+            texts=documents['texts'],
+            metadatas=documents['metadatas'],
+            k1=documents['k1'],
+            b=documents['b'],
+            **arrays,
+        )
@@ -0,0 +1,160 @@
+from __future__ import annotations
+
+import abc
+import asyncio
+import contextlib
+import time
+import typing
+import zlib
+
+from ailingbot.shared.misc import get_class_dynamically
+
+
+class ConversationLockManager(abc.ABC):
+    """Base class of conversation lock managers.
+
+    A lock manager serializes requests of the same conversation, and records how often requests queue behind one another.
+    """
+
+    def __init__(self):
+        self.acquisitions = 0
+        self.contentions = 0
+        self.total_wait_time = 0.0
+        self.max_wait_time = 0.0
+
+    @abc.abstractmethod
+    def _lock_for(self, conversation_id: str) -> asyncio.Lock:
+        """Gets the lock guarding the conversation, and marks it as in use.
+
+        :param conversation_id: Conversation ID.
+        :type conversation_id: str
+        :return: Lock.
+        :rtype: asyncio.Lock
+        """
+        raise NotImplementedError
+
+    def _release_lock(self, conversation_id: str) -> None:
+        """Marks the lock of the conversation as no longer in use.
+
+        :param conversation_id: Conversation ID.
+        :type conversation_id: str
+        """
+        pass
+
+    @property
+    @abc.abstractmethod
+    def live_locks(self) -> int:
+        """Number of locks currently held in memory."""
+        raise NotImplementedError
+
+    @contextlib.asynccontextmanager
+    async def hold(self, conversation_id: str) -> typing.AsyncIterator[None]:
+        """Holds the lock of the conversation during the context.
+
+        :param conversation_id: Conversation ID.
+        :type conversation_id: str
+        """
+        lock = self._lock_for(conversation_id)
+        try:
+            if lock.locked():
+                self.contentions += 1
+            start = time.perf_counter()
+            await lock.acquire()
+            wait_time = time.perf_counter() - start
+            self.acquisitions += 1
+            self.total_wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+            try:
+                yield
+            finally:
+                lock.release()
+        finally:
+            self._release_lock(conversation_id)
+
+    def stats(self) -> dict[str, typing.Any]:
+        """Gets lock statistics.
+
+        :return: Statistics of live locks, contention and wait time.
+        :rtype: dict
+        """
+        return {
+            'live_locks': self.live_locks,
+            'acquisitions': self.acquisitions,
+            'contentions': self.contentions,
+            'total_wait_time': self.total_wait_time,
+            'max_wait_time': self.max_wait_time,
+        }
+
+    @staticmethod
+    def get_lock_manager(name: str, **kwargs) -> ConversationLockManager:
+        """Gets lock manager instance.
+
+        :param name: Built-in lock manager name or full path of lock manager class.
+        :type name: str
+        :return: Lock manager instance.
+        :rtype: ConversationLockManager
+        """
+        if name.lower() == 'refcount':
+            instance = RefCountLockManager()
+        elif name.lower() == 'striped':
+            instance = StripedLockManager(stripes=kwargs.get('stripes', 1024))
+        else:
+            instance = get_class_dynamically(name)(**kwargs)
+
+        return instance
+
+
+class RefCountLockManager(ConversationLockManager):
+    """Lock manager that keeps a lock only while some request uses it.
+
+    Each lock is reference counted by the requests holding or waiting on it, and dropped once the count reaches zero,
+    so memory is proportional to the number of in-flight conversations.
+    """
+
+    def __init__(self):
+        super(RefCountLockManager, self).__init__()
+
+        self.locks: dict[str, asyncio.Lock] = {}
+        self.refcounts: dict[str, int] = {}
+
+    def _lock_for(self, conversation_id: str) -> asyncio.Lock:
+        if conversation_id not in self.locks:
+            self.locks[conversation_id] = asyncio.Lock()
+            self.refcounts[conversation_id] = 0
+        self.refcounts[conversation_id] += 1
+        return self.locks[conversation_id]
+
+    def _release_lock(self, conversation_id: str) -> None:
+        self.refcounts[conversation_id] -= 1
+        if self.refcounts[conversation_id] == 0:
+            del self.refcounts[conversation_id]
+            del self.locks[conversation_id]
+
+    @property
+    def live_locks(self) -> int:
+        return len(self.locks)
+
+
+class StripedLockManager(ConversationLockManager):
+    """Lock manager that maps conversations onto a fixed array of locks.
+
+    Memory is constant, at the cost of unrelated conversations occasionally sharing a stripe.
+    """
+
+    def __init__(self, *, stripes: int = 1024):
+        super(StripedLockManager, self).__init__()
+
+        self.stripes = stripes
+        self.locks: list[asyncio.Lock] = []
+
+    def _lock_for(self, conversation_id: str) -> asyncio.Lock:
+        # Creates locks lazily, so that they are bound to the running event loop.
+        if not self.locks:
+            self.locks = [asyncio.Lock() for _ in range(self.stripes)]
+        # Uses crc32 instead of hash() to keep stripes stable across processes.
+        index = zlib.crc32(conversation_id.encode('utf-8')) % len(self.locks)
+        return self.locks[index]
+
+    @property
+    def live_locks(self) -> int:
+        return len(self.locks)
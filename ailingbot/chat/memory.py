@@ -0,0 +1,418 @@
+from __future__ import annotations
+
+import abc
+import asyncio
+import collections
+import functools
+import json
+import sqlite3
+import threading
+import time
+import typing
+
+import tiktoken
+from langchain.memory import ConversationBufferWindowMemory
+from langchain.memory.chat_memory import BaseChatMemory
+from langchain.schema import (
+    BaseMessage,
+    SystemMessage,
+    get_buffer_string,
+    messages_from_dict,
+    messages_to_dict,
+)
+
+from ailingbot.shared.misc import get_class_dynamically
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model_name: str) -> tiktoken.Encoding:
+    """Gets tiktoken encoding of model, falls back to cl100k_base for unknown models.
+
+    :param model_name: Model name.
+    :type model_name: str
+    :return: Encoding.
+    :rtype: tiktoken.Encoding
+    """
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding('cl100k_base')
+
+
+class TokenBudgetWindowMemory(ConversationBufferWindowMemory):
+    """Window memory that keeps as many recent rounds as fit in a token budget.
+
+    The token count of each message is computed once and cached in the message's additional_kwargs, so it is
+    persisted with the message and never recomputed on later rounds.
+    """
+
+    # None means no token budget, only the window size applies.
+    max_token_limit: typing.Optional[int] = 2000
+    model_name: str = 'gpt-3.5-turbo'
+    # Tokens of history selected by the last load, and of the whole window before selection.
+    last_token_count: int = 0
+    last_window_token_count: int = 0
+
+    def count_tokens(self, message: BaseMessage) -> int:
+        """Gets token count of a rendered message, computes and caches it if not cached.
+
+        :param message: Message.
+        :type message: BaseMessage
+        :return: Token count.
+        :rtype: int
+        """
+        count = message.additional_kwargs.get('token_count', None)
+        if count is None:
+            text = get_buffer_string(
+                [message],
+                human_prefix=self.human_prefix,
+                ai_prefix=self.ai_prefix,
+            )
+            count = len(get_encoding(self.model_name).encode(text))
+            message.additional_kwargs['token_count'] = count
+        return count
+
+    def select_messages(self) -> list[BaseMessage]:
+        """Selects messages of the recent rounds that fit in the token budget.
+
+        :return: Selected messages.
+        :rtype: list[BaseMessage]
+        """
+        window = self.buffer[-self.k * 2 :] if self.k > 0 else []
+        if self.max_token_limit is None:
+            return window
+        counts = [self.count_tokens(m) for m in window]
+
+        # Walks back round by round, and stops at the first round over budget.
+        start, total = len(window), 0
+        while start > 0:
+            begin = max(start - 2, 0)
+            count = sum(counts[begin:start])
+            if total + count > self.max_token_limit:
+                break
+            start, total = begin, total + count
+        self.last_token_count = total
+        self.last_window_token_count = sum(counts)
+        return window[start:]
+
+    def load_memory_variables(
+        self, inputs: dict[str, typing.Any]
+    ) -> dict[str, typing.Any]:
+        buffer: typing.Any = self.select_messages()
+        if not self.return_messages:
+            buffer = get_buffer_string(
+                buffer,
+                human_prefix=self.human_prefix,
+                ai_prefix=self.ai_prefix,
+            )
+        return {self.memory_key: buffer}
+
+
+class CompactingWindowMemory(TokenBudgetWindowMemory):
+    """Window memory with a rolling summary of the rounds compacted out of the window.
+
+    The summary is sent before the recent rounds. Compaction itself is done by the policy, which summarizes the
+    rounds out of the window into summary and then removes them.
+    """
+
+    summary: str = ''
+
+    def rounds_to_compact(self) -> int:
+        """Gets number of rounds out of the window that are not yet compacted.
+
+        :return: Number of rounds.
+        :rtype: int
+        """
+        return max(len(self.buffer) - self.k * 2, 0) // 2
+
+    def select_messages(self) -> list[BaseMessage]:
+        messages = super(CompactingWindowMemory, self).select_messages()
+        if self.summary:
+            messages = [SystemMessage(content=self.summary)] + messages
+        return messages
+
+
+class ConversationMemoryStore(abc.ABC):
+    """Base class of conversation memory stores."""
+
+    def __init__(self, *, memory_factory: typing.Callable[[], BaseChatMemory]):
+        """Init.
+
+        :param memory_factory: Function that creates an empty memory for a new conversation.
+        :type memory_factory: typing.Callable[[], BaseChatMemory]
+        """
+        self.memory_factory = memory_factory
+
+    @abc.abstractmethod
+    async def load(self, conversation_id: str) -> BaseChatMemory:
+        """Loads memory of conversation. Creates a new memory if not exists.
+
+        :param conversation_id: Conversation ID.
+        :type conversation_id: str
+        :return: Chat memory.
+        :rtype: BaseChatMemory
+        """
+        raise NotImplementedError
+
+    async def save(self, conversation_id: str, memory: BaseChatMemory) -> None:
+        """Saves memory of conversation after a round of conversation.
+
+        :param conversation_id: Conversation ID.
+        :type conversation_id: str
+        :param memory: Chat memory.
+        :type memory: BaseChatMemory
+        """
+        pass
+
+    async def close(self) -> None:
+        """Persists memories if necessary, and releases resources."""
+        pass
+
+    def stats(self) -> dict[str, typing.Any]:
+        """Gets store statistics.
+
+        :return: Statistics.
+        :rtype: dict
+        """
+        return {}
+
+    def dump(self, memory: BaseChatMemory) -> dict[str, typing.Any]:
+        """Converts memory to a JSON serializable dict.
+
+        :param memory: Chat memory.
+        :type memory: BaseChatMemory
+        :return: Serialized memory.
+        :rtype: dict
+        """
+        data = {'messages': messages_to_dict(memory.chat_memory.messages)}
+        if isinstance(memory, CompactingWindowMemory):
+            data['summary'] = memory.summary
+        return data
+
+    def restore(self, data: dict[str, typing.Any]) -> BaseChatMemory:
+        """Creates memory from the dict returned by dump.
+
+        :param data: Serialized memory.
+        :type data: dict
+        :return: Chat memory.
+        :rtype: BaseChatMemory
+        """
+        memory = self.memory_factory()
+        memory.chat_memory.messages = messages_from_dict(
+            data.get('messages', [])
+        )
+        if isinstance(memory, CompactingWindowMemory):
+            memory.summary = data.get('summary', '')
+        return memory
+
+    @staticmethod
+    def get_store(
+        name: str,
+        *,
+        memory_factory: typing.Callable[[], BaseChatMemory],
+        **kwargs,
+    ) -> ConversationMemoryStore:
+        """Gets conversation memory store instance.
+
+        :param name: Built-in store name or full path of store class.
+        :type name: str
+        :param memory_factory: Function that creates an empty memory for a new conversation.
+        :type memory_factory: typing.Callable[[], BaseChatMemory]
+        :return: Store instance.
+        :rtype: ConversationMemoryStore
+        """
+        if name.lower() == 'memory':
+            instance = LRUConversationMemoryStore(
+                memory_factory=memory_factory,
+                max_conversations=kwargs.get('max_conversations', 10000),
+                idle_ttl=kwargs.get('idle_ttl', None),
+            )
+        elif name.lower() == 'sqlite':
+            instance = SQLiteConversationMemoryStore(
+                memory_factory=memory_factory,
+                max_conversations=kwargs.get('max_conversations', 10000),
+                idle_ttl=kwargs.get('idle_ttl', None),
+                path=kwargs.get('path', 'ailingbot_memory.sqlite3'),
+            )
+        else:
+            instance = get_class_dynamically(name)(
+                memory_factory=memory_factory, **kwargs
+            )
+
+        return instance
+
+
+class LRUConversationMemoryStore(ConversationMemoryStore):
+    """Keeps memories in memory, and evicts least recently used or idle conversations.
+
+    Evicted conversations are dropped. Subclasses can spill them somewhere and reload them on the next message by
+    overriding _spill and _reload.
+    """
+
+    def __init__(
+        self,
+        *,
+        memory_factory: typing.Callable[[], BaseChatMemory],
+        max_conversations: int = 10000,
+        idle_ttl: typing.Optional[float] = None,
+    ):
+        """Init.
+
+        :param memory_factory: Function that creates an empty memory for a new conversation.
+        :type memory_factory: typing.Callable[[], BaseChatMemory]
+        :param max_conversations: Maximum number of conversations kept in memory.
+        :type max_conversations: int
+        :param idle_ttl: Seconds after which an idle conversation is evicted, None means never.
+        :type idle_ttl: typing.Optional[float]
+        """
+        super(LRUConversationMemoryStore, self).__init__(
+            memory_factory=memory_factory
+        )
+
+        self.max_conversations = max_conversations
+        self.idle_ttl = idle_ttl
+        # Conversation ID -> (memory, last access time), in order of access.
+        self.memories: collections.OrderedDict[
+            str, tuple[BaseChatMemory, float]
+        ] = collections.OrderedDict()
+
+        self.evictions = 0
+        self.reloads = 0
+
+    async def _spill(
+        self, conversation_id: str, data: dict[str, typing.Any]
+    ) -> None:
+        """Persists an evicted conversation.
+
+        :param conversation_id: Conversation ID.
+        :type conversation_id: str
+        :param data: Serialized memory.
+        :type data: dict
+        """
+        pass
+
+    async def _reload(
+        self, conversation_id: str
+    ) -> typing.Optional[dict[str, typing.Any]]:
+        """Reloads a persisted conversation.
+
+        :param conversation_id: Conversation ID.
+        :type conversation_id: str
+        :return: Serialized memory, None if not exists.
+        :rtype: typing.Optional[dict]
+        """
+        return None
+
+    def _touch(self, conversation_id: str, memory: BaseChatMemory) -> None:
+        """Marks conversation as the most recently used one."""
+        self.memories[conversation_id] = (memory, time.monotonic())
+        self.memories.move_to_end(conversation_id)
+
+    async def _evict(self) -> None:
+        """Evicts conversations over the count limit or idle for too long."""
+        now = time.monotonic()
+        while self.memories:
+            conversation_id, (memory, accessed_at) = next(
+                iter(self.memories.items())
+            )
+            if len(self.memories) <= self.max_conversations and (
+                self.idle_ttl is None or now - accessed_at < self.idle_ttl
+            ):
+                break
+            del self.memories[conversation_id]
+            self.evictions += 1
+            await self._spill(conversation_id, self.dump(memory))
+
+    async def load(self, conversation_id: str) -> BaseChatMemory:
+        if conversation_id in self.memories:
+            memory, _ = self.memories[conversation_id]
+        else:
+            data = await self._reload(conversation_id)
+            if data is None:
+                memory = self.memory_factory()
+            else:
+                memory = self.restore(data)
+                self.reloads += 1
+        self._touch(conversation_id, memory)
+        await self._evict()
+        return memory
+
+    async def save(self, conversation_id: str, memory: BaseChatMemory) -> None:
+        # Puts memory back in case it was evicted while in use.
+        self._touch(conversation_id, memory)
+        await self._evict()
+
+    async def close(self) -> None:
+        while self.memories:
+            conversation_id, (memory, _) = self.memories.popitem(last=False)
+            await self._spill(conversation_id, self.dump(memory))
+
+    def stats(self) -> dict[str, typing.Any]:
+        return {
+            'live_conversations': len(self.memories),
+            'evictions': self.evictions,
+            'reloads': self.reloads,
+        }
+
+
+class SQLiteConversationMemoryStore(LRUConversationMemoryStore):
+    """LRU memory store that spills evicted conversations to a SQLite file.
+
+    All conversations in memory are spilled on close, so that they survive restarts.
+    """
+
+    def __init__(
+        self,
+        *,
+        memory_factory: typing.Callable[[], BaseChatMemory],
+        max_conversations: int = 10000,
+        idle_ttl: typing.Optional[float] = None,
+        path: str = 'ailingbot_memory.sqlite3',
+    ):
+        super(SQLiteConversationMemoryStore, self).__init__(
+            memory_factory=memory_factory,
+            max_conversations=max_conversations,
+            idle_ttl=idle_ttl,
+        )
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS conversation_memory '
+                '(conversation_id TEXT PRIMARY KEY, data TEXT, updated_at REAL)'
+            )
+
+    def _spill_sync(self, conversation_id: str, data: str) -> None:
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO conversation_memory VALUES (?, ?, ?)',
+                (conversation_id, data, time.time()),
+            )
+
+    def _reload_sync(self, conversation_id: str) -> typing.Optional[str]:
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                'SELECT data FROM conversation_memory WHERE conversation_id = ?',
+                (conversation_id,),
+            ).fetchone()
+        return None if row is None else row[0]
+
+    async def _spill(
+        self, conversation_id: str, data: dict[str, typing.Any]
+    ) -> None:
+        await asyncio.to_thread(
+            self._spill_sync,
+            conversation_id,
+            json.dumps(data, ensure_ascii=False),
+        )
+
+    async def _reload(
+        self, conversation_id: str
+    ) -> typing.Optional[dict[str, typing.Any]]:
+        data = await asyncio.to_thread(self._reload_sync, conversation_id)
+        return None if data is None else json.loads(data)
+
+    async def close(self) -> None:
+        await super(SQLiteConversationMemoryStore, self).close()
+        self.connection.close()
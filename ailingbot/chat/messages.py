@@ -4,7 +4,7 @@ import abc
 import enum
 import typing
 
-from pydantic import BaseModel
+from pydantic import BaseModel, validator
 
 
 class MessageScope(str, enum.Enum):
@@ -36,12 +36,22 @@ class TextRequestMessage(RequestMessage):
 
 
 class FileRequestMessage(RequestMessage):
-    """File request message."""
+    """File request message.
 
-    content: bytes
+    Content is the file content, or a binary file positioned at the start, which downloads are spooled into so that
+    large files are not held in memory.
+    """
+
+    content: typing.Any
     file_type: str
     file_name: str
 
+    @validator('content')
+    def _check_content(cls, v: typing.Any) -> typing.Any:
+        if isinstance(v, bytes) or hasattr(v, 'read'):
+            return v
+        raise TypeError('content must be bytes or a binary file')
+
 
 class ResponseMessage(BaseModel, abc.ABC):
     """Base class of response messages."""
@@ -86,6 +96,13 @@ class TextResponseMessage(ResponseMessage):
         return self.text
 
 
+class NoticeResponseMessage(TextResponseMessage):
+    """Interim notice sent on its own while a streaming response is being prepared, e.g. an acknowledgement of a
+    long-running task."""
+
+    pass
+
+
 class FallbackResponseMessage(ResponseMessage):
     """Fallback response message.
 
@@ -1,10 +1,23 @@
+import asyncio
 import copy
+import hashlib
+import json
+import typing
 
-from langchain import ConversationChain
+from langchain import ConversationChain, LLMChain
 from langchain.llms.loading import load_llm_from_config
 from langchain.memory import ConversationBufferWindowMemory
 from langchain.memory.chat_memory import BaseChatMemory
+from langchain.memory.prompt import SUMMARY_PROMPT
+from langchain.schema import get_buffer_string
+from loguru import logger
 
+from ailingbot.chat.cache import ResponseCache, SingleFlight
+from ailingbot.chat.memory import (
+    CompactingWindowMemory,
+    ConversationMemoryStore,
+    TokenBudgetWindowMemory,
+)
 from ailingbot.chat.messages import (
     ResponseMessage,
     TextRequestMessage,
@@ -13,6 +26,7 @@ from ailingbot.chat.messages import (
     RequestMessage,
 )
 from ailingbot.chat.policy import ChatPolicy
+from ailingbot.chat.streaming import arun_stream
 from ailingbot.config import settings
 
 
@@ -29,10 +43,84 @@ class ConversationChatPolicy(ChatPolicy):
         )
 
         llm_config = copy.deepcopy(settings.policy.llm)
-        llm = load_llm_from_config(llm_config)
-        self.chain = ConversationChain(llm=llm, verbose=debug)
+        self.llm = load_llm_from_config(llm_config)
         self.history_size = settings.policy.get('history_size', 5)
-        self.memories: dict[str, BaseChatMemory] = {}
+        self.history_token_budget = settings.policy.get(
+            'history_token_budget', None
+        )
+        self.model_name = llm_config.get('model_name', 'gpt-3.5-turbo')
+        # Rounds out of the history window that trigger a background compaction, None disables compaction.
+        self.compaction_threshold = settings.policy.get(
+            'compaction_threshold', None
+        )
+        # Failed compactions in a row after which the rounds are dropped without being summarized.
+        self.compaction_max_failures = settings.policy.get(
+            'compaction_max_failures', 3
+        )
+        self.compaction_tasks: dict[str, asyncio.Task] = {}
+        # Failed compactions in a row of each conversation.
+        self.compaction_retries: dict[str, int] = {}
+        self.compactions = 0
+        self.compaction_failures = 0
+        self.compaction_drops = 0
+        memory_config = settings.policy.get('memory', {})
+        self.memories = ConversationMemoryStore.get_store(
+            memory_config.get('store', 'memory'),
+            memory_factory=self._create_memory,
+            **{k: v for k, v in memory_config.items() if k != 'store'},
+        )
+        # Tokens of history sent to LLM, and tokens the whole history window would have taken.
+        self.history_tokens_sent = 0
+        self.history_tokens_windowed = 0
+
+        cache_config = settings.policy.get('cache', None)
+        self.cache: typing.Optional[ResponseCache] = None
+        if cache_config:
+            self.cache = ResponseCache.get_cache(
+                cache_config.get('backend', 'memory'),
+                **{k: v for k, v in cache_config.items() if k != 'backend'},
+            )
+        self.flights = SingleFlight()
+        # The API key does not change responses, so it is left out of the cache key.
+        self.llm_config_hash = hashlib.sha256(
+            json.dumps(
+                {k: v for k, v in llm_config.items() if k != 'openai_api_key'},
+                sort_keys=True,
+                default=str,
+            ).encode('utf-8')
+        ).hexdigest()
+
+    def _create_memory(self) -> BaseChatMemory:
+        """Creates an empty memory for a new conversation.
+
+        :return: Chat memory.
+        :rtype: BaseChatMemory
+        """
+        if self.compaction_threshold is not None:
+            return CompactingWindowMemory(
+                k=self.history_size,
+                max_token_limit=self.history_token_budget,
+                model_name=self.model_name,
+            )
+        if self.history_token_budget is not None:
+            return TokenBudgetWindowMemory(
+                k=self.history_size,
+                max_token_limit=self.history_token_budget,
+                model_name=self.model_name,
+            )
+        return ConversationBufferWindowMemory(k=self.history_size)
+
+    def _record_history_tokens(self, *, memory: BaseChatMemory) -> None:
+        """Records history tokens sent by the chain that just ran."""
+        if (
+            isinstance(memory, TokenBudgetWindowMemory)
+            and memory.max_token_limit is not None
+        ):
+            self.history_tokens_sent += memory.last_token_count
+            self.history_tokens_windowed += memory.last_window_token_count
+            logger.debug(
+                f'History tokens sent: {memory.last_token_count}/{memory.last_window_token_count}.'
+            )
 
     async def _load_memory(self, *, conversation_id: str) -> BaseChatMemory:
         """Load memory for conversation. Create a new memory if not exists.
@@ -42,11 +130,197 @@ class ConversationChatPolicy(ChatPolicy):
         :return: Chat memory.
         :rtype: BaseChatMemory
         """
-        if conversation_id not in self.memories:
-            self.memories[conversation_id] = ConversationBufferWindowMemory(
-                k=self.history_size
+        return await self.memories.load(conversation_id)
+
+    async def _save_memory(
+        self, *, conversation_id: str, memory: BaseChatMemory
+    ) -> None:
+        """Save memory of conversation after a round of conversation.
+
+        Messages out of the history window are dropped, or compacted into summary in background if compaction is
+        enabled.
+
+        :param conversation_id: Conversation ID.
+        :type conversation_id: str
+        :param memory: Chat memory.
+        :type memory: BaseChatMemory
+        """
+        if not isinstance(memory, CompactingWindowMemory):
+            del memory.chat_memory.messages[: -self.history_size * 2]
+        elif (
+            memory.rounds_to_compact() >= self.compaction_threshold
+            and conversation_id not in self.compaction_tasks
+        ):
+            task = asyncio.create_task(
+                self._compact(conversation_id=conversation_id, memory=memory)
+            )
+            self.compaction_tasks[conversation_id] = task
+            task.add_done_callback(
+                lambda _: self.compaction_tasks.pop(conversation_id, None)
             )
-        return self.memories[conversation_id]
+        await self.memories.save(conversation_id, memory)
+
+    async def _compact(
+        self, *, conversation_id: str, memory: CompactingWindowMemory
+    ) -> None:
+        """Summarizes rounds out of the history window into the rolling summary, and removes them.
+
+        Runs in background after the response is returned. The memory is loaded again once the summary is ready,
+        since it may have been replaced in the store meanwhile, e.g. spilled and reloaded. The summary is only applied
+        if the compacted rounds are still the first ones. After `compaction_max_failures` failed compactions in a row,
+        the rounds are dropped without being summarized, so that history does not grow without limit.
+
+        :param conversation_id: Conversation ID.
+        :type conversation_id: str
+        :param memory: Chat memory.
+        :type memory: CompactingWindowMemory
+        """
+        count = memory.rounds_to_compact() * 2
+        messages = memory.chat_memory.messages[:count]
+        previous_summary = memory.summary
+        summary: typing.Optional[str] = None
+        try:
+            summary = await LLMChain(
+                llm=self.llm, prompt=SUMMARY_PROMPT, verbose=self.debug
+            ).apredict(
+                summary=previous_summary,
+                new_lines=get_buffer_string(
+                    messages,
+                    human_prefix=memory.human_prefix,
+                    ai_prefix=memory.ai_prefix,
+                ),
+            )
+        except Exception as e:
+            logger.error(e)
+            self.compaction_failures += 1
+            retries = self.compaction_retries.get(conversation_id, 0) + 1
+            if retries < self.compaction_max_failures:
+                self.compaction_retries[conversation_id] = retries
+                return
+            logger.warning(
+                f'Compaction of conversation {conversation_id} failed {retries} times, dropping {count} messages.'
+            )
+        self.compaction_retries.pop(conversation_id, None)
+
+        memory = await self.memories.load(conversation_id)
+        if (
+            not isinstance(memory, CompactingWindowMemory)
+            or memory.summary != previous_summary
+            or memory.chat_memory.messages[:count] != messages
+        ):
+            logger.warning(
+                f'History of conversation {conversation_id} changed during compaction, skipped.'
+            )
+            return
+        if summary is None:
+            self.compaction_drops += 1
+        else:
+            memory.summary = summary.strip()
+            self.compactions += 1
+        del memory.chat_memory.messages[:count]
+        await self.memories.save(conversation_id, memory)
+
+    def _cache_key(self, *, memory: BaseChatMemory, text: str) -> str:
+        """Builds response cache key from normalized prompt, rendered history and LLM config.
+
+        :param memory: Chat memory of the conversation.
+        :type memory: BaseChatMemory
+        :param text: User input.
+        :type text: str
+        :return: Cache key.
+        :rtype: str
+        """
+        prompt = ' '.join(text.split()).casefold()
+        history = json.dumps(
+            memory.load_memory_variables({}), sort_keys=True, default=str
+        )
+        return hashlib.sha256(
+            '\0'.join([prompt, history, self.llm_config_hash]).encode('utf-8')
+        ).hexdigest()
+
+    def _build_chain(self, *, memory: BaseChatMemory) -> ConversationChain:
+        """Builds a chain bound to the memory of one conversation.
+
+        Chains are cheap to build and the LLM is shared, so each call gets its own chain, and concurrent
+        conversations never see each other's memory.
+
+        :param memory: Chat memory of the conversation.
+        :type memory: BaseChatMemory
+        :return: Conversation chain.
+        :rtype: ConversationChain
+        """
+        return ConversationChain(
+            llm=self.llm, memory=memory, verbose=self.debug
+        )
+
+    @staticmethod
+    def _save_context(
+        *, memory: BaseChatMemory, text: str, answer: str
+    ) -> None:
+        """Saves a round of conversation that was answered without running the chain."""
+        memory.save_context({'input': text}, {'response': answer})
+
+    async def _run_and_cache(
+        self, *, key: str, memory: BaseChatMemory, text: str
+    ) -> str:
+        """Runs chain and caches the answer."""
+        answer = await self._build_chain(memory=memory).arun(text)
+        self._record_history_tokens(memory=memory)
+        await self.cache.set(key, answer)
+        return answer
+
+    async def _run(self, *, memory: BaseChatMemory, text: str) -> str:
+        """Gets answer from cache, from the identical in-flight request, or by running chain.
+
+        :param memory: Chat memory of the conversation.
+        :type memory: BaseChatMemory
+        :param text: User input.
+        :type text: str
+        :return: Answer.
+        :rtype: str
+        """
+        if self.cache is None:
+            answer = await self._build_chain(memory=memory).arun(text)
+            self._record_history_tokens(memory=memory)
+            return answer
+
+        key = self._cache_key(memory=memory, text=text)
+        answer = await self.cache.get(key)
+        if answer is None:
+            answer, shared = await self.flights.do(
+                key,
+                lambda: self._run_and_cache(key=key, memory=memory, text=text),
+            )
+        else:
+            shared = True
+        if shared:
+            self._save_context(memory=memory, text=text, answer=answer)
+        return answer
+
+    def stats(self) -> dict[str, typing.Any]:
+        return {
+            'memories': self.memories.stats(),
+            'history_tokens': {
+                'sent': self.history_tokens_sent,
+                'windowed': self.history_tokens_windowed,
+            }
+            if self.history_token_budget is not None
+            else None,
+            'compaction': {
+                'running': len(self.compaction_tasks),
+                'compactions': self.compactions,
+                'failures': self.compaction_failures,
+                'drops': self.compaction_drops,
+            }
+            if self.compaction_threshold is not None
+            else None,
+            'cache': {
+                **self.cache.stats(),
+                'shared_flights': self.flights.shared,
+            }
+            if self.cache
+            else None,
+        }
 
     async def respond(
         self, *, conversation_id: str, message: RequestMessage
@@ -55,10 +329,106 @@ class ConversationChatPolicy(ChatPolicy):
             response = FallbackResponseMessage()
             response.reason = '不支持的消息类型'
         else:
-            self.chain.memory = await self._load_memory(
-                conversation_id=conversation_id
-            )
+            memory = await self._load_memory(conversation_id=conversation_id)
             response = TextResponseMessage()
-            response.text = await self.chain.arun(message.text)
+            response.text = await self._run(memory=memory, text=message.text)
+            await self._save_memory(
+                conversation_id=conversation_id, memory=memory
+            )
 
         return response
+
+    async def respond_stream(
+        self, *, conversation_id: str, message: RequestMessage
+    ) -> typing.AsyncIterator[ResponseMessage]:
+        if not isinstance(message, TextRequestMessage):
+            yield await self.respond(
+                conversation_id=conversation_id, message=message
+            )
+            return
+
+        memory = await self._load_memory(conversation_id=conversation_id)
+        if self.cache is None:
+            async for text in arun_stream(
+                self._build_chain(memory=memory), message.text
+            ):
+                yield TextResponseMessage(text=text)
+            self._record_history_tokens(memory=memory)
+            await self._save_memory(
+                conversation_id=conversation_id, memory=memory
+            )
+            return
+
+        key = self._cache_key(memory=memory, text=message.text)
+        answer = await self.cache.get(key)
+        shared = True
+        if answer is None:
+            answer = ''
+            async for text, shared in self._stream_and_cache(
+                key=key, memory=memory, text=message.text
+            ):
+                answer = text
+                if not shared:
+                    yield TextResponseMessage(text=text)
+        if shared:
+            self._save_context(memory=memory, text=message.text, answer=answer)
+            yield TextResponseMessage(text=answer)
+        await self._save_memory(conversation_id=conversation_id, memory=memory)
+
+    async def _stream_and_cache(
+        self, *, key: str, memory: BaseChatMemory, text: str
+    ) -> typing.AsyncIterator[tuple[str, bool]]:
+        """Streams chain and caches the answer, or waits for the identical in-flight request.
+
+        The caller running the chain gets the text generated so far whenever the LLM outputs new tokens. Callers
+        sharing the in-flight request only get its answer.
+
+        :param key: Cache key.
+        :type key: str
+        :param memory: Chat memory of the conversation.
+        :type memory: BaseChatMemory
+        :param text: User input.
+        :type text: str
+        :return: Async iterator of generated text, and whether it is shared from another caller.
+        :rtype: typing.AsyncIterator[tuple[str, bool]]
+        """
+        partials: asyncio.Queue[str] = asyncio.Queue()
+
+        async def _stream() -> str:
+            answer = ''
+            async for answer in arun_stream(
+                self._build_chain(memory=memory), text
+            ):
+                partials.put_nowait(answer)
+            self._record_history_tokens(memory=memory)
+            await self.cache.set(key, answer)
+            return answer
+
+        flight = asyncio.ensure_future(self.flights.do(key, _stream))
+        getter: typing.Optional[asyncio.Future] = None
+        try:
+            while True:
+                getter = asyncio.ensure_future(partials.get())
+                done, _ = await asyncio.wait(
+                    [getter, flight], return_when=asyncio.FIRST_COMPLETED
+                )
+                if getter not in done:
+                    getter.cancel()
+                    break
+                yield getter.result(), False
+            answer, shared = flight.result()
+            if shared:
+                yield answer, True
+        finally:
+            # Cancels the chain if the caller stops listening, waiting callers then run it themselves.
+            if getter is not None and not getter.done():
+                getter.cancel()
+            if not flight.done():
+                flight.cancel()
+
+    async def _finalize(self) -> None:
+        # Waits for running compactions, so that their summaries are persisted.
+        await asyncio.gather(
+            *self.compaction_tasks.values(), return_exceptions=True
+        )
+        await self.memories.close()
@@ -1,14 +1,15 @@
+import asyncio
+import concurrent.futures
 import copy
-import tempfile
+import functools
+import typing
 
 from langchain.chains import RetrievalQA
 from langchain.chains.base import Chain
-from langchain.document_loaders import PyPDFLoader
+from langchain.docstore.document import Document
 from langchain.embeddings import OpenAIEmbeddings
+from langchain.embeddings.base import Embeddings
 from langchain.llms.loading import load_llm_from_config
-from langchain.text_splitter import CharacterTextSplitter
-from langchain.vectorstores import Chroma
-from langchain.vectorstores.base import VectorStoreRetriever
 
 from ailingbot.chat.messages import (
     RequestMessage,
@@ -17,8 +18,27 @@ from ailingbot.chat.messages import (
     FallbackResponseMessage,
     TextResponseMessage,
     FileRequestMessage,
+    NoticeResponseMessage,
+)
+from ailingbot.chat.embeddings import (
+    BatchingEmbeddings,
+    CachedEmbeddings,
+    SQLiteEmbeddingCache,
+)
+from ailingbot.chat.indexing import (
+    DocumentIndex,
+    MultiDocumentRetriever,
+    PersistentIndexRegistry,
+    RetrievalCache,
+    SharedIndexRegistry,
+    count_pdf_pages,
+    file_source,
+    get_executor,
+    index_key,
+    load_and_split,
 )
 from ailingbot.chat.policy import ChatPolicy
+from ailingbot.chat.streaming import arun_stream
 from ailingbot.config import settings
 from ailingbot.shared.errors import ChatPolicyError
 
@@ -37,64 +57,352 @@ class DocumentQAPolicy(ChatPolicy):
 
         llm_config = copy.deepcopy(settings.policy.llm)
         self.llm = load_llm_from_config(llm_config)
-        self.chains: dict[str, Chain] = {}
         self.chunk_size = settings.policy.get('chunk_size', 1000)
         self.chunk_overlap = settings.policy.get('chunk_overlap', 0)
+        # Text splitter, `character` or `tiktoken` which measures chunk size and overlap in tokens.
+        self.splitter = settings.policy.get('splitter', 'character')
+        # Executor that parses and splits documents, `process` or `thread`.
+        self.index_executor = settings.policy.get('index_executor', 'process')
+        self.index_workers = settings.policy.get('index_workers', None)
+        # Number of pages extracted by one indexing task.
+        self.pages_per_task = settings.policy.get('pages_per_task', 16)
+        self.executor: typing.Optional[concurrent.futures.Executor] = None
+        # Executor of documents held in memory, which a process pool would be sent a copy of with every task.
+        self.memory_executor: typing.Optional[
+            concurrent.futures.Executor
+        ] = None
+        # Directory where indexes are persisted, None means keeping them in memory only.
+        self.index_path = settings.policy.get('index_path', None)
+        self.max_indexes = settings.policy.get('max_indexes', 100)
+        # Maximum estimated memory size of loaded indexes in bytes, None means no limit.
+        self.max_index_bytes = settings.policy.get('max_index_bytes', None)
+        self.index_idle_ttl = settings.policy.get('index_idle_ttl', None)
+        # Vector store of indexes, `chroma` or `numpy`.
+        self.vector_store = settings.policy.get('vector_store', 'chroma')
+        # Storage type of vectors of the numpy vector store, `float32`, `float16` or `int8`.
+        self.vector_dtype = settings.policy.get('vector_dtype', 'float32')
+        # Retrieval mode, `vector`, `bm25` which makes no embedding calls, or `hybrid`.
+        self.retrieval = settings.policy.get('retrieval', 'vector')
+        # Weight of vector scores in hybrid mode, BM25 scores weigh the rest.
+        self.hybrid_weight = settings.policy.get('hybrid_weight', 0.5)
+        # Cache of query embeddings and retrieval results, disabled if not set.
+        retrieval_cache_config = settings.policy.get('retrieval_cache', None)
+        self.retrieval_cache: typing.Optional[RetrievalCache] = None
+        if retrieval_cache_config:
+            self.retrieval_cache = RetrievalCache(
+                maxsize=retrieval_cache_config.get('maxsize', 1024),
+                ttl=retrieval_cache_config.get('ttl', 3600),
+            )
+        self.indexes: typing.Optional[PersistentIndexRegistry] = None
+        # SQLite file caching chunk embeddings across uploads and restarts, None disables the cache.
+        self.embedding_cache_path = settings.policy.get(
+            'embedding_cache_path', None
+        )
+        self.embedding_cache: typing.Optional[SQLiteEmbeddingCache] = None
+        self.embedding_batch_size = settings.policy.get(
+            'embedding_batch_size', 100
+        )
+        self.embedding_concurrency = settings.policy.get(
+            'embedding_concurrency', 4
+        )
+        # Milliseconds to wait for chunks of other uploads before sending a batch that is not full.
+        self.embedding_batch_delay = settings.policy.get(
+            'embedding_batch_delay', 50
+        )
+        self.embedding_max_retries = settings.policy.get(
+            'embedding_max_retries', 6
+        )
+        self.batcher: typing.Optional[BatchingEmbeddings] = None
+        self.embeddings: typing.Optional[Embeddings] = None
+
+    async def _build_documents_index(
+        self, *, key: str, content: typing.Union[bytes, str], file_type: str
+    ) -> DocumentIndex:
+        """Load document and build index.
 
-    def _build_documents_index(
-        self, *, content: bytes, file_type: str
-    ) -> VectorStoreRetriever:
-        """Load document and build index."""
+        The document is split in page ranges, extracted in parallel in the indexing executor from its spooled file on
+        disk. Documents small enough to be held in memory are extracted in threads instead, which share the content
+        without copies, since a process pool would be sent a copy with every task. Chunks of each range are embedded as soon as the range is split, asynchronously in batches shared with concurrent
+        uploads, and the index is built in a thread, so that the event loop keeps serving other conversations. In
+        `bm25` mode chunks are not embedded.
+        """
         if file_type.lower() != 'pdf':
             raise ChatPolicyError(
                 reason='目前只支持PDF文档',
                 suggestion='请上传PDF文档',
             )
 
-        with tempfile.NamedTemporaryFile(delete=True) as tf:
-            tf.write(content)
-            loader = PyPDFLoader(file_path=tf.name)
-            documents = loader.load()
+        executor = (
+            self.memory_executor
+            if isinstance(content, bytes)
+            else self.executor
+        )
+        loop = asyncio.get_running_loop()
+        pages = await loop.run_in_executor(executor, count_pdf_pages, content)
+
+        async def _index_range(
+            start: int, stop: int
+        ) -> tuple[list[Document], list[list[float]]]:
+            chunks = await loop.run_in_executor(
+                executor,
+                functools.partial(
+                    load_and_split,
+                    content,
+                    chunk_size=self.chunk_size,
+                    chunk_overlap=self.chunk_overlap,
+                    start=start,
+                    stop=stop,
+                    splitter=self.splitter,
+                ),
+            )
+            if not chunks or self.embeddings is None:
+                return chunks, []
+            return chunks, await self.embeddings.aembed_documents(
+                [c.page_content for c in chunks]
+            )
 
-        text_splitter = CharacterTextSplitter(
-            chunk_size=self.chunk_size, chunk_overlap=self.chunk_overlap
+        results = await asyncio.gather(
+            *[
+                _index_range(x, min(x + self.pages_per_task, pages))
+                for x in range(0, pages, self.pages_per_task)
+            ]
+        )
+        texts = [c for chunks, _ in results for c in chunks]
+        vectors = [v for _, range_vectors in results for v in range_vectors]
+        return await self.indexes.build(
+            key, texts, vectors if self.embeddings is not None else None
         )
-        texts = text_splitter.split_documents(documents)
 
-        embeddings = OpenAIEmbeddings(
-            openai_api_key=settings.policy.llm.openai_api_key,
+    async def _learn(
+        self, *, conversation_id: str, message: FileRequestMessage
+    ) -> ResponseMessage:
+        """Adds the uploaded document to the documents of conversation.
+
+        Each document has its own index, shared with other conversations that uploaded the same document, so only
+        new documents are embedded. A document with the same name is replaced.
+
+        :param conversation_id: Conversation ID.
+        :type conversation_id: str
+        :param message: File request message.
+        :type message: FileRequestMessage
+        :return: Completion response.
+        :rtype: ResponseMessage
+        """
+        if message.file_type.lower() != 'pdf':
+            raise ChatPolicyError(
+                reason='目前只支持PDF文档',
+                suggestion='请上传PDF文档',
+            )
+
+        source = file_source(message.content)
+        # Identical documents share one index, so that re-uploads cost nothing.
+        key = index_key(
+            source,
+            file_type=message.file_type,
+            chunk_size=self.chunk_size,
+            chunk_overlap=self.chunk_overlap,
+            splitter=self.splitter,
         )
-        docsearch = Chroma.from_documents(texts, embeddings)
+        await self.indexes.acquire(
+            conversation_id,
+            key,
+            functools.partial(
+                self._build_documents_index,
+                key=key,
+                content=source,
+                file_type=message.file_type,
+            ),
+            message.file_name,
+        )
+        response = TextResponseMessage()
+        response.text = f'我已完成学习，现在可以针对 {"、".join(self.indexes.documents(conversation_id))} 进行提问了'
+        return response
 
-        return docsearch.as_retriever()
+    async def _run_command(
+        self, *, conversation_id: str, text: str
+    ) -> typing.Optional[ResponseMessage]:
+        """Runs document management command.
+
+        `/documents` lists the documents of conversation, `/remove <file name>` removes a document.
+
+        :param conversation_id: Conversation ID.
+        :type conversation_id: str
+        :param text: Request text.
+        :type text: str
+        :return: Command response, None if text is not a command.
+        :rtype: typing.Optional[ResponseMessage]
+        """
+        command, _, argument = text.strip().partition(' ')
+        if command == '/documents':
+            documents = self.indexes.documents(conversation_id)
+            response = TextResponseMessage()
+            response.text = (
+                f'已上传的文档：{"、".join(documents)}' if documents else '还没有上传文档'
+            )
+        elif command == '/remove':
+            response = TextResponseMessage()
+            if await self.indexes.remove(conversation_id, argument.strip()):
+                response.text = f'已删除文档 {argument.strip()}'
+            else:
+                response.text = f'没有找到文档 {argument.strip()}'
+        else:
+            return None
+        return response
+
+    async def _get_chain(self, conversation_id: str) -> typing.Optional[Chain]:
+        """Gets QA chain on all documents of conversation, reopens their indexes if unloaded.
+
+        :param conversation_id: Conversation ID.
+        :type conversation_id: str
+        :return: QA chain, None if no document was uploaded.
+        :rtype: typing.Optional[Chain]
+        :raises ChatPolicyError: If documents were unloaded and can not be reopened.
+        """
+        indexes = await self.indexes.get(conversation_id)
+        # Answering without the dropped documents would silently ignore them.
+        dropped = self.indexes.pop_dropped(conversation_id)
+        if dropped:
+            raise ChatPolicyError(
+                reason=f'文档 {"、".join(dropped)} 因内存限制已被卸载',
+                suggestion='请重新上传文档后再提问',
+            )
+        if not indexes:
+            return None
+        return RetrievalQA.from_chain_type(
+            llm=self.llm,
+            chain_type='stuff',
+            retriever=MultiDocumentRetriever(
+                registry=self.indexes,
+                indexes=indexes,
+                hybrid_weight=self.hybrid_weight,
+            ),
+            return_source_documents=False,
+            verbose=self.debug,
+        )
 
     async def respond(
         self, *, conversation_id: str, message: RequestMessage
     ) -> ResponseMessage:
         if isinstance(message, TextRequestMessage):
-            if conversation_id not in self.chains:
+            response = await self._run_command(
+                conversation_id=conversation_id, text=message.text
+            )
+            if response is not None:
+                return response
+            chain = await self._get_chain(conversation_id)
+            if chain is None:
                 response = FallbackResponseMessage()
                 response.reason = '还没有上传文档'
                 response.suggestion = '请先上传文档'
             else:
                 response = TextResponseMessage()
-                response.text = await self.chains[conversation_id].arun(
-                    message.text
-                )
+                response.text = await chain.arun(message.text)
         elif isinstance(message, FileRequestMessage):
-            self.chains[conversation_id] = RetrievalQA.from_chain_type(
-                llm=self.llm,
-                chain_type='stuff',
-                retriever=self._build_documents_index(
-                    content=message.content, file_type=message.file_type
-                ),
-                return_source_documents=False,
-                verbose=self.debug,
+            response = await self._learn(
+                conversation_id=conversation_id, message=message
             )
-            response = TextResponseMessage()
-            response.text = f'我已完成学习，现在可以针对 {message.file_name} 进行提问了'
         else:
             response = FallbackResponseMessage()
             response.reason = '不支持的消息类型'
 
         return response
+
+    async def respond_stream(
+        self, *, conversation_id: str, message: RequestMessage
+    ) -> typing.AsyncIterator[ResponseMessage]:
+        if isinstance(message, FileRequestMessage):
+            # Indexing may take minutes, acknowledges at once.
+            yield NoticeResponseMessage(
+                text=f'正在学习 {message.file_name}，完成后会通知你'
+            )
+            yield await self._learn(
+                conversation_id=conversation_id, message=message
+            )
+            return
+
+        chain = (
+            await self._get_chain(conversation_id)
+            if isinstance(message, TextRequestMessage)
+            and not message.text.strip().startswith('/')
+            else None
+        )
+        if chain is None:
+            yield await self.respond(
+                conversation_id=conversation_id, message=message
+            )
+            return
+
+        async for text in arun_stream(chain, message.text):
+            yield TextResponseMessage(text=text)
+
+    def stats(self) -> dict[str, typing.Any]:
+        return {
+            'indexes': self.indexes.stats() if self.indexes else None,
+            'embedding': self.batcher.stats() if self.batcher else None,
+            'embedding_cache': self.embedding_cache.stats()
+            if self.embedding_cache is not None
+            else None,
+            'retrieval_cache': self.retrieval_cache.stats()
+            if self.retrieval_cache is not None
+            else None,
+        }
+
+    async def _initialize(self) -> None:
+        self.executor = get_executor(
+            self.index_executor, max_workers=self.index_workers
+        )
+        self.memory_executor = (
+            get_executor('thread', max_workers=self.index_workers)
+            if isinstance(
+                self.executor, concurrent.futures.ProcessPoolExecutor
+            )
+            else self.executor
+        )
+        # Lexical retrieval runs locally, without any embedding calls.
+        if self.retrieval != 'bm25':
+            self._initialize_embeddings()
+        self.indexes = SharedIndexRegistry.get_registry(
+            self.vector_store,
+            embeddings=self.embeddings,
+            path=self.index_path,
+            max_indexes=self.max_indexes,
+            max_bytes=self.max_index_bytes,
+            idle_ttl=self.index_idle_ttl,
+            retrieval=self.retrieval,
+            cache=self.retrieval_cache,
+            dtype=self.vector_dtype,
+        )
+
+    def _initialize_embeddings(self) -> None:
+        """Creates embeddings that batch, retry, and optionally cache embedding requests."""
+        # Each call of the underlying embeddings is one request, batching and retries are done by the batcher.
+        embeddings = OpenAIEmbeddings(
+            openai_api_key=settings.policy.llm.openai_api_key,
+            chunk_size=self.embedding_batch_size,
+            max_retries=1,
+        )
+        self.batcher = BatchingEmbeddings(
+            embeddings=embeddings,
+            batch_size=self.embedding_batch_size,
+            max_concurrency=self.embedding_concurrency,
+            batch_delay=self.embedding_batch_delay / 1000,
+            max_retries=self.embedding_max_retries,
+        )
+        self.embeddings = self.batcher
+        if self.embedding_cache_path is not None:
+            self.embedding_cache = SQLiteEmbeddingCache(
+                path=self.embedding_cache_path
+            )
+            # Unchanged chunks of revised documents are not embedded again.
+            self.embeddings = CachedEmbeddings(
+                embeddings=self.batcher,
+                cache=self.embedding_cache,
+                model=embeddings.model,
+            )
+
+    async def _finalize(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.memory_executor.shutdown(wait=False, cancel_futures=True)
+        await self.indexes.close()
+        if self.embedding_cache is not None:
+            self.embedding_cache.close()
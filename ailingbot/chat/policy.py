@@ -1,6 +1,7 @@
 from __future__ import annotations
 
 import abc
+import typing
 
 from ailingbot.chat.messages import RequestMessage, ResponseMessage
 from ailingbot.shared.abc import AbstractAsyncComponent
@@ -28,6 +29,33 @@ class ChatPolicy(AbstractAsyncComponent, abc.ABC):
         """
         raise NotImplementedError
 
+    async def respond_stream(
+        self, *, conversation_id: str, message: RequestMessage
+    ) -> typing.AsyncIterator[ResponseMessage]:
+        """Responding to user inputs incrementally.
+
+        Yields responses containing the partial result generated so far, the last yielded response is the final one.
+        Policies that can not respond incrementally yield the result of respond once.
+
+        :param conversation_id:
+        :type conversation_id:
+        :param message: Request message.
+        :type message: RequestMessage
+        :return: Async iterator of response messages.
+        :rtype: typing.AsyncIterator[ResponseMessage]
+        """
+        yield await self.respond(
+            conversation_id=conversation_id, message=message
+        )
+
+    def stats(self) -> dict[str, typing.Any]:
+        """Gets runtime statistics of the policy.
+
+        :return: Statistics.
+        :rtype: dict
+        """
+        return {}
+
     @staticmethod
     def get_policy(name: str, *, debug: bool = False) -> ChatPolicy:
         """Gets policy instance.
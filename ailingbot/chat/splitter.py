@@ -0,0 +1,167 @@
+from __future__ import annotations
+
+import bisect
+import re
+import threading
+import typing
+
+import numpy as np
+import tiktoken
+from langchain.text_splitter import CharacterTextSplitter, TextSplitter
+
+from ailingbot.shared.misc import get_class_dynamically
+
+# Ends of sentences: CJK terminators, Latin terminators followed by whitespace, and line breaks. Closing quotes and
+# brackets stay with their sentence.
+_SENTENCE_END = re.compile(r'[。！？；…]+[”’」』）》]*|[.!?;]+[\'")\]]*(?=\s)|\n+')
+# Ends of words, used when no sentence end fits in a chunk.
+_WORD_END = re.compile(r'[，、：,:]|\s+')
+
+# Encoding name -> byte length of each token.
+_token_lengths: dict[str, np.ndarray] = {}
+_token_lengths_lock = threading.Lock()
+
+
+def _get_token_lengths(encoding: tiktoken.Encoding) -> np.ndarray:
+    """Gets byte length of each token of encoding, computed once per process."""
+    with _token_lengths_lock:
+        if encoding.name not in _token_lengths:
+            lengths = np.zeros(encoding.n_vocab, dtype=np.int64)
+            for token in range(encoding.n_vocab):
+                try:
+                    lengths[token] = len(
+                        encoding.decode_single_token_bytes(token)
+                    )
+                except KeyError:
+                    # Unused token IDs.
+                    pass
+            _token_lengths[encoding.name] = lengths
+        return _token_lengths[encoding.name]
+
+
+class TiktokenTextSplitter(TextSplitter):
+    """Splits text into chunks of at most chunk size tiktoken tokens, preferring to cut at sentence ends.
+
+    Each text is encoded once. Sentence ends are mapped to token positions through a table of byte lengths of tokens,
+    and chunks are cut from the token array and the UTF-8 bytes of text, so no candidate is encoded again. Chunks are cut
+    at the last sentence end that fits in chunk size, else at the last word end, else at chunk size. Cuts are
+    moved to character boundaries, so a chunk may exceed chunk size by the token holding the rest of a character.
+    """
+
+    def __init__(
+        self,
+        encoding: typing.Union[str, tiktoken.Encoding] = 'cl100k_base',
+        **kwargs: typing.Any,
+    ):
+        """Init.
+
+        :param encoding: Tiktoken encoding or its name.
+        :type encoding: typing.Union[str, tiktoken.Encoding]
+        """
+        super(TiktokenTextSplitter, self).__init__(**kwargs)
+
+        self.encoding = (
+            tiktoken.get_encoding(encoding)
+            if isinstance(encoding, str)
+            else encoding
+        )
+
+    def split_text(self, text: str) -> list[str]:
+        data = text.encode('utf-8')
+        tokens = self.encoding.encode_ordinary(text)
+        n = len(tokens)
+        if n == 0:
+            return []
+        # Byte offset where each token ends.
+        ends = np.cumsum(_get_token_lengths(self.encoding)[tokens])
+        # Byte offset where each character ends.
+        code_points = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+        char_ends = np.cumsum(
+            1
+            + (code_points >= 0x80)
+            + (code_points >= 0x800)
+            + (code_points >= 0x10000)
+        )
+
+        cuts = self._cuts(_SENTENCE_END, text, ends, char_ends)
+        word_cuts = self._cuts(_WORD_END, text, ends, char_ends)
+
+        chunks = []
+        start = end = 0
+        while start < n:
+            # Each chunk ends after the previous one, so that overlaps do not repeat it.
+            previous_end = end
+            end = min(start + self._chunk_size, n)
+            if end < n:
+                for candidates in (cuts, word_cuts):
+                    i = bisect.bisect_right(candidates, end) - 1
+                    if i >= 0 and candidates[i] > max(start, previous_end):
+                        end = candidates[i]
+                        break
+            chunk = data[
+                self._char_boundary(
+                    data, int(ends[start - 1]) if start else 0
+                ) : self._char_boundary(data, int(ends[end - 1]))
+            ]
+            chunk = chunk.decode('utf-8').strip()
+            if chunk:
+                chunks.append(chunk)
+            if end >= n:
+                break
+
+            # Overlaps with the previous chunk from the first sentence or word end in overlap, if any.
+            next_start = max(end - self._chunk_overlap, start + 1)
+            for candidates in (cuts, word_cuts):
+                i = bisect.bisect_left(candidates, next_start)
+                if i < len(candidates) and candidates[i] < end:
+                    next_start = candidates[i]
+                    break
+            start = next_start
+        return chunks
+
+    @staticmethod
+    def _cuts(
+        pattern: re.Pattern,
+        text: str,
+        ends: np.ndarray,
+        char_ends: np.ndarray,
+    ) -> list[int]:
+        """Gets token positions after which matches of pattern end."""
+        offsets = char_ends[[m.end() - 1 for m in pattern.finditer(text)]]
+        return np.searchsorted(ends, offsets, side='right').tolist()
+
+    @staticmethod
+    def _char_boundary(data: bytes, offset: int) -> int:
+        """Moves offset forward past UTF-8 continuation bytes, to the start of the next character."""
+        while offset < len(data) and 0x80 <= data[offset] < 0xC0:
+            offset += 1
+        return offset
+
+
+def get_text_splitter(
+    name: str, *, chunk_size: int, chunk_overlap: int
+) -> TextSplitter:
+    """Gets text splitter that splits pages into chunks.
+
+    :param name: `character` which measures chunk size in characters, `tiktoken` which measures it in tokens, or
+        full path of splitter class.
+    :type name: str
+    :param chunk_size: Chunk size.
+    :type chunk_size: int
+    :param chunk_overlap: Chunk overlap.
+    :type chunk_overlap: int
+    :return: Text splitter.
+    :rtype: TextSplitter
+    """
+    if name.lower() == 'character':
+        return CharacterTextSplitter(
+            chunk_size=chunk_size, chunk_overlap=chunk_overlap
+        )
+    elif name.lower() == 'tiktoken':
+        return TiktokenTextSplitter(
+            chunk_size=chunk_size, chunk_overlap=chunk_overlap
+        )
+    else:
+        return get_class_dynamically(name)(
+            chunk_size=chunk_size, chunk_overlap=chunk_overlap
+        )
@@ -0,0 +1,55 @@
+from __future__ import annotations
+
+import asyncio
+import typing
+
+from langchain.callbacks.base import AsyncCallbackHandler
+from langchain.chains.base import Chain
+
+
+class TokenQueueCallbackHandler(AsyncCallbackHandler):
+    """Callback handler that puts new LLM tokens into a queue."""
+
+    def __init__(self):
+        self.queue: asyncio.Queue[str] = asyncio.Queue()
+
+    async def on_llm_new_token(self, token: str, **kwargs: typing.Any) -> None:
+        self.queue.put_nowait(token)
+
+
+async def arun_stream(
+    chain: Chain, *args: typing.Any, **kwargs: typing.Any
+) -> typing.AsyncIterator[str]:
+    """Runs chain, and yields the text generated so far whenever the LLM outputs new tokens.
+
+    The last yielded text is always the chain output. Tokens are only produced when the LLM is configured with
+    streaming enabled, otherwise only the chain output is yielded.
+
+    :param chain: Chain to run.
+    :type chain: Chain
+    :return: Async iterator of generated text.
+    :rtype: typing.AsyncIterator[str]
+    """
+    handler = TokenQueueCallbackHandler()
+    task = asyncio.create_task(
+        chain.arun(*args, callbacks=[handler], **kwargs)
+    )
+    text = ''
+    getter: typing.Optional[asyncio.Future] = None
+    try:
+        while True:
+            getter = asyncio.ensure_future(handler.queue.get())
+            done, _ = await asyncio.wait(
+                [getter, task], return_when=asyncio.FIRST_COMPLETED
+            )
+            if getter not in done:
+                getter.cancel()
+                break
+            text += getter.result()
+            yield text
+        yield task.result()
+    finally:
+        if getter is not None and not getter.done():
+            getter.cancel()
+        if not task.done():
+            task.cancel()
@@ -0,0 +1,274 @@
+from __future__ import annotations
+
+import json
+import os
+import typing
+
+import numpy as np
+from langchain.docstore.document import Document
+from langchain.embeddings.base import Embeddings
+from langchain.vectorstores.base import VectorStore
+
+from ailingbot.shared.errors import ConfigValidationError
+
+
+class NumpyVectorStore(VectorStore):
+    """Vector store that keeps normalized embeddings in one contiguous NumPy matrix.
+
+    Similarity is cosine, computed for all rows with one matrix-vector product, and top k rows are selected with
+    argpartition. Vectors can be stored as float32, float16, or int8 with a float32 scale per row; the smaller types
+    cut memory at the cost of converting the matrix to float32 on each query. Saved stores are loaded through
+    memory-mapped .npy files.
+    """
+
+    def __init__(
+        self,
+        *,
+        embedding: Embeddings,
+        dtype: str = 'float32',
+        matrix: typing.Optional[np.ndarray] = None,
+        scales: typing.Optional[np.ndarray] = None,
+        texts: typing.Optional[list[str]] = None,
+        metadatas: typing.Optional[list[dict]] = None,
+    ):
+        """Init.
+
+        :param embedding: Embeddings used to embed texts and queries.
+        :type embedding: Embeddings
+        :param dtype: Storage type of vectors, `float32`, `float16` or `int8`.
+        :type dtype: str
+        :param matrix: Stored vectors.
+        :type matrix: typing.Optional[np.ndarray]
+        :param scales: Scale of each row of int8 vectors.
+        :type scales: typing.Optional[np.ndarray]
+        :param texts: Text of each row.
+        :type texts: typing.Optional[list[str]]
+        :param metadatas: Metadata of each row.
+        :type metadatas: typing.Optional[list[dict]]
+        """
+        if dtype not in ('float32', 'float16', 'int8'):
+            raise ConfigValidationError(
+                f'Unsupported vector dtype: {dtype}', critical=True
+            )
+        self.embedding = embedding
+        self.dtype = dtype
+        self.matrix = matrix
+        self.scales = scales
+        self.texts: list[str] = texts or []
+        self.metadatas: list[dict] = metadatas or [{} for _ in self.texts]
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    @property
+    def nbytes(self) -> int:
+        """Estimated memory size of vectors and texts in bytes."""
+        size = sum(len(t) for t in self.texts)
+        for array in (self.matrix, self.scales):
+            if array is not None:
+                size += array.nbytes
+        return size
+
+    def _quantize(
+        self, vectors: np.ndarray
+    ) -> tuple[np.ndarray, typing.Optional[np.ndarray]]:
+        """Normalizes vectors, and converts them to the storage type."""
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms == 0, 1, norms)
+        if self.dtype != 'int8':
+            return vectors.astype(self.dtype), None
+        scales = np.abs(vectors).max(axis=1) / 127
+        scales[scales == 0] = 1
+        return (
+            np.round(vectors / scales[:, None]).astype(np.int8),
+            scales.astype(np.float32),
+        )
+
+    def add_vectors(
+        self,
+        vectors: list[list[float]],
+        texts: list[str],
+        metadatas: typing.Optional[list[dict]] = None,
+    ) -> None:
+        """Adds texts with vectors computed beforehand.
+
+        :param vectors: Vector of each text.
+        :type vectors: list[list[float]]
+        :param texts: Texts.
+        :type texts: list[str]
+        :param metadatas: Metadata of each text.
+        :type metadatas: typing.Optional[list[dict]]
+        """
+        if not texts:
+            return
+        matrix, scales = self._quantize(np.asarray(vectors, dtype=np.float32))
+        if self.matrix is None:
+            self.matrix, self.scales = matrix, scales
+        else:
+            self.matrix = np.concatenate([self.matrix, matrix])
+            if scales is not None:
+                self.scales = np.concatenate([self.scales, scales])
+        self.texts.extend(texts)
+        self.metadatas.extend(metadatas or [{} for _ in texts])
+
+    def add_texts(
+        self,
+        texts: typing.Iterable[str],
+        metadatas: typing.Optional[list[dict]] = None,
+        **kwargs: typing.Any,
+    ) -> list[str]:
+        texts = list(texts)
+        self.add_vectors(
+            self.embedding.embed_documents(texts), texts, metadatas
+        )
+        return [str(x) for x in range(len(self) - len(texts), len(self))]
+
+    async def aadd_texts(
+        self,
+        texts: typing.Iterable[str],
+        metadatas: typing.Optional[list[dict]] = None,
+        **kwargs: typing.Any,
+    ) -> list[str]:
+        texts = list(texts)
+        self.add_vectors(
+            await self.embedding.aembed_documents(texts), texts, metadatas
+        )
+        return [str(x) for x in range(len(self) - len(texts), len(self))]
+
+    def similarity_search_with_score_by_vector(
+        self, embedding: list[float], k: int = 4
+    ) -> list[tuple[Document, float]]:
+        """Gets the k most similar documents to vector, with their cosine similarity.
+
+        :param embedding: Query vector.
+        :type embedding: list[float]
+        :param k: Number of documents.
+        :type k: int
+        :return: Documents and similarity scores, most similar first.
+        :rtype: list[tuple[Document, float]]
+        """
+        k = min(k, len(self))
+        if k <= 0:
+            return []
+        query = np.asarray(embedding, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1
+        scores = self.matrix @ query
+        if self.scales is not None:
+            scores *= self.scales
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [
+            (
+                Document(
+                    page_content=self.texts[i],
+                    metadata=self.metadatas[i],
+                ),
+                float(scores[i]),
+            )
+            for i in top
+        ]
+
+    def similarity_search_by_vector(
+        self, embedding: list[float], k: int = 4, **kwargs: typing.Any
+    ) -> list[Document]:
+        return [
+            d
+            for d, _ in self.similarity_search_with_score_by_vector(
+                embedding, k
+            )
+        ]
+
+    def similarity_search(
+        self, query: str, k: int = 4, **kwargs: typing.Any
+    ) -> list[Document]:
+        return self.similarity_search_by_vector(
+            self.embedding.embed_query(query), k
+        )
+
+    async def asimilarity_search(
+        self, query: str, k: int = 4, **kwargs: typing.Any
+    ) -> list[Document]:
+        return self.similarity_search_by_vector(
+            await self.embedding.aembed_query(query), k
+        )
+
+    def _similarity_search_with_relevance_scores(
+        self, query: str, k: int = 4, **kwargs: typing.Any
+    ) -> list[tuple[Document, float]]:
+        return self.similarity_search_with_score_by_vector(
+            self.embedding.embed_query(query), k
+        )
+
+    def save(self, path: str) -> None:
+        """Saves the store in a directory.
+
+        :param path: Directory path.
+        :type path: str
+        """
+        os.makedirs(path, exist_ok=True)
+        if self.matrix is not None:
+            np.save(os.path.join(path, 'vectors.npy'), self.matrix)
+        if self.scales is not None:
+            np.save(os.path.join(path, 'scales.npy'), self.scales)
+        with open(
+            os.path.join(path, 'documents.json'), 'w', encoding='utf-8'
+        ) as f:
+            json.dump(
+                {
+                    'dtype': self.dtype,
+                    'texts': self.texts,
+                    'metadatas': self.metadatas,
+                },
+                f,
+                ensure_ascii=False,
+            )
+
+    @classmethod
+    def load(
+        cls, path: str, *, embedding: Embeddings, mmap: bool = True
+    ) -> NumpyVectorStore:
+        """Loads a store saved in a directory.
+
+        :param path: Directory path.
+        :type path: str
+        :param embedding: Embeddings used to embed texts and queries.
+        :type embedding: Embeddings
+        :param mmap: Whether to memory-map vectors instead of reading them into memory.
+        :type mmap: bool
+        :return: Store.
+        :rtype: NumpyVectorStore
+        """
+        with open(
+            os.path.join(path, 'documents.json'), 'r', encoding='utf-8'
+        ) as f:
+            documents = json.load(f)
+        mmap_mode = 'r' if mmap else None
+        matrix = scales = None
+        if os.path.exists(os.path.join(path, 'vectors.npy')):
+            matrix = np.load(
+                os.path.join(path, 'vectors.npy'), mmap_mode=mmap_mode
+            )
+        if os.path.exists(os.path.join(path, 'scales.npy')):
+            scales = np.load(
+                os.path.join(path, 'scales.npy'), mmap_mode=mmap_mode
+            )
+        return cls(
+            embedding=embedding,
+            dtype=documents['dtype'],
+            matrix=matrix,
+            scales=scales,
+            texts=documents['texts'],
+            metadatas=documents['metadatas'],
+        )
+
+    @classmethod
+    def from_texts(
+        cls,
+        texts: list[str],
+        embedding: Embeddings,
+        metadatas: typing.Optional[list[dict]] = None,
+        **kwargs: typing.Any,
+    ) -> NumpyVectorStore:
+        store = cls(embedding=embedding, dtype=kwargs.get('dtype', 'float32'))
+        store.add_texts(texts, metadatas)
+        return store
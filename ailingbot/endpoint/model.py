@@ -12,6 +12,7 @@ class RequestMessageType(enum.Enum):
 class ResponseMessageType(enum.Enum):
     TEXT = 'text'
     FALLBACK = 'fallback'
+    SILENCE = 'silence'
 
 
 class ChatRequest(BaseModel):
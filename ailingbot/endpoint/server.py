@@ -12,6 +12,7 @@ from ailingbot.chat.messages import (
     TextResponseMessage,
     FileRequestMessage,
     FallbackResponseMessage,
+    SilenceResponseMessage,
 )
 from ailingbot.endpoint.model import (
     RequestMessageType,
@@ -19,6 +20,8 @@ from ailingbot.endpoint.model import (
     ChatRequest,
     ChatResponse,
 )
+from ailingbot.shared.download import download
+from ailingbot.shared.errors import FileTooLargeError
 
 bot = ChatBot()
 app = FastAPI(title='AilingBot')
@@ -100,12 +103,17 @@ async def chat(request: ChatRequest) -> ChatResponse:
                 ) as r:
                     if not r.ok:
                         r.raise_for_status()
-                    file_content = await r.content.read()
+                    file_content = await download(r)
         except ClientError as e:
             raise HTTPException(
                 status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
                 detail=str(e),
             )
+        except FileTooLargeError as e:
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail=str(e),
+            )
 
         req = FileRequestMessage(
             uuid=_uuid,
@@ -123,7 +131,14 @@ async def chat(request: ChatRequest) -> ChatResponse:
             detail=f'Request message type {request.type} is not supported.',
         )
 
-    res = await bot.chat(conversation_id=conversation_id, message=req)
+    try:
+        res = await bot.chat(
+            conversation_id=conversation_id, message=req, lane='api'
+        )
+    finally:
+        # Deletes the temporary file the download may be spooled into.
+        if isinstance(req, FileRequestMessage):
+            req.content.close()
     response = ChatResponse(
         conversation_id=conversation_id,
         uuid=res.uuid,
@@ -140,6 +155,8 @@ async def chat(request: ChatRequest) -> ChatResponse:
         response.type = ResponseMessageType.FALLBACK.value
         response.reason = res.reason
         response.suggestion = res.suggestion
+    elif isinstance(res, SilenceResponseMessage):
+        response.type = ResponseMessageType.SILENCE.value
     else:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -147,3 +164,12 @@ async def chat(request: ChatRequest) -> ChatResponse:
         )
 
     return response
+
+
+@app.get(
+    '/stats/',
+    status_code=status.HTTP_200_OK,
+    tags=['Stats'],
+)
+async def stats() -> dict:
+    return bot.stats()
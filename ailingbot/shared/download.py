@@ -0,0 +1,66 @@
+from __future__ import annotations
+
+import io
+import tempfile
+import typing
+
+import aiohttp
+
+from ailingbot.config import settings
+from ailingbot.shared.errors import FileTooLargeError
+
+
+async def download(
+    response: aiohttp.ClientResponse,
+    *,
+    max_size: typing.Optional[int] = None,
+    spool_size: typing.Optional[int] = None,
+    chunk_size: int = 64 * 1024,
+) -> typing.BinaryIO:
+    """Streams response body into a file, in memory while small, and in a temporary file on disk once larger.
+
+    The download is aborted as soon as the body, or its declared Content-Length, exceeds max size. The temporary file
+    is deleted when closed.
+
+    :param response: HTTP response.
+    :type response: aiohttp.ClientResponse
+    :param max_size: Maximum bytes of file, 0 means unlimited, defaults to `download.max_size`.
+    :type max_size: typing.Optional[int]
+    :param spool_size: Bytes kept in memory before spilling to disk, defaults to `download.spool_size`.
+    :type spool_size: typing.Optional[int]
+    :param chunk_size: Bytes read at a time.
+    :type chunk_size: int
+    :return: File positioned at the start, io.BytesIO if in memory, otherwise a named temporary file.
+    :rtype: typing.BinaryIO
+    """
+    if max_size is None:
+        max_size = settings.get('download.max_size', 100 * 1024 * 1024)
+    if spool_size is None:
+        spool_size = settings.get('download.spool_size', 8 * 1024 * 1024)
+
+    def _check_size(size: int) -> None:
+        if max_size and size > max_size:
+            raise FileTooLargeError(
+                f'文件大小超过{max_size / 1024 / 1024:.0f}MB的限制',
+                suggestion=f'请上传不超过{max_size / 1024 / 1024:.0f}MB的文件',
+            )
+
+    if response.content_length is not None:
+        _check_size(response.content_length)
+
+    file: typing.BinaryIO = io.BytesIO()
+    size = 0
+    try:
+        async for chunk in response.content.iter_chunked(chunk_size):
+            size += len(chunk)
+            _check_size(size)
+            if isinstance(file, io.BytesIO) and size > spool_size:
+                spilled = tempfile.NamedTemporaryFile(prefix='ailingbot-')
+                spilled.write(file.getbuffer())
+                file = spilled
+            file.write(chunk)
+    except BaseException:
+        file.close()
+        raise
+    file.seek(0)
+    return file
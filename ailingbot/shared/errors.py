@@ -30,6 +30,24 @@ class ExternalHTTPAPIError(AilingBotError):
     pass
 
 
+class InvalidAccessTokenError(ExternalHTTPAPIError):
+    """Raised when external api reports the access token as invalid or expired."""
+
+    pass
+
+
+class CircuitOpenError(ExternalHTTPAPIError):
+    """Raised when calls to external api are suspended after repeated failures."""
+
+    pass
+
+
+class FileTooLargeError(AilingBotError):
+    """Raised when downloaded file exceeds the size limit."""
+
+    pass
+
+
 class EmptyQueueError(AilingBotError):
     """Raised when queue is empty no more message to consume."""
 
@@ -42,6 +60,12 @@ class FullQueueError(AilingBotError):
     pass
 
 
+class QueueTimeoutError(AilingBotError):
+    """Raised when waiting in queue longer than the deadline."""
+
+    pass
+
+
 class BrokerError(AilingBotError):
     """Raised when connecting to broker or broker operation failed."""
 
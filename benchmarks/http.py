@@ -0,0 +1,86 @@
+"""Benchmarks HTTP sessions of channel agents: latency of a fresh session per request versus one pooled session.
+
+Run with `python -m benchmarks.http`. By default requests go to a local server, which only measures the cost of
+opening connections and sessions; pass `--url` with an HTTPS endpoint, such as the Feishu or Slack API, to include DNS
+lookups and TLS handshakes.
+"""
+import argparse
+import asyncio
+import statistics
+import time
+import typing
+
+import aiohttp
+from aiohttp import web
+
+
+async def _handle(_: web.Request) -> web.Response:
+    return web.json_response({'ok': True})
+
+
+async def _fresh(url: str, requests: int) -> list[float]:
+    latencies = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        async with aiohttp.ClientSession() as session:
+            async with session.get(url) as response:
+                await response.read()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+async def _pooled(url: str, requests: int) -> list[float]:
+    from ailingbot.channels.channel import ChannelAgent
+
+    class _Agent(ChannelAgent):
+        async def send_message(self, message: typing.Any) -> None:
+            pass
+
+    agent = _Agent()
+    await agent.initialize()
+    latencies = []
+    try:
+        for _ in range(requests):
+            start = time.perf_counter()
+            async with agent._get_session().get(url) as response:
+                await response.read()
+            latencies.append(time.perf_counter() - start)
+    finally:
+        await agent.finalize()
+    return latencies
+
+
+async def _main(url: typing.Optional[str], requests: int) -> None:
+    runner = None
+    if url is None:
+        app = web.Application()
+        app.router.add_get('/', _handle)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        url = f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}/'
+
+    print(f'{"session":<10}{"p50 ms":>10}{"p95 ms":>10}')
+    try:
+        for name, run in (('fresh', _fresh), ('pooled', _pooled)):
+            latencies = sorted(await run(url, requests))
+            print(
+                f'{name:<10}{statistics.median(latencies) * 1000:>10.3f}'
+                f'{latencies[int(len(latencies) * 0.95)] * 1000:>10.3f}'
+            )
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--url', default=None)
+    parser.add_argument('--requests', type=int, default=200)
+    args = parser.parse_args()
+    asyncio.run(_main(args.url, args.requests))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""Benchmarks text splitters of document QA policy: throughput and token size of chunks.
+
+Run with `python -m benchmarks.splitter`. Pages of mixed Chinese and English text are split by the `character`
+splitter, the `tiktoken` splitter, and LangChain's recursive splitter measuring length with tiktoken, which encodes
+every candidate chunk again. Pass `--encoding bytes` to use a byte level encoding when tiktoken encodings can not be
+downloaded.
+"""
+import argparse
+import random
+import statistics
+import time
+import typing
+
+import tiktoken
+from langchain.text_splitter import (
+    CharacterTextSplitter,
+    RecursiveCharacterTextSplitter,
+    TextSplitter,
+)
+
+from ailingbot.chat.splitter import TiktokenTextSplitter
+
+CHINESE = [
+    '员工每年享有十天带薪年假，入职满五年后增加到十五天。',
+    '报销需要在费用发生后三十天内提交，并附上发票原件。',
+    '出差期间的住宿标准根据城市等级确定，超出部分需自行承担。',
+    '绩效评估每半年进行一次，结果将作为调薪和晋升的依据！',
+]
+ENGLISH = [
+    'Annual leave requests must be approved by the direct manager.',
+    'Expense claims without receipts will not be reimbursed.',
+    'Remote work is allowed up to two days per week; exceptions need approval.',
+    'Security training is mandatory for all employees every year.',
+]
+
+
+def _pages(count: int, sentences: int) -> list[str]:
+    """Makes pages of random sentences, with a paragraph break every few sentences."""
+    rng = random.Random(0)
+    pages = []
+    for _ in range(count):
+        parts = []
+        for x in range(sentences):
+            parts.append(rng.choice(rng.choice([CHINESE, ENGLISH])))
+            parts.append('\n\n' if x % 8 == 7 else ' ')
+        pages.append(''.join(parts))
+    return pages
+
+
+def _get_encoding(name: str) -> tiktoken.Encoding:
+    if name == 'bytes':
+        return tiktoken.Encoding(
+            'bytes',
+            pat_str=r'\S+|\s+',
+            mergeable_ranks={bytes([x]): x for x in range(256)},
+            special_tokens={},
+        )
+    return tiktoken.get_encoding(name)
+
+
+def _run(
+    name: str,
+    splitter: TextSplitter,
+    pages: list[str],
+    encoding: tiktoken.Encoding,
+) -> dict[str, typing.Any]:
+    start = time.perf_counter()
+    chunks = [c for page in pages for c in splitter.split_text(page)]
+    elapsed = time.perf_counter() - start
+
+    tokens = sorted(len(encoding.encode_ordinary(c)) for c in chunks)
+    return {
+        'splitter': name,
+        'pages_per_s': len(pages) / elapsed,
+        'mb_per_s': sum(len(p.encode('utf-8')) for p in pages)
+        / elapsed
+        / 1024
+        / 1024,
+        'chunks': len(chunks),
+        'mean_tokens': statistics.mean(tokens),
+        'p95_tokens': tokens[int(len(tokens) * 0.95)],
+        'max_tokens': tokens[-1],
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--pages', type=int, default=200)
+    parser.add_argument('--sentences', type=int, default=60)
+    parser.add_argument('--chunk-size', type=int, default=500)
+    parser.add_argument('--chunk-overlap', type=int, default=50)
+    parser.add_argument('--encoding', default='cl100k_base')
+    args = parser.parse_args()
+
+    encoding = _get_encoding(args.encoding)
+    pages = _pages(args.pages, args.sentences)
+    splitters = {
+        'character': CharacterTextSplitter(
+            chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap
+        ),
+        'tiktoken': TiktokenTextSplitter(
+            encoding,
+            chunk_size=args.chunk_size,
+            chunk_overlap=args.chunk_overlap,
+        ),
+        'recursive-tiktoken': RecursiveCharacterTextSplitter(
+            chunk_size=args.chunk_size,
+            chunk_overlap=args.chunk_overlap,
+            length_function=lambda x: len(encoding.encode_ordinary(x)),
+        ),
+    }
+
+    print(
+        f'{"splitter":<20}{"pages/s":>10}{"MB/s":>8}{"chunks":>8}'
+        f'{"mean tok":>10}{"p95 tok":>9}{"max tok":>9}'
+    )
+    for name, splitter in splitters.items():
+        r = _run(name, splitter, pages, encoding)
+        print(
+            f'{r["splitter"]:<20}{r["pages_per_s"]:>10.1f}{r["mb_per_s"]:>8.2f}'
+            f'{r["chunks"]:>8}{r["mean_tokens"]:>10.1f}{r["p95_tokens"]:>9}'
+            f'{r["max_tokens"]:>9}'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+"""Benchmarks vector stores of document QA policy: build time, query latency and RSS.
+
+Run with `python -m benchmarks.vectorstore`. Each store is measured in a fresh process, so that RSS growth is not
+affected by other stores. Chroma is skipped if chromadb is not installed.
+"""
+import argparse
+import concurrent.futures
+import os
+import resource
+import statistics
+import time
+import typing
+import uuid
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+
+class RandomEmbeddings(Embeddings):
+    """Embeddings that returns random unit vectors, so that no API is called."""
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        self.rng = np.random.default_rng(0)
+
+    def _random(self, n: int) -> list[list[float]]:
+        vectors = self.rng.standard_normal((n, self.dim), dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors.tolist()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self._random(len(texts))
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._random(1)[0]
+
+
+def _rss() -> int:
+    """Gets current RSS in bytes."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        # Falls back to peak RSS, in kilobytes on Linux and bytes on macOS.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _run(
+    backend: str, chunks: int, dim: int, queries: int, k: int
+) -> dict[str, typing.Any]:
+    embeddings = RandomEmbeddings(dim)
+    texts = [f'chunk {x}' for x in range(chunks)]
+    vectors = embeddings.embed_documents(texts)
+    query_vectors = [embeddings.embed_query('') for _ in range(queries)]
+
+    rss_before = _rss()
+    start = time.perf_counter()
+    if backend == 'chroma':
+        import chromadb
+        import chromadb.config
+
+        client = chromadb.Client(chromadb.config.Settings())
+        collection = client.create_collection(f'benchmark-{uuid.uuid4()}')
+        collection.add(
+            ids=[str(x) for x in range(chunks)],
+            embeddings=vectors,
+            documents=texts,
+        )
+
+        def _query(v):
+            return collection.query(query_embeddings=[v], n_results=k)
+
+    else:
+        from ailingbot.chat.vectorstore import NumpyVectorStore
+
+        store = NumpyVectorStore(
+            embedding=embeddings, dtype=backend.split('-')[1]
+        )
+        store.add_vectors(vectors, texts)
+
+        def _query(v):
+            return store.similarity_search_by_vector(v, k)
+
+    build_time = time.perf_counter() - start
+
+    latencies = []
+    for v in query_vectors:
+        start = time.perf_counter()
+        _query(v)
+        latencies.append(time.perf_counter() - start)
+    latencies.sort()
+
+    return {
+        'backend': backend,
+        'build_ms': build_time * 1000,
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p95_ms': latencies[int(len(latencies) * 0.95)] * 1000,
+        'rss_mb': (_rss() - rss_before) / 1024 / 1024,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--chunks', type=int, default=500)
+    parser.add_argument('--dim', type=int, default=1536)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=4)
+    args = parser.parse_args()
+
+    backends = ['numpy-float32', 'numpy-float16', 'numpy-int8']
+    try:
+        import chromadb  # noqa: F401
+
+        backends.append('chroma')
+    except ImportError:
+        print('chromadb is not installed, skipping chroma.')
+
+    print(
+        f'{"backend":<16}{"build ms":>12}{"p50 ms":>12}{"p95 ms":>12}{"RSS MB":>12}'
+    )
+    for backend in backends:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1) as pool:
+            r = pool.submit(
+                _run, backend, args.chunks, args.dim, args.queries, args.k
+            ).result()
+        print(
+            f'{r["backend"]:<16}{r["build_ms"]:>12.2f}{r["p50_ms"]:>12.3f}'
+            f'{r["p95_ms"]:>12.3f}{r["rss_mb"]:>12.2f}'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+import io
+import json
+import typing
+
+import pytest
+
+from ailingbot.channels.channel import ChannelAgent, ChannelWebhookFactory
+from ailingbot.channels.feishu.agent import FeishuAgent
+from ailingbot.channels.slack.agent import SlackAgent
+from ailingbot.chat.messages import (
+    FallbackResponseMessage,
+    FileRequestMessage,
+    NoticeResponseMessage,
+    ResponseMessage,
+    MessageScope,
+    TextResponseMessage,
+)
+from ailingbot.config import settings
+from ailingbot.shared.errors import FileTooLargeError
+
+
+class RecordingAgent(ChannelAgent):
+    def __init__(self, *, editable: bool):
+        super(RecordingAgent, self).__init__()
+        self.editable = editable
+        self.supports_streaming = editable
+        self.stream_interval = 0
+        self.calls = []
+
+    async def send_message(self, message: ResponseMessage) -> None:
+        self.calls.append(('send', message))
+
+    async def _start_stream(self, message: TextResponseMessage) -> typing.Any:
+        if not self.editable:
+            raise NotImplementedError
+        self.calls.append(('start', message.text))
+        return 'handle'
+
+    async def _update_stream(
+        self, handle: typing.Any, message: TextResponseMessage
+    ) -> None:
+        self.calls.append(('update', message.text))
+
+
+async def _responses(*responses: ResponseMessage):
+    for r in responses:
+        yield r
+
+
+@pytest.mark.asyncio
+async def test_send_stream_editable():
+    agent = RecordingAgent(editable=True)
+    await agent.send_stream(
+        _responses(
+            TextResponseMessage(text='a'),
+            TextResponseMessage(text='ab'),
+            TextResponseMessage(text='abc'),
+        )
+    )
+    assert agent.calls == [('start', 'a'), ('update', 'ab'), ('update', 'abc')]
+
+
+@pytest.mark.asyncio
+async def test_send_stream_not_editable():
+    agent = RecordingAgent(editable=False)
+    final = TextResponseMessage(text='abc')
+    await agent.send_stream(_responses(TextResponseMessage(text='a'), final))
+    assert agent.calls == [('send', final)]
+    # Streaming is not attempted, so no call is spent on it.
+    assert agent.delivery.stats()['sent'] == 1
+
+
+@pytest.mark.asyncio
+async def test_send_stream_fallback_after_partial():
+    agent = RecordingAgent(editable=True)
+    final = FallbackResponseMessage(reason='error')
+    await agent.send_stream(_responses(TextResponseMessage(text='a'), final))
+    assert agent.calls == [('start', 'a'), ('send', final)]
+
+
+@pytest.mark.asyncio
+async def test_send_stream_notice():
+    agent = RecordingAgent(editable=True)
+    notice = NoticeResponseMessage(text='indexing')
+    final = TextResponseMessage(text='done')
+    await agent.send_stream(_responses(notice, final))
+    # The notice is sent on its own, and is not edited into the final response.
+    assert agent.calls == [('send', notice), ('send', final)]
+
+
+@pytest.mark.asyncio
+async def test_pooled_http_session():
+    from aiohttp import web
+
+    async def _handle(_):
+        return web.json_response({'ok': True})
+
+    app = web.Application()
+    app.router.add_get('/', _handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    agent = RecordingAgent(editable=False)
+    await agent.initialize()
+    try:
+        for _ in range(3):
+            async with agent._get_session().get(
+                f'http://127.0.0.1:{port}/'
+            ) as response:
+                assert (await response.json()) == {'ok': True}
+        stats = agent.stats()['http']
+        assert stats['requests'] == 3
+        assert stats['connections_created'] == 1
+        assert stats['connections_reused'] == 2
+    finally:
+        await agent.finalize()
+        await runner.cleanup()
+    assert agent.session is None
+
+
+@pytest.fixture
+def feishu_settings():
+    settings.set('channel', {'app_id': 'app', 'app_secret': 'secret'})
+    yield
+    settings.unset('channel')
+
+
+class StubFeishuAgent(FeishuAgent):
+    """Feishu agent with API calls stubbed, keeping its own rendering and sending helpers."""
+
+    def __init__(self):
+        super(StubFeishuAgent, self).__init__()
+        self.stream_interval = 0
+        self.calls = []
+
+    async def _send(self, *, receive_id_type: str, body: dict) -> str:
+        self.calls.append(('send', json.loads(body['content'])))
+        return 'message-id'
+
+    async def _reply(self, *, ack_uuid: str, body: dict) -> str:
+        self.calls.append(('reply', json.loads(body['content'])))
+        return 'message-id'
+
+    async def _patch(self, *, message_id: str, body: dict) -> None:
+        self.calls.append(('patch', message_id))
+
+
+@pytest.mark.asyncio
+async def test_send_stream_real_agent(feishu_settings):
+    agent = StubFeishuAgent()
+    await agent.send_stream(_responses(TextResponseMessage(text='done')))
+    assert agent.calls == [('send', {'text': 'done'})]
+
+    agent.calls.clear()
+    await agent.send_stream(
+        _responses(
+            TextResponseMessage(text='a', ack_uuid='request-id'),
+            TextResponseMessage(text='ab', ack_uuid='request-id'),
+        )
+    )
+    assert [c[0] for c in agent.calls] == ['reply', 'patch']
+    assert agent.stats()['delivery']['sent'] == 3
+
+
+class StubSlackAgent(SlackAgent):
+    """Slack agent with API calls stubbed."""
+
+    def __init__(self):
+        super(StubSlackAgent, self).__init__()
+        self.stream_interval = 0
+        self.calls = []
+
+    async def _send(
+        self, *, channel: str, thread_ts: str = '', text: str
+    ) -> str:
+        self.calls.append(('send', channel, text))
+        return 'ts'
+
+    async def _update(self, *, channel: str, ts: str, text: str) -> None:
+        self.calls.append(('update', channel, text))
+
+
+@pytest.mark.asyncio
+async def test_slack_delivery_buckets():
+    settings.set('channel', {'oauth_token': 'token'})
+    try:
+        agent = StubSlackAgent()
+        for channel in ['C1', 'C2']:
+            await agent.send_stream(
+                _responses(
+                    *[
+                        TextResponseMessage(
+                            text=text,
+                            scope=MessageScope.USER,
+                            echo={'channel': channel},
+                        )
+                        for text in ['a', 'ab']
+                    ]
+                )
+            )
+    finally:
+        settings.unset('channel')
+    assert agent.calls == [
+        ('send', 'C1', 'a'),
+        ('update', 'C1', 'ab'),
+        ('send', 'C2', 'a'),
+        ('update', 'C2', 'ab'),
+    ]
+    # Messages are rate limited per channel, edits by their own limit.
+    buckets = agent.delivery.buckets
+    assert set(buckets) == {
+        ('chat.postMessage', 'C1'),
+        ('chat.postMessage', 'C2'),
+        ('chat.update', None),
+    }
+    assert buckets[('chat.update', None)].rate == 50 / 60
+
+
+class EchoBot:
+    """Chat bot that answers with the file name of the request."""
+
+    async def chat_stream(self, *, conversation_id: str, message):
+        yield TextResponseMessage(
+            text=message.file_name, receiver_id=message.sender_id
+        )
+
+
+@pytest.mark.asyncio
+async def test_webhook_chat():
+    agent = RecordingAgent(editable=False)
+    address = {
+        'uuid': 'request-id',
+        'sender_id': 'user',
+        'scope': MessageScope.USER,
+        'echo': {'channel': 'C1'},
+    }
+    content = io.BytesIO(b'pdf')
+
+    async def _create_message():
+        return FileRequestMessage(
+            file_name='a.pdf', file_type='pdf', content=content
+        )
+
+    await ChannelWebhookFactory._chat(
+        agent=agent,
+        bot=EchoBot(),
+        conversation_id='1',
+        address=address,
+        create_message=_create_message,
+    )
+    assert [(c[0], c[1].text, c[1].receiver_id) for c in agent.calls] == [
+        ('send', 'a.pdf', 'user')
+    ]
+    # The downloaded file is closed once answered.
+    assert content.closed
+
+    # Errors of creating the request are sent back to the sender.
+    async def _too_large():
+        raise FileTooLargeError('文件太大', suggestion='请上传小一些的文件')
+
+    agent.calls.clear()
+    await ChannelWebhookFactory._chat(
+        agent=agent,
+        bot=EchoBot(),
+        conversation_id='1',
+        address=address,
+        create_message=_too_large,
+    )
+    [(kind, response)] = agent.calls
+    assert isinstance(response, FallbackResponseMessage)
+    assert response.suggestion == '请上传小一些的文件'
+    assert response.ack_uuid == 'request-id'
+    assert response.receiver_id == 'user'
+    assert response.echo == {'channel': 'C1'}
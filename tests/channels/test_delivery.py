@@ -0,0 +1,163 @@
+import asyncio
+import time
+
+import aiohttp
+import pytest
+
+from ailingbot.channels.delivery import DeliveryQueue
+from ailingbot.shared.errors import CircuitOpenError, FullQueueError
+
+
+def _response_error(status: int) -> aiohttp.ClientResponseError:
+    return aiohttp.ClientResponseError(
+        request_info=None, history=(), status=status
+    )
+
+
+class FlakyAPI:
+    """Fails with the given errors first, then succeeds."""
+
+    def __init__(self, *errors: Exception):
+        self.errors = list(errors)
+        self.calls = 0
+
+    async def call(self) -> str:
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return 'ok'
+
+
+@pytest.mark.asyncio
+async def test_rate_limit():
+    queue = DeliveryQueue(rate=20, burst=2)
+    api = FlakyAPI()
+    start = time.monotonic()
+    await asyncio.gather(*[queue.submit(api.call) for _ in range(6)])
+    # 2 calls in the burst, and 4 more at 20 per second.
+    assert time.monotonic() - start >= 0.19
+    assert queue.stats()['sent'] == 6
+    assert queue.stats()['throttled_seconds'] > 0
+
+
+@pytest.mark.asyncio
+async def test_keyed_buckets():
+    queue = DeliveryQueue(rate=10, burst=1, limits={'update': (100, 100)})
+    api = FlakyAPI()
+    start = time.monotonic()
+    # Buckets of different keys and names do not wait for each other.
+    await asyncio.gather(
+        queue.submit(api.call, bucket=('send', 'a')),
+        queue.submit(api.call, bucket=('send', 'b')),
+        *[queue.submit(api.call, bucket=('update', None)) for _ in range(5)],
+    )
+    assert time.monotonic() - start < 0.05
+    await queue.submit(api.call, bucket=('send', 'a'))
+    assert time.monotonic() - start >= 0.09
+    assert queue.stats()['buckets'] == 3
+
+
+@pytest.mark.asyncio
+async def test_retry():
+    queue = DeliveryQueue(rate=100, burst=100, backoff_base=0.01)
+    api = FlakyAPI(_response_error(503), _response_error(429))
+    assert await queue.submit(api.call) == 'ok'
+    assert api.calls == 3
+    assert queue.stats()['retries'] == 2
+
+    # Timeouts are retried only for idempotent calls, a timed out send may have been delivered.
+    api = FlakyAPI(asyncio.TimeoutError())
+    with pytest.raises(asyncio.TimeoutError):
+        await queue.submit(api.call)
+    assert api.calls == 1
+    api = FlakyAPI(asyncio.TimeoutError())
+    assert await queue.submit(api.call, idempotent=True) == 'ok'
+    assert api.calls == 2
+
+    # Client errors are not retried.
+    api = FlakyAPI(_response_error(400))
+    with pytest.raises(aiohttp.ClientResponseError):
+        await queue.submit(api.call)
+    assert api.calls == 1
+    assert queue.stats()['drops'] == {'error': 2}
+
+
+@pytest.mark.asyncio
+async def test_circuit_breaker():
+    queue = DeliveryQueue(
+        rate=100,
+        burst=100,
+        max_retries=0,
+        breaker_threshold=2,
+        breaker_reset_timeout=0.05,
+    )
+    api = FlakyAPI(*[_response_error(500)] * 2)
+    for _ in range(2):
+        with pytest.raises(aiohttp.ClientResponseError):
+            await queue.submit(api.call)
+    assert queue.stats()['circuit'] == 'open'
+    with pytest.raises(CircuitOpenError):
+        await queue.submit(api.call)
+    assert api.calls == 2
+
+    # A trial call closes the circuit once the reset timeout passed.
+    await asyncio.sleep(0.06)
+    assert queue.stats()['circuit'] == 'half_open'
+    assert await queue.submit(api.call) == 'ok'
+    assert queue.stats()['circuit'] == 'closed'
+    assert queue.stats()['drops'] == {
+        'retries_exhausted': 2,
+        'circuit_open': 1,
+    }
+
+
+@pytest.mark.asyncio
+async def test_circuit_breaker_trial_without_outcome():
+    queue = DeliveryQueue(
+        rate=100,
+        burst=100,
+        max_retries=0,
+        breaker_threshold=1,
+        breaker_reset_timeout=0.05,
+    )
+    api = FlakyAPI(_response_error(503))
+    with pytest.raises(aiohttp.ClientResponseError):
+        await queue.submit(api.call)
+    await asyncio.sleep(0.06)
+
+    # Unsupported and cancelled trial calls let the next call be the trial.
+    async def _unsupported() -> None:
+        raise NotImplementedError
+
+    with pytest.raises(NotImplementedError):
+        await queue.submit(_unsupported)
+    assert queue.breaker.state == 'half_open' and not queue.breaker.trial
+
+    call = asyncio.create_task(queue.submit(asyncio.Event().wait))
+    await asyncio.sleep(0)
+    assert queue.breaker.trial
+    call.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await call
+    assert not queue.breaker.trial
+
+    assert await queue.submit(api.call) == 'ok'
+    assert queue.stats()['circuit'] == 'closed'
+
+
+@pytest.mark.asyncio
+async def test_queue_full():
+    queue = DeliveryQueue(rate=100, burst=100, concurrency=1, max_queue=1)
+    release = asyncio.Event()
+
+    async def _blocked() -> None:
+        await release.wait()
+
+    calls = [asyncio.create_task(queue.submit(_blocked)) for _ in range(2)]
+    await asyncio.sleep(0)
+    assert queue.stats()['queue_depth'] == 1
+    with pytest.raises(FullQueueError):
+        await queue.submit(_blocked)
+    release.set()
+    await asyncio.gather(*calls)
+    assert queue.stats()['drops'] == {'queue_full': 1}
@@ -0,0 +1,145 @@
+import asyncio
+
+import pytest
+
+from ailingbot.channels.channel import ChannelAgent
+from ailingbot.channels.token import AccessTokenManager, SQLiteTokenStore
+from ailingbot.chat.messages import ResponseMessage
+from ailingbot.shared.errors import InvalidAccessTokenError
+
+
+class TokenServer:
+    """Issues numbered tokens, and accepts only the latest one."""
+
+    def __init__(self, expires_in: float = 7200):
+        self.expires_in = expires_in
+        self.issued = 0
+
+    async def fetch(self) -> tuple[str, float]:
+        await asyncio.sleep(0.01)
+        self.issued += 1
+        return f'token-{self.issued}', self.expires_in
+
+
+class TokenAgent(ChannelAgent):
+    def __init__(self, server: TokenServer):
+        super(TokenAgent, self).__init__()
+        self.server = server
+        self.tokens = AccessTokenManager(fetch=server.fetch)
+        self.used = []
+
+    async def send_message(self, message: ResponseMessage) -> None:
+        async def _call(access_token: str) -> None:
+            self.used.append(access_token)
+            if access_token != f'token-{self.server.issued}':
+                raise InvalidAccessTokenError('invalid access token')
+
+        await self._with_access_token(_call)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_requests_share_one_refresh():
+    server = TokenServer()
+    tokens = AccessTokenManager(fetch=server.fetch)
+    assert (
+        await asyncio.gather(*[tokens.get() for _ in range(10)])
+        == ['token-1'] * 10
+    )
+    assert server.issued == 1
+    assert tokens.stats()['shared_requests'] == 9
+    await tokens.close()
+
+
+@pytest.mark.asyncio
+async def test_background_refresh_before_expiry():
+    server = TokenServer(expires_in=0.2)
+    tokens = AccessTokenManager(
+        fetch=server.fetch,
+        expiry_margin=0,
+        refresh_margin=0.15,
+        retry_interval=0.01,
+    )
+    assert await tokens.get() == 'token-1'
+    await asyncio.sleep(0.1)
+    assert server.issued == 2
+    assert tokens.stats()['background_refreshes'] == 1
+    # Requests use the refreshed token without waiting.
+    assert tokens._valid() and await tokens.get() == 'token-2'
+    await tokens.close()
+
+
+@pytest.mark.asyncio
+async def test_unusable_token_does_not_loop_refreshes():
+    server = TokenServer(expires_in=0)
+    tokens = AccessTokenManager(fetch=server.fetch)
+    assert await tokens.get() == 'token-1'
+    await asyncio.sleep(0.1)
+    # Only requests refresh a token that expires on arrival.
+    assert server.issued == 1
+    assert tokens.refresh_handle is None
+    assert await tokens.get() == 'token-2'
+    await tokens.close()
+
+    # Short lived tokens are refreshed at most once per retry interval.
+    server = TokenServer(expires_in=0.02)
+    tokens = AccessTokenManager(
+        fetch=server.fetch, expiry_margin=0, retry_interval=0.05
+    )
+    await tokens.get()
+    await asyncio.sleep(0.12)
+    assert server.issued <= 3
+    await tokens.close()
+
+
+@pytest.mark.asyncio
+async def test_invalid_token_is_cleaned_and_retried_once():
+    server = TokenServer()
+    agent = TokenAgent(server)
+    await agent.send_message(ResponseMessage())
+    # The platform revokes the token before it expires.
+    server.issued += 1
+    await agent.send_message(ResponseMessage())
+    assert agent.used == ['token-1', 'token-1', 'token-3']
+    assert agent.stats()['tokens']['invalidations'] == 1
+
+    # A stale token reported as invalid does not drop the current one.
+    agent._clean_access_token('token-1')
+    assert await agent._get_access_token() == 'token-3'
+    await agent.finalize()
+
+
+@pytest.mark.asyncio
+async def test_token_store_shared_by_processes_and_restarts(tmp_path):
+    server = TokenServer()
+    path = str(tmp_path / 'tokens.sqlite3')
+
+    def _manager() -> AccessTokenManager:
+        # Each manager stands for a process, with its own store connection.
+        return AccessTokenManager(
+            fetch=server.fetch,
+            store=SQLiteTokenStore(path=path),
+            key='app',
+            lease_poll_interval=0.01,
+        )
+
+    managers = [_manager() for _ in range(3)]
+    assert (
+        await asyncio.gather(*[m.get() for m in managers]) == ['token-1'] * 3
+    )
+    assert server.issued == 1
+    assert sum(m.stats()['store_hits'] for m in managers) == 2
+
+    # A restarted process uses the stored token.
+    restarted = _manager()
+    assert await restarted.get() == 'token-1'
+    assert server.issued == 1
+
+    # A token reported as invalid is replaced in store for every process.
+    restarted.invalidate('token-1')
+    assert await restarted.get() == 'token-2'
+    managers[0].invalidate()
+    assert await managers[0].get() == 'token-2'
+    assert server.issued == 2
+
+    for m in [*managers, restarted]:
+        await m.close()
@@ -0,0 +1,271 @@
+import asyncio
+import random
+import re
+import typing
+
+import pytest
+from langchain.llms.base import LLM
+
+from ailingbot.chat.chatbot import ChatBot
+from ailingbot.chat.messages import TextRequestMessage
+from ailingbot.config import settings
+
+
+class HistoryCheckingFakeLLM(LLM):
+    """Fake LLM that answers with the conversations mentioned in the prompt."""
+
+    @property
+    def _llm_type(self) -> str:
+        return 'history-checking-fake'
+
+    def _call(self, prompt: str, stop=None, run_manager=None, **kwargs):
+        raise NotImplementedError
+
+    async def _acall(
+        self,
+        prompt: str,
+        stop: typing.Optional[list[str]] = None,
+        run_manager=None,
+        **kwargs: typing.Any,
+    ) -> str:
+        await asyncio.sleep(random.random() / 100)
+        return ','.join(sorted(set(re.findall(r'conversation-\d+', prompt))))
+
+
+@pytest.fixture
+def policy_settings():
+    settings.set(
+        'policy',
+        {
+            'name': 'conversation',
+            'history_size': 3,
+            'llm': {'_type': 'openai', 'openai_api_key': 'sk-fake'},
+        },
+    )
+    yield
+    settings.unset('policy')
+
+
+@pytest.mark.asyncio
+async def test_concurrent_conversations_are_isolated(policy_settings):
+    bot = ChatBot()
+    await bot.initialize()
+    bot.policy.llm = HistoryCheckingFakeLLM()
+
+    async def _conversation(number: int) -> list[str]:
+        conversation_id = f'conversation-{number}'
+        answers = []
+        for _ in range(5):
+            response = await bot.chat(
+                conversation_id=conversation_id,
+                message=TextRequestMessage(text=conversation_id),
+            )
+            answers.append(response.text)
+        return answers
+
+    results = await asyncio.gather(*[_conversation(x) for x in range(50)])
+    for number, answers in enumerate(results):
+        # Every prompt only mentions its own conversation.
+        assert answers == [f'conversation-{number}'] * 5
+
+    await bot.finalize()
+
+
+class SummarizingFakeLLM(LLM):
+    """Fake LLM that counts summarization calls, and answers with a fixed text otherwise."""
+
+    summaries: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return 'summarizing-fake'
+
+    def _call(self, prompt: str, stop=None, run_manager=None, **kwargs):
+        raise NotImplementedError
+
+    async def _acall(
+        self,
+        prompt: str,
+        stop: typing.Optional[list[str]] = None,
+        run_manager=None,
+        **kwargs: typing.Any,
+    ) -> str:
+        if 'New summary:' in prompt:
+            self.summaries += 1
+            return f'summary-{self.summaries}'
+        return 'answer'
+
+
+@pytest.mark.asyncio
+async def test_history_compaction(policy_settings):
+    settings.set('policy.compaction_threshold', 2)
+    bot = ChatBot()
+    await bot.initialize()
+    llm = SummarizingFakeLLM()
+    bot.policy.llm = llm
+
+    for x in range(5):
+        await bot.chat(
+            conversation_id='1',
+            message=TextRequestMessage(text=str(x)),
+        )
+        await asyncio.sleep(0)
+    await asyncio.gather(*bot.policy.compaction_tasks.values())
+
+    memory = await bot.policy.memories.load('1')
+    # Rounds 0 and 1 are compacted, rounds 2 to 4 are kept.
+    assert llm.summaries == 1
+    assert memory.summary == 'summary-1'
+    assert len(memory.chat_memory.messages) == 6
+    assert memory.load_memory_variables({})['history'].startswith(
+        'System: summary-1\nHuman: 2'
+    )
+    assert bot.policy.stats()['compaction']['compactions'] == 1
+
+    await bot.finalize()
+
+
+class BlockingSummaryFakeLLM(SummarizingFakeLLM):
+    """Summarizing fake LLM that waits for release before summarizing, or fails to summarize."""
+
+    release: typing.Any = None
+    fail: bool = False
+
+    async def _acall(
+        self,
+        prompt: str,
+        stop: typing.Optional[list[str]] = None,
+        run_manager=None,
+        **kwargs: typing.Any,
+    ) -> str:
+        if 'New summary:' in prompt:
+            if self.fail:
+                raise RuntimeError('summary failed')
+            await self.release.wait()
+        return await super(BlockingSummaryFakeLLM, self)._acall(
+            prompt, stop, run_manager, **kwargs
+        )
+
+
+@pytest.mark.asyncio
+async def test_history_compaction_skips_replaced_memory(policy_settings):
+    settings.set('policy.compaction_threshold', 2)
+    bot = ChatBot()
+    await bot.initialize()
+    llm = BlockingSummaryFakeLLM(release=asyncio.Event())
+    bot.policy.llm = llm
+
+    for x in range(5):
+        await bot.chat(
+            conversation_id='1',
+            message=TextRequestMessage(text=str(x)),
+        )
+    assert bot.policy.compaction_tasks
+
+    # The conversation is replaced in the store while summarizing.
+    replaced = bot.policy._create_memory()
+    replaced.save_context({'input': 'new'}, {'response': 'answer'})
+    await bot.policy.memories.save('1', replaced)
+    llm.release.set()
+    await asyncio.gather(*bot.policy.compaction_tasks.values())
+
+    memory = await bot.policy.memories.load('1')
+    assert memory.summary == ''
+    assert len(memory.chat_memory.messages) == 2
+    assert bot.policy.stats()['compaction']['compactions'] == 0
+
+    await bot.finalize()
+
+
+@pytest.mark.asyncio
+async def test_history_compaction_drops_after_failures(policy_settings):
+    settings.set('policy.compaction_threshold', 1)
+    settings.set('policy.compaction_max_failures', 2)
+    bot = ChatBot()
+    await bot.initialize()
+    bot.policy.llm = BlockingSummaryFakeLLM(fail=True)
+
+    for x in range(5):
+        await bot.chat(
+            conversation_id='1',
+            message=TextRequestMessage(text=str(x)),
+        )
+        await asyncio.gather(*bot.policy.compaction_tasks.values())
+
+    memory = await bot.policy.memories.load('1')
+    stats = bot.policy.stats()['compaction']
+    # Compactions after rounds 3 and 4 fail, the second one drops rounds 0 and 1 unsummarized.
+    assert stats['failures'] == 2
+    assert stats['drops'] == 1
+    assert memory.summary == ''
+    assert memory.load_memory_variables({})['history'].startswith('Human: 2')
+
+    await bot.finalize()
+
+
+class CountingFakeLLM(LLM):
+    """Slow fake LLM that counts calls."""
+
+    calls: int = 0
+
+    @property
+    def _llm_type(self) -> str:
+        return 'counting-fake'
+
+    def _call(self, prompt: str, stop=None, run_manager=None, **kwargs):
+        raise NotImplementedError
+
+    async def _acall(
+        self,
+        prompt: str,
+        stop: typing.Optional[list[str]] = None,
+        run_manager=None,
+        **kwargs: typing.Any,
+    ) -> str:
+        self.calls += 1
+        await asyncio.sleep(0.05)
+        return 'answer'
+
+
+async def _stream_texts(
+    policy, conversation_id: str, text: str = 'hello'
+) -> list[str]:
+    return [
+        r.text
+        async for r in policy.respond_stream(
+            conversation_id=conversation_id,
+            message=TextRequestMessage(text=text),
+        )
+    ]
+
+
+@pytest.mark.asyncio
+async def test_streaming_requests_share_flight(policy_settings):
+    settings.set('policy.cache', {'backend': 'memory'})
+    bot = ChatBot()
+    await bot.initialize()
+    llm = CountingFakeLLM()
+    bot.policy.llm = llm
+
+    results = await asyncio.gather(
+        *[_stream_texts(bot.policy, str(x)) for x in range(5)]
+    )
+    assert results == [['answer']] * 5
+    assert llm.calls == 1
+    assert bot.policy.stats()['cache']['shared_flights'] == 4
+    # Followers saved the round in their own memory.
+    memory = await bot.policy.memories.load('4')
+    assert len(memory.chat_memory.messages) == 2
+
+    # Followers of a cancelled leader run the chain themselves.
+    leader = asyncio.create_task(_stream_texts(bot.policy, 'leader', 'bye'))
+    await asyncio.sleep(0.01)
+    follower = asyncio.create_task(
+        _stream_texts(bot.policy, 'follower', 'bye')
+    )
+    await asyncio.sleep(0.01)
+    leader.cancel()
+    assert await follower == ['answer']
+    assert llm.calls == 3
+
+    await bot.finalize()
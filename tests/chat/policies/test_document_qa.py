@@ -0,0 +1,163 @@
+import concurrent.futures
+import typing
+
+import pytest
+from langchain.embeddings.base import Embeddings
+from langchain.llms.base import LLM
+
+from ailingbot.chat.chatbot import ChatBot
+from ailingbot.chat.messages import (
+    FallbackResponseMessage,
+    FileRequestMessage,
+    TextRequestMessage,
+)
+from ailingbot.config import settings
+from tests.chat.test_indexing import _make_pdf
+
+FRUITS = [
+    'apple',
+    'banana',
+    'cherry',
+    'grape',
+    'lemon',
+    'mango',
+    'peach',
+    'plum',
+]
+
+
+class FruitFakeEmbeddings(Embeddings):
+    """Fake embeddings with one dimension for each fruit mentioned in the text."""
+
+    def __init__(self):
+        self.embedded: list[str] = []
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        raise NotImplementedError
+
+    def embed_query(self, text: str) -> list[float]:
+        raise NotImplementedError
+
+    @staticmethod
+    def _embed(text: str) -> list[float]:
+        return [1.0 if x in text.lower() else 0.0 for x in FRUITS] + [0.1]
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        self.embedded.extend(texts)
+        return [self._embed(t) for t in texts]
+
+    async def aembed_query(self, text: str) -> list[float]:
+        return self._embed(text)
+
+
+class FirstContextFakeLLM(LLM):
+    """Fake LLM that answers with the first piece of context in the prompt."""
+
+    @property
+    def _llm_type(self) -> str:
+        return 'first-context-fake'
+
+    def _call(self, prompt: str, stop=None, run_manager=None, **kwargs):
+        raise NotImplementedError
+
+    async def _acall(
+        self,
+        prompt: str,
+        stop: typing.Optional[list[str]] = None,
+        run_manager=None,
+        **kwargs: typing.Any,
+    ) -> str:
+        return prompt.split('\n\n')[1]
+
+
+@pytest.fixture
+def policy_settings():
+    settings.set(
+        'policy',
+        {
+            'name': 'document_qa',
+            'chunk_size': 100,
+            'index_executor': 'thread',
+            'pages_per_task': 3,
+            'vector_store': 'numpy',
+            'llm': {'_type': 'openai', 'openai_api_key': 'sk-fake'},
+        },
+    )
+    yield
+    settings.unset('policy')
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('index_executor', ['thread', 'process'])
+async def test_index_and_ask(policy_settings, index_executor):
+    pytest.importorskip('pypdf')
+    settings.set('policy.index_executor', index_executor)
+    bot = ChatBot()
+    await bot.initialize()
+    embeddings = FruitFakeEmbeddings()
+    bot.policy.batcher.embeddings = embeddings
+    bot.policy.llm = FirstContextFakeLLM()
+
+    response = await bot.chat(
+        conversation_id='1',
+        message=FileRequestMessage(
+            content=_make_pdf([f'The {x} is ripe' for x in FRUITS]),
+            file_type='pdf',
+            file_name='fruits.pdf',
+        ),
+    )
+    assert 'fruits.pdf' in response.text
+    # Documents held in memory are parsed in threads, not copied to worker processes.
+    assert isinstance(
+        bot.policy.memory_executor, concurrent.futures.ThreadPoolExecutor
+    )
+    # Every page range is split and embedded.
+    assert sorted(embeddings.embedded) == sorted(
+        f'The {x} is ripe' for x in FRUITS
+    )
+
+    response = await bot.chat(
+        conversation_id='1',
+        message=TextRequestMessage(text='Is the mango ripe?'),
+    )
+    assert response.text == 'The mango is ripe'
+
+    await bot.finalize()
+
+
+@pytest.mark.asyncio
+async def test_unloaded_document_notice(policy_settings):
+    pytest.importorskip('pypdf')
+    settings.set('policy.max_index_bytes', 1)
+    bot = ChatBot()
+    await bot.initialize()
+    bot.policy.batcher.embeddings = FruitFakeEmbeddings()
+    bot.policy.llm = FirstContextFakeLLM()
+
+    for name in ['fruits.pdf', 'more.pdf']:
+        await bot.chat(
+            conversation_id='1',
+            message=FileRequestMessage(
+                content=_make_pdf(
+                    [f'The {x} is ripe in {name}' for x in FRUITS]
+                ),
+                file_type='pdf',
+                file_name=name,
+            ),
+        )
+    # Without an index path the first index can not be reopened, the user is told instead of being answered
+    # without it.
+    response = await bot.chat(
+        conversation_id='1',
+        message=TextRequestMessage(text='Is the mango ripe?'),
+    )
+    assert isinstance(response, FallbackResponseMessage)
+    assert 'fruits.pdf' in response.reason
+
+    response = await bot.chat(
+        conversation_id='1',
+        message=TextRequestMessage(text='Is the mango ripe?'),
+    )
+    assert response.text == 'The mango is ripe in more.pdf'
+
+    await bot.finalize()
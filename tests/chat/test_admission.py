@@ -0,0 +1,46 @@
+import asyncio
+
+import pytest
+
+from ailingbot.chat.admission import AdmissionController
+from ailingbot.shared.errors import FullQueueError, QueueTimeoutError
+
+
+@pytest.mark.asyncio
+async def test_priority_lanes():
+    controller = AdmissionController(
+        max_concurrency=1, lanes={'user': 0, 'group': 1}
+    )
+    order = []
+
+    async def _task(lane: str, number: int):
+        async with controller.admit(lane):
+            order.append((lane, number))
+            await asyncio.sleep(0.01)
+
+    first = asyncio.create_task(_task('group', 0))
+    await asyncio.sleep(0)
+    await asyncio.gather(
+        _task('group', 1), _task('user', 2), _task('group', 3), first
+    )
+    assert order == [('group', 0), ('user', 2), ('group', 1), ('group', 3)]
+    assert controller.stats()['running'] == 0
+    assert controller.stats()['admitted'] == 4
+
+
+@pytest.mark.asyncio
+async def test_reject_and_timeout():
+    controller = AdmissionController(
+        max_concurrency=1, max_queue_size=1, queue_timeout=0.01
+    )
+    async with controller.admit('user'):
+        waiter = asyncio.create_task(controller._acquire('user'))
+        await asyncio.sleep(0)
+        with pytest.raises(FullQueueError):
+            await controller._acquire('user')
+        with pytest.raises(QueueTimeoutError):
+            await waiter
+    assert controller.stats()['rejected'] == 1
+    assert controller.stats()['timed_out'] == 1
+    assert controller.stats()['running'] == 0
+    assert controller.stats()['queue_depth'] == 0
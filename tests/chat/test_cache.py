@@ -0,0 +1,59 @@
+import asyncio
+
+import pytest
+
+from ailingbot.chat.cache import ResponseCache, SingleFlight
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('backend', ['memory', 'sqlite'])
+async def test_response_cache(backend, tmp_path):
+    cache = ResponseCache.get_cache(
+        backend, maxsize=2, ttl=60, path=str(tmp_path / 'cache.sqlite3')
+    )
+    assert await cache.get('a') is None
+    await cache.set('a', '1')
+    await cache.set('b', '2')
+    assert await cache.get('a') == '1'
+    await cache.set('c', '3')
+    # b is the least recently used one.
+    assert await cache.get('b') is None
+    assert await cache.get('c') == '3'
+    assert cache.stats()['hits'] == 2
+    assert cache.stats()['misses'] == 2
+
+
+@pytest.mark.asyncio
+async def test_single_flight():
+    flights = SingleFlight()
+    calls = []
+
+    async def _fn():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return 'result'
+
+    results = await asyncio.gather(*[flights.do('k', _fn) for _ in range(3)])
+    assert calls == [1]
+    assert results == [('result', False), ('result', True), ('result', True)]
+    assert flights.calls == {}
+
+
+@pytest.mark.asyncio
+async def test_single_flight_leader_cancelled():
+    flights = SingleFlight()
+    calls = []
+
+    async def _fn():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return len(calls)
+
+    leader = asyncio.create_task(flights.do('k', _fn))
+    await asyncio.sleep(0)
+    follower = asyncio.create_task(flights.do('k', _fn))
+    await asyncio.sleep(0)
+    leader.cancel()
+    # The follower runs the call itself instead of failing with the leader.
+    assert await follower == (2, False)
+    assert leader.cancelled()
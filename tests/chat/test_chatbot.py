@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+
+from ailingbot.chat.chatbot import ChatBot
+from ailingbot.chat.messages import (
+    RequestMessage,
+    ResponseMessage,
+    SilenceResponseMessage,
+    TextRequestMessage,
+    TextResponseMessage,
+)
+from ailingbot.chat.policy import ChatPolicy
+
+
+class EchoPolicy(ChatPolicy):
+    def __init__(self):
+        super(EchoPolicy, self).__init__()
+        self.requests = []
+
+    async def respond(
+        self, *, conversation_id: str, message: RequestMessage
+    ) -> ResponseMessage:
+        self.requests.append(message.text)
+        await asyncio.sleep(0.02)
+        return TextResponseMessage(text=message.text)
+
+
+@pytest.mark.asyncio
+async def test_coalesce_messages():
+    bot = ChatBot()
+    bot.policy = EchoPolicy()
+    bot.coalesce_window = 10
+
+    responses = await asyncio.gather(
+        *[
+            bot.chat(
+                conversation_id='c',
+                message=TextRequestMessage(uuid=str(x), text=str(x)),
+            )
+            for x in range(3)
+        ]
+    )
+    assert bot.policy.requests == ['0\n1\n2']
+    assert isinstance(responses[0], SilenceResponseMessage)
+    assert isinstance(responses[1], SilenceResponseMessage)
+    assert responses[2].text == '0\n1\n2'
+    assert responses[2].ack_uuid == '2'
+    assert bot.stats()['coalescing']['coalesced_messages'] == 2
+
+
+@pytest.mark.asyncio
+async def test_coalesce_cancelled_waiter():
+    bot = ChatBot()
+    bot.policy = EchoPolicy()
+    bot.coalesce_window = 10
+
+    calls = [
+        asyncio.create_task(
+            bot.chat(
+                conversation_id='c',
+                message=TextRequestMessage(uuid=str(x), text=str(x)),
+            )
+        )
+        for x in range(3)
+    ]
+    await asyncio.sleep(0)
+    calls[1].cancel()
+    responses = await asyncio.gather(*calls, return_exceptions=True)
+    # The other waiters still get the response of the whole batch.
+    assert isinstance(responses[0], SilenceResponseMessage)
+    assert isinstance(responses[1], asyncio.CancelledError)
+    assert responses[2].text == '0\n1\n2'
+
+
+@pytest.mark.asyncio
+async def test_coalesce_disabled():
+    bot = ChatBot()
+    bot.policy = EchoPolicy()
+
+    responses = await asyncio.gather(
+        *[
+            bot.chat(
+                conversation_id='c',
+                message=TextRequestMessage(uuid=str(x), text=str(x)),
+            )
+            for x in range(3)
+        ]
+    )
+    assert bot.policy.requests == ['0', '1', '2']
+    assert [r.text for r in responses] == ['0', '1', '2']
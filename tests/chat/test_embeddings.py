@@ -0,0 +1,114 @@
+import asyncio
+import typing
+
+import openai.error
+import pytest
+from langchain.embeddings.base import Embeddings
+
+from ailingbot.chat.embeddings import (
+    BatchingEmbeddings,
+    CachedEmbeddings,
+    SQLiteEmbeddingCache,
+)
+
+
+class CountingFakeEmbeddings(Embeddings):
+    def __init__(
+        self,
+        *,
+        rate_limits: int = 0,
+        errors: typing.Optional[list[Exception]] = None,
+    ):
+        self.embedded: list[str] = []
+        self.requests: list[list[str]] = []
+        self.rate_limits = rate_limits
+        self.errors = errors or []
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        raise NotImplementedError
+
+    def embed_query(self, text: str) -> list[float]:
+        raise NotImplementedError
+
+    async def aembed_documents(self, texts: list[str]) -> list[list[float]]:
+        if self.rate_limits:
+            self.rate_limits -= 1
+            raise openai.error.RateLimitError('slow down', http_status=429)
+        if self.errors:
+            raise self.errors.pop(0)
+        self.requests.append(texts)
+        self.embedded.extend(texts)
+        return [[float(len(t)), 0.5] for t in texts]
+
+
+@pytest.mark.asyncio
+async def test_cached_embeddings(tmp_path):
+    path = str(tmp_path / 'embeddings.sqlite3')
+    fake = CountingFakeEmbeddings()
+    cache = SQLiteEmbeddingCache(path=path)
+    embeddings = CachedEmbeddings(embeddings=fake, cache=cache, model='m')
+    assert await embeddings.aembed_documents(['a', 'bb']) == [
+        [1.0, 0.5],
+        [2.0, 0.5],
+    ]
+    cache.close()
+
+    # Only the new chunk of the revised document is embedded, after restart.
+    cache = SQLiteEmbeddingCache(path=path)
+    embeddings = CachedEmbeddings(embeddings=fake, cache=cache, model='m')
+    assert await embeddings.aembed_documents(['bb', 'ccc', 'a']) == [
+        [2.0, 0.5],
+        [3.0, 0.5],
+        [1.0, 0.5],
+    ]
+    assert fake.embedded == ['a', 'bb', 'ccc']
+    assert cache.stats()['hits'] == 2
+    assert cache.stats()['bytes_saved'] == 3
+
+    # Vectors of another model are not shared.
+    embeddings = CachedEmbeddings(embeddings=fake, cache=cache, model='n')
+    await embeddings.aembed_documents(['a'])
+    assert fake.embedded[-1] == 'a'
+    cache.close()
+
+
+@pytest.mark.asyncio
+async def test_batching_embeddings():
+    fake = CountingFakeEmbeddings(rate_limits=1)
+    embeddings = BatchingEmbeddings(
+        embeddings=fake, batch_size=3, batch_delay=0.01, backoff_base=0.01
+    )
+    # Chunks of concurrent uploads share requests.
+    a, b = await asyncio.gather(
+        embeddings.aembed_documents(['a', 'bb']),
+        embeddings.aembed_documents(['ccc', 'dddd']),
+    )
+    assert a == [[1.0, 0.5], [2.0, 0.5]]
+    assert b == [[3.0, 0.5], [4.0, 0.5]]
+    assert fake.requests == [['a', 'bb', 'ccc'], ['dddd']]
+    assert embeddings.stats()['rate_limited'] == 1
+
+
+@pytest.mark.asyncio
+async def test_batching_embeddings_transient_errors():
+    fake = CountingFakeEmbeddings(
+        errors=[
+            openai.error.Timeout('timed out'),
+            openai.error.APIConnectionError('reset'),
+            openai.error.ServiceUnavailableError(
+                'overloaded', http_status=503
+            ),
+            openai.error.APIError('bad gateway', http_status=502),
+        ]
+    )
+    embeddings = BatchingEmbeddings(
+        embeddings=fake, batch_delay=0.01, backoff_base=0.01
+    )
+    assert await embeddings.aembed_documents(['a']) == [[1.0, 0.5]]
+    assert embeddings.stats()['transient_errors'] == 4
+
+    # Other errors are not retried.
+    fake.errors = [openai.error.InvalidRequestError('too long', param=None)]
+    with pytest.raises(openai.error.InvalidRequestError):
+        await embeddings.aembed_documents(['b'])
+    assert embeddings.stats()['requests'] == 6
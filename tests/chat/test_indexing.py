@@ -0,0 +1,217 @@
+import asyncio
+import io
+import tempfile
+
+import pytest
+
+from ailingbot.chat.indexing import (
+    SharedIndexRegistry,
+    count_pdf_pages,
+    file_source,
+    index_key,
+    load_and_split,
+)
+
+
+def _make_pdf(texts: list[str]) -> bytes:
+    """Makes a PDF document with one line of text on each page."""
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        b'',
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+    ]
+    kids = []
+    for text in texts:
+        stream = f'BT /F1 12 Tf 72 720 Td ({text}) Tj ET'.encode()
+        objects.append(
+            b'<< /Length %d >>\nstream\n%s\nendstream' % (len(stream), stream)
+        )
+        objects.append(
+            b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] '
+            b'/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>'
+            % (len(objects))
+        )
+        kids.append(b'%d 0 R' % len(objects))
+    objects[1] = b'<< /Type /Pages /Kids [%s] /Count %d >>' % (
+        b' '.join(kids),
+        len(kids),
+    )
+
+    pdf = b'%PDF-1.4\n'
+    offsets = []
+    for number, obj in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += b'%d 0 obj\n%s\nendobj\n' % (number, obj)
+    xref = len(pdf)
+    pdf += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    pdf += b''.join(b'%010d 00000 n \n' % x for x in offsets)
+    pdf += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (
+        len(objects) + 1,
+        xref,
+    )
+    return pdf
+
+
+def test_load_and_split_page_range():
+    pytest.importorskip('pypdf')
+    content = _make_pdf([f'Page {x}' for x in range(5)])
+    assert count_pdf_pages(content) == 5
+    chunks = load_and_split(
+        content, chunk_size=100, chunk_overlap=0, start=1, stop=3
+    )
+    assert [c.page_content for c in chunks] == ['Page 1', 'Page 2']
+    assert [c.metadata['page'] for c in chunks] == [1, 2]
+
+
+def test_spooled_file_source(tmp_path):
+    pytest.importorskip('pypdf')
+    content = _make_pdf([f'Page {x}' for x in range(3)])
+    spooled = tempfile.NamedTemporaryFile(dir=tmp_path)
+    spooled.write(content)
+
+    # Files spooled to disk are read from their path, in-memory files as content.
+    path = file_source(spooled)
+    assert path == spooled.name
+    assert file_source(io.BytesIO(content)) == content
+    assert count_pdf_pages(path) == 3
+    assert [
+        c.page_content
+        for c in load_and_split(path, chunk_size=100, chunk_overlap=0)
+    ] == ['Page 0', 'Page 1', 'Page 2']
+    assert index_key(
+        path, file_type='pdf', chunk_size=1000, chunk_overlap=0
+    ) == index_key(content, file_type='pdf', chunk_size=1000, chunk_overlap=0)
+
+
+def test_index_key():
+    key = index_key(b'pdf', file_type='PDF', chunk_size=1000, chunk_overlap=0)
+    assert key == index_key(
+        b'pdf', file_type='pdf', chunk_size=1000, chunk_overlap=0
+    )
+    assert key != index_key(
+        b'pdf', file_type='pdf', chunk_size=500, chunk_overlap=0
+    )
+    assert key != index_key(
+        b'doc', file_type='pdf', chunk_size=1000, chunk_overlap=0
+    )
+    assert key != index_key(
+        b'pdf',
+        file_type='pdf',
+        chunk_size=1000,
+        chunk_overlap=0,
+        splitter='tiktoken',
+    )
+
+
+@pytest.mark.asyncio
+async def test_shared_index_registry():
+    registry = SharedIndexRegistry()
+    builds = []
+
+    async def _build():
+        builds.append(1)
+        await asyncio.sleep(0.01)
+        return object()
+
+    # Concurrent uploads of the same document build it once.
+    a, b = await asyncio.gather(
+        registry.acquire('1', 'key', _build),
+        registry.acquire('2', 'key', _build),
+    )
+    assert a is b
+    assert len(builds) == 1
+    assert await registry.acquire('3', 'key', _build) is a
+    assert registry.stats()['reuses'] == 2
+
+    # Re-uploading the same document keeps the index.
+    assert await registry.acquire('3', 'key', _build) is a
+    assert len(builds) == 1
+
+    # The index is dropped once all conversations moved on.
+    await registry.acquire('1', 'other', _build)
+    await registry.release('2')
+    assert registry.stats()['live_indexes'] == 2
+    await registry.release('3')
+    assert registry.stats()['live_indexes'] == 1
+    assert registry.stats()['conversations'] == 1
+
+
+@pytest.mark.asyncio
+async def test_reupload_by_only_owner():
+    registry = SharedIndexRegistry()
+    index = object()
+
+    async def _build():
+        return index
+
+    await registry.acquire('1', 'key', _build, 'a.pdf')
+    # The only conversation using the index uploads it again, under the same name and under a new one.
+    assert await registry.acquire('1', 'key', _build, 'a.pdf') is index
+    assert await registry.acquire('1', 'key', _build, 'b.pdf') is index
+    assert registry.documents('1') == ['b.pdf']
+    assert registry.stats()['live_indexes'] == 1
+    assert registry.stats()['builds'] == 1
+    assert [i for _, i in await registry.get('1')] == [index]
+
+
+class ReloadingIndexRegistry(SharedIndexRegistry):
+    def __init__(self, **kwargs):
+        super(ReloadingIndexRegistry, self).__init__(**kwargs)
+        self.unloaded = {}
+
+    async def _reload(self, key):
+        return self.unloaded.pop(key, None)
+
+    async def _unload(self, key, index):
+        self.unloaded[key] = index
+
+
+@pytest.mark.asyncio
+async def test_index_registry_eviction():
+    async def _build():
+        return object()
+
+    registry = SharedIndexRegistry(max_indexes=1)
+    await registry.acquire('1', 'a', _build, 'a.pdf')
+    await registry.acquire('2', 'b', _build, 'b.pdf')
+    # Unloaded indexes can not be reloaded, so they are dropped with their conversations.
+    assert await registry.get('1') == []
+    assert registry.stats()['evictions'] == 1
+    assert registry.stats()['indexes'] == 1
+    # The conversation is told once which documents were dropped.
+    assert registry.pop_dropped('1') == ['a.pdf']
+    assert registry.pop_dropped('1') == []
+
+    registry = ReloadingIndexRegistry(max_indexes=1)
+    a = await registry.acquire('1', 'a', _build)
+    await registry.acquire('2', 'b', _build)
+    assert registry.stats()['live_indexes'] == 1
+    assert await registry.get('1') == [('', a)]
+    assert registry.stats()['reloads'] == 1
+    assert 'b' in registry.unloaded
+
+
+class SizedIndexRegistry(SharedIndexRegistry):
+    async def _size(self, index):
+        return 100
+
+
+@pytest.mark.asyncio
+async def test_index_registry_byte_limit():
+    async def _build():
+        return object()
+
+    registry = SizedIndexRegistry(max_bytes=250)
+    await registry.acquire('1', 'a', _build, 'a.pdf')
+    await registry.acquire('1', 'b', _build, 'b.pdf')
+    assert registry.stats()['live_bytes'] == 200
+    await registry.acquire('2', 'c', _build, 'c.pdf')
+    # The least recently used index is unloaded once loaded indexes exceed the byte limit.
+    assert registry.stats()['live_indexes'] == 2
+    assert registry.stats()['live_bytes'] == 200
+    assert registry.documents('1') == ['b.pdf']
+    # Uploading a dropped document again clears it from the dropped ones, and unloads the next one.
+    await registry.acquire('1', 'a', _build, 'a.pdf')
+    assert registry.pop_dropped('1') == ['b.pdf']
+    await registry.release('1')
+    assert registry.stats()['live_bytes'] == 100
@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+from langchain.docstore.document import Document
+from langchain.embeddings.base import Embeddings
+
+from ailingbot.chat.indexing import MultiDocumentRetriever, NumpyIndexRegistry
+from ailingbot.chat.lexical import BM25Index, tokenize
+
+TEXTS = [
+    '员工每年享有十天带薪年假',
+    'Annual leave requests are approved by managers',
+    '报销需要在三十天内提交发票',
+    'Expense claims need receipts within 30 days',
+]
+
+
+def test_tokenize():
+    assert tokenize('Annual-leave 2023, 年假天数') == [
+        'annual',
+        'leave',
+        '2023',
+        '年',
+        '假',
+        '天',
+        '数',
+        '年假',
+        '假天',
+        '天数',
+    ]
+
+
+def test_bm25_search(tmp_path):
+    index = BM25Index.from_documents(
+        [
+            Document(page_content=t, metadata={'n': i})
+            for i, t in enumerate(TEXTS)
+        ]
+    )
+    docs = index.search('年假有几天？', k=2)
+    assert docs[0][0].page_content == TEXTS[0]
+    assert docs[0][0].metadata == {'n': 0}
+    assert [d.page_content for d, _ in index.search('RECEIPTS')] == [TEXTS[3]]
+    assert index.search('nothing matches') == []
+
+    index.save(str(tmp_path))
+    loaded = BM25Index.load(str(tmp_path))
+    assert isinstance(loaded.doc_ids, np.memmap)
+    assert loaded.search('expense claims') == index.search('expense claims')
+
+
+class KeywordEmbeddings(Embeddings):
+    """Embeds texts by whether they are about leave or expenses."""
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [self.embed_query(t) for t in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        leave = any(w in text.lower() for w in ('假', 'leave', 'holiday'))
+        return [1.0, 0.0] if leave else [0.0, 1.0]
+
+    async def aembed_query(self, text: str) -> list[float]:
+        return self.embed_query(text)
+
+
+@pytest.mark.asyncio
+async def test_lexical_and_hybrid_retrieval(tmp_path):
+    documents = [Document(page_content=t) for t in TEXTS]
+
+    # BM25 mode needs no embeddings, and persists the BM25 index.
+    registry = NumpyIndexRegistry(
+        embeddings=None, path=str(tmp_path), retrieval='bm25'
+    )
+    index = await registry.build('key', documents, None)
+    assert index.vector is None
+    assert (tmp_path / 'bm25' / 'key').is_dir()
+    retriever = MultiDocumentRetriever(
+        registry=registry, indexes=[('a.pdf', index)], k=1
+    )
+    docs = await retriever.aget_relevant_documents('报销发票')
+    assert [(d.page_content, d.metadata['document']) for d in docs] == [
+        (TEXTS[2], 'a.pdf')
+    ]
+    await registry.close()
+
+    # Hybrid mode ranks chunks matching both the keywords and the meaning first.
+    embeddings = KeywordEmbeddings()
+    registry = NumpyIndexRegistry(embeddings=embeddings, retrieval='hybrid')
+    index = await registry.build(
+        'key', documents, embeddings.embed_documents(TEXTS)
+    )
+    retriever = MultiDocumentRetriever(
+        registry=registry, indexes=[('a.pdf', index)], k=2
+    )
+    docs = await retriever.aget_relevant_documents(
+        'holiday approved by managers'
+    )
+    assert [d.page_content for d in docs] == [TEXTS[1], TEXTS[0]]
@@ -0,0 +1,47 @@
+import asyncio
+
+import pytest
+
+from ailingbot.chat.lock import (
+    ConversationLockManager,
+    RefCountLockManager,
+    StripedLockManager,
+)
+
+
+@pytest.mark.asyncio
+async def test_refcount_lock_manager():
+    manager = ConversationLockManager.get_lock_manager('refcount')
+    assert isinstance(manager, RefCountLockManager)
+
+    order = []
+
+    async def _task(conversation_id: str, number: int):
+        async with manager.hold(conversation_id):
+            order.append((conversation_id, number))
+            await asyncio.sleep(0.01)
+
+    await asyncio.gather(*[_task('a', x) for x in range(3)], _task('b', 0))
+    assert [x for x in order if x[0] == 'a'] == [('a', 0), ('a', 1), ('a', 2)]
+    assert manager.live_locks == 0
+    assert manager.stats()['acquisitions'] == 4
+    assert manager.stats()['contentions'] == 2
+
+    for x in range(1000):
+        async with manager.hold(str(x)):
+            pass
+    assert manager.live_locks == 0
+
+
+@pytest.mark.asyncio
+async def test_striped_lock_manager():
+    manager = ConversationLockManager.get_lock_manager('striped', stripes=4)
+    assert isinstance(manager, StripedLockManager)
+    # Stripes are allocated on first use.
+    assert manager.live_locks == 0
+
+    for x in range(100):
+        async with manager.hold(str(x)):
+            pass
+    assert manager.live_locks == 4
+    assert manager.stats()['acquisitions'] == 100
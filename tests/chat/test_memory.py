@@ -0,0 +1,73 @@
+import pytest
+from langchain.memory import ConversationBufferWindowMemory
+
+from ailingbot.chat.memory import (
+    ConversationMemoryStore,
+    TokenBudgetWindowMemory,
+)
+
+
+def _memory_factory():
+    return ConversationBufferWindowMemory(k=5)
+
+
+@pytest.mark.asyncio
+async def test_lru_memory_store():
+    store = ConversationMemoryStore.get_store(
+        'memory', memory_factory=_memory_factory, max_conversations=2
+    )
+    for x in range(3):
+        memory = await store.load(str(x))
+        memory.save_context({'input': str(x)}, {'response': str(x)})
+        await store.save(str(x), memory)
+
+    assert store.stats()['live_conversations'] == 2
+    assert store.stats()['evictions'] == 1
+    assert (await store.load('0')).chat_memory.messages == []
+
+
+@pytest.mark.asyncio
+async def test_sqlite_memory_store(tmp_path):
+    path = str(tmp_path / 'memory.sqlite3')
+    store = ConversationMemoryStore.get_store(
+        'sqlite',
+        memory_factory=_memory_factory,
+        max_conversations=1,
+        path=path,
+    )
+    for x in range(2):
+        memory = await store.load(str(x))
+        memory.save_context({'input': str(x)}, {'response': str(x)})
+        await store.save(str(x), memory)
+
+    # Conversation 0 was spilled, and is reloaded on demand.
+    memory = await store.load('0')
+    assert memory.load_memory_variables({})['history'] == 'Human: 0\nAI: 0'
+    assert store.stats()['reloads'] == 1
+    await store.close()
+
+    # Conversations survive restarts.
+    store = ConversationMemoryStore.get_store(
+        'sqlite', memory_factory=_memory_factory, path=path
+    )
+    memory = await store.load('1')
+    assert memory.load_memory_variables({})['history'] == 'Human: 1\nAI: 1'
+    await store.close()
+
+
+def test_token_budget_window_memory():
+    memory = TokenBudgetWindowMemory(k=5, max_token_limit=25)
+    for x in range(4):
+        memory.save_context({'input': f'q{x}'}, {'response': f'a{x}'})
+    # Token counts are cached on messages, so the encoding is never loaded here.
+    for x, message in enumerate(memory.chat_memory.messages):
+        message.additional_kwargs['token_count'] = 5 + x
+
+    history = memory.load_memory_variables({})['history']
+    assert history == 'Human: q3\nAI: a3'
+    assert memory.last_token_count == 11 + 12
+    assert memory.last_window_token_count == sum(range(5, 13))
+
+    memory.max_token_limit = 45
+    history = memory.load_memory_variables({})['history']
+    assert history == 'Human: q2\nAI: a2\nHuman: q3\nAI: a3'
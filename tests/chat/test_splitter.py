@@ -0,0 +1,40 @@
+import tiktoken
+
+from ailingbot.chat.splitter import TiktokenTextSplitter
+
+# Byte level encoding without merges, so that tests need not download encodings.
+ENCODING = tiktoken.Encoding(
+    'bytes',
+    pat_str=r'\S+|\s+',
+    mergeable_ranks={bytes([x]): x for x in range(256)},
+    special_tokens={},
+)
+TEXT = (
+    '员工每年享有十天年假。年假需提前申请！'
+    'Leave must be approved. Expenses are paid monthly.\n\n报销需要发票。'
+)
+
+
+def test_tiktoken_splitter_sentences():
+    splitter = TiktokenTextSplitter(ENCODING, chunk_size=30, chunk_overlap=0)
+    chunks = splitter.split_text(TEXT)
+    assert chunks == [
+        '员工每年享有十天年假',
+        '。年假需提前申请！',
+        'Leave must be approved.',
+        'Expenses are paid monthly.',
+        '报销需要发票。',
+    ]
+    assert all(len(ENCODING.encode(c)) <= 30 for c in chunks)
+
+
+def test_tiktoken_splitter_overlap():
+    splitter = TiktokenTextSplitter(ENCODING, chunk_size=30, chunk_overlap=10)
+    chunks = splitter.split_text(TEXT)
+    assert chunks[0] == '员工每年享有十天年假'
+    assert chunks[-1] == '报销需要发票。'
+    # Every chunk ends after the previous one, and cuts never break characters.
+    positions = [TEXT.index(c) + len(c) for c in chunks]
+    assert positions == sorted(set(positions))
+    # Chunks without sentence ends are cut between words.
+    assert 'must be approved.' in chunks
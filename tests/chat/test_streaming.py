@@ -0,0 +1,38 @@
+import typing
+
+import pytest
+from langchain import LLMChain, PromptTemplate
+from langchain.callbacks.manager import AsyncCallbackManagerForLLMRun
+from langchain.llms.base import LLM
+
+from ailingbot.chat.streaming import arun_stream
+
+
+class StreamingFakeLLM(LLM):
+    @property
+    def _llm_type(self) -> str:
+        return 'streaming-fake'
+
+    def _call(self, prompt: str, stop=None, run_manager=None, **kwargs):
+        return 'hello world'
+
+    async def _acall(
+        self,
+        prompt: str,
+        stop: typing.Optional[list[str]] = None,
+        run_manager: typing.Optional[AsyncCallbackManagerForLLMRun] = None,
+        **kwargs: typing.Any,
+    ) -> str:
+        for token in ['hello', ' ', 'world']:
+            await run_manager.on_llm_new_token(token)
+        return 'hello world'
+
+
+@pytest.mark.asyncio
+async def test_arun_stream():
+    chain = LLMChain(
+        llm=StreamingFakeLLM(),
+        prompt=PromptTemplate.from_template('{question}'),
+    )
+    texts = [x async for x in arun_stream(chain, 'hi')]
+    assert texts == ['hello', 'hello ', 'hello world', 'hello world']
@@ -0,0 +1,166 @@
+import numpy as np
+import pytest
+from langchain.docstore.document import Document
+from langchain.embeddings.base import Embeddings
+
+from ailingbot.chat.indexing import (
+    MultiDocumentRetriever,
+    NumpyIndexRegistry,
+    RetrievalCache,
+)
+from ailingbot.chat.vectorstore import NumpyVectorStore
+
+VECTORS = {
+    'apple': [1.0, 0.1, 0.0],
+    'banana': [0.8, 0.6, 0.0],
+    'car': [0.0, 0.2, 1.0],
+    'truck': [0.1, 0.0, 0.9],
+}
+
+
+class FakeEmbeddings(Embeddings):
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return [VECTORS[t] for t in texts]
+
+    def embed_query(self, text: str) -> list[float]:
+        return VECTORS[text]
+
+    async def aembed_query(self, text: str) -> list[float]:
+        return VECTORS[text]
+
+
+@pytest.mark.parametrize('dtype', ['float32', 'float16', 'int8'])
+def test_numpy_vector_store_search(dtype):
+    store = NumpyVectorStore.from_texts(
+        list(VECTORS),
+        FakeEmbeddings(),
+        metadatas=[{'n': x} for x in range(4)],
+        dtype=dtype,
+    )
+    assert store.matrix.dtype == np.dtype(dtype)
+    docs = store.similarity_search('apple', k=2)
+    assert [d.page_content for d in docs] == ['apple', 'banana']
+    assert docs[1].metadata == {'n': 1}
+    assert [d.page_content for d in store.similarity_search('car', k=9)][
+        :2
+    ] == ['car', 'truck']
+
+
+def test_numpy_vector_store_save_load(tmp_path):
+    store = NumpyVectorStore.from_texts(
+        list(VECTORS), FakeEmbeddings(), dtype='int8'
+    )
+    store.save(str(tmp_path))
+    loaded = NumpyVectorStore.load(str(tmp_path), embedding=FakeEmbeddings())
+    assert isinstance(loaded.matrix, np.memmap)
+    assert [d.page_content for d in loaded.similarity_search('truck', 1)] == [
+        'truck'
+    ]
+
+
+@pytest.mark.asyncio
+async def test_numpy_index_registry_persistence(tmp_path):
+    documents = [Document(page_content=t) for t in VECTORS]
+    vectors = list(VECTORS.values())
+    registry = NumpyIndexRegistry(
+        embeddings=FakeEmbeddings(), path=str(tmp_path), max_indexes=1
+    )
+
+    async def _build():
+        return await registry.build('key', documents, vectors)
+
+    await registry.acquire('1', 'key', _build, 'fruits.pdf')
+    await registry.close()
+
+    # Indexes and conversations survive restarts.
+    registry = NumpyIndexRegistry(
+        embeddings=FakeEmbeddings(), path=str(tmp_path), max_indexes=1
+    )
+    retriever = MultiDocumentRetriever(
+        registry=registry, indexes=await registry.get('1')
+    )
+    docs = await retriever.aget_relevant_documents('banana')
+    assert docs[0].page_content == 'banana'
+    assert docs[0].metadata['document'] == 'fruits.pdf'
+    assert registry.stats()['reloads'] == 1
+
+    await registry.release('1')
+    assert not (tmp_path / 'numpy' / 'key').exists()
+    await registry.close()
+
+
+@pytest.mark.asyncio
+async def test_multi_document_retrieval():
+    registry = NumpyIndexRegistry(embeddings=FakeEmbeddings())
+
+    def _builder(texts):
+        async def _build():
+            return await registry.build(
+                ','.join(texts),
+                [Document(page_content=t) for t in texts],
+                [VECTORS[t] for t in texts],
+            )
+
+        return _build
+
+    await registry.acquire(
+        '1', 'fruits', _builder(['apple', 'banana']), 'a.pdf'
+    )
+    await registry.acquire('1', 'cars', _builder(['car', 'truck']), 'b.pdf')
+    assert registry.documents('1') == ['a.pdf', 'b.pdf']
+
+    # Questions search over all documents.
+    retriever = MultiDocumentRetriever(
+        registry=registry, indexes=await registry.get('1'), k=2
+    )
+    docs = await retriever.aget_relevant_documents('truck')
+    assert [(d.page_content, d.metadata['document']) for d in docs] == [
+        ('truck', 'b.pdf'),
+        ('car', 'b.pdf'),
+    ]
+
+    # A single document is removed without touching the others.
+    assert await registry.remove('1', 'b.pdf')
+    assert not await registry.remove('1', 'b.pdf')
+    assert registry.documents('1') == ['a.pdf']
+    assert registry.stats()['indexes'] == 1
+
+    # Uploading a document with the same name replaces it.
+    await registry.acquire('1', 'cars', _builder(['car', 'truck']), 'a.pdf')
+    assert registry.documents('1') == ['a.pdf']
+    assert list(registry.refcounts) == ['cars']
+
+
+@pytest.mark.asyncio
+async def test_retrieval_cache():
+    class CountingEmbeddings(FakeEmbeddings):
+        queries = 0
+
+        async def aembed_query(self, text: str) -> list[float]:
+            self.queries += 1
+            return VECTORS[text.strip().lower()]
+
+    embeddings = CountingEmbeddings()
+    cache = RetrievalCache()
+    registry = NumpyIndexRegistry(embeddings=embeddings, cache=cache)
+    documents = [Document(page_content=t) for t in VECTORS]
+
+    async def _build():
+        return await registry.build('key', documents, list(VECTORS.values()))
+
+    await registry.acquire('1', 'key', _build)
+    retriever = MultiDocumentRetriever(
+        registry=registry, indexes=await registry.get('1'), k=1
+    )
+    docs = await retriever.aget_relevant_documents('car')
+    # Near-identical questions are answered from cache without embedding.
+    assert await retriever.aget_relevant_documents('  CAR ') == docs
+    assert embeddings.queries == 1
+    assert cache.stats()['result_hits'] == 1
+
+    # Rebuilding the index invalidates its results, but not query vectors.
+    await registry.build('key', documents, list(VECTORS.values()))
+    assert await retriever.aget_relevant_documents('car') == docs
+    assert embeddings.queries == 1
+    assert cache.stats()['vector_hits'] == 1
+    assert cache.stats()['invalidations'] == 1
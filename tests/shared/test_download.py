@@ -0,0 +1,51 @@
+import io
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+from ailingbot.shared.download import download
+from ailingbot.shared.errors import FileTooLargeError
+
+
+@pytest.mark.asyncio
+async def test_download():
+    body = bytes(range(256)) * 1024
+
+    async def _sized(_):
+        return web.Response(body=body)
+
+    async def _chunked(_):
+        response = web.StreamResponse()
+        response.enable_chunked_encoding()
+        await response.prepare(_)
+        for x in range(0, len(body), 4096):
+            await response.write(body[x : x + 4096])
+        return response
+
+    app = web.Application()
+    app.router.add_get('/sized', _sized)
+    app.router.add_get('/chunked', _chunked)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    url = f'http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}'
+
+    async with aiohttp.ClientSession() as session:
+        # Small files stay in memory, larger ones spill to disk.
+        async with session.get(f'{url}/sized') as r:
+            file = await download(r, max_size=0, spool_size=len(body))
+        assert isinstance(file, io.BytesIO) and file.read() == body
+        async with session.get(f'{url}/chunked') as r:
+            file = await download(r, max_size=0, spool_size=1024)
+        assert isinstance(file.name, str) and file.read() == body
+        file.close()
+
+        # Oversized files are rejected by Content-Length before reading, or as soon as the limit is passed.
+        for path in ('sized', 'chunked'):
+            async with session.get(f'{url}/{path}') as r:
+                with pytest.raises(FileTooLargeError):
+                    await download(r, max_size=len(body) - 1, spool_size=1024)
+
+    await runner.cleanup()